@@ -0,0 +1,531 @@
+""" An in-process stand-in for the parts of the Swift API used by vertica_backup, for benchmarks and tests.
+    It serves keystone v2 and v1 auth, account and container listings with json, prefix, marker and delimiter,
+    object PUT/GET/HEAD/DELETE with ETags and bulk delete. Latency, bandwidth and errors can be injected.
+
+Copyright 2014 Hewlett-Packard Development Company, L.P.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software 
+and associated documentation files (the "Software"), to deal in the Software without restriction, 
+including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, 
+and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, 
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or 
+substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, 
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR 
+PURPOSE AND NONINFRINGEMENT.
+
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR 
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF 
+OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from datetime import datetime
+import argparse
+import errno
+import hashlib
+import json
+import random
+import re
+import socket
+from SocketServer import ThreadingMixIn
+import sys
+import threading
+import time
+import urllib
+import urlparse
+import uuid
+
+ACCOUNT = 'AUTH_test'
+LISTING_LIMIT = 10000
+
+
+class FakeObject(object):
+    __slots__ = ('data', 'etag', 'last_modified', 'content_type', 'delete_at')
+
+    def __init__(self, data, content_type='application/octet-stream'):
+        self.data = data
+        self.etag = hashlib.md5(data).hexdigest()
+        self.last_modified = datetime.utcnow()
+        self.content_type = content_type
+        self.delete_at = None
+
+    def expired(self):
+        return self.delete_at is not None and self.delete_at <= time.time()
+
+    def listing(self, name):
+        return {'name': name, 'bytes': len(self.data), 'hash': self.etag, 'content_type': self.content_type,
+                'last_modified': self.last_modified.strftime('%Y-%m-%dT%H:%M:%S.%f')}
+
+
+class FakeSwift(object):
+    """ The state of the fake cluster and the knobs for injecting latency, bandwidth limits and errors.
+
+        latency is seconds added to every storage request, bandwidth limits object bodies in bytes per second
+        in each direction and error_rate is the fraction of storage requests failed with error_status.
+        fail_next queues errors for the next requests which is more useful in tests than a random rate.
+        Counts of requests by method, connections and tokens issued are kept in stats.
+    """
+    def __init__(self, latency=0.0, bandwidth=None, error_rate=0.0, error_status=503, listing_limit=LISTING_LIMIT,
+                 user='test', key='test', region='region-a', seed=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.listing_limit = listing_limit
+        self.user = user
+        self.key = key
+        self.region = region
+        self.random = random.Random(seed)
+
+        self.containers = {}
+        self.tokens = set()
+        self.connections = set()
+        self.injected = []
+        self.lock = threading.Lock()
+        self.stats = {'connections': 0, 'auths': 0, 'errors': 0}
+        self.server = None
+        self.thread = None
+
+    # Server lifecycle
+
+    def start(self, port=0):
+        """ Start serving on localhost in a daemon thread, port 0 picks a free port. """
+        self.server = _ThreadedHTTPServer(('127.0.0.1', port), _Handler)
+        self.server.fake = self
+        self.thread = threading.Thread(target=self.server.serve_forever, name='fake-swift')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.stopped = True
+            self.server.shutdown()
+            self.server.server_close()
+            # Close keep-alive connections still held by clients so their handler threads finish
+            with self.lock:
+                connections = list(self.connections)
+            for connection in connections:
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+            deadline = time.time() + 5
+            while len(self.connections) > 0 and time.time() < deadline:
+                time.sleep(0.01)
+            self.server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    @property
+    def auth_url(self):
+        """ The keystone v2 url, pass as the url in the config. """
+        return self.base_url + '/v2.0'
+
+    @property
+    def storage_url(self):
+        return '%s/v1/%s' % (self.base_url, ACCOUNT)
+
+    def new_token(self):
+        """ Issue a token, also usable to seed a TokenCache so clients skip keystone. """
+        token = uuid.uuid4().hex
+        with self.lock:
+            self.tokens.add(token)
+            self.stats['auths'] += 1
+        return token
+
+    def expire_tokens(self):
+        with self.lock:
+            self.tokens.clear()
+
+    # Injection
+
+    def fail_next(self, count=1, status=None):
+        """ Fail the next count storage requests with status, by default error_status. """
+        with self.lock:
+            self.injected.extend([status or self.error_status] * count)
+
+    def injected_error(self):
+        with self.lock:
+            if len(self.injected) > 0:
+                status = self.injected.pop(0)
+            elif self.error_rate > 0 and self.random.random() < self.error_rate:
+                status = self.error_status
+            else:
+                return None
+            self.stats['errors'] += 1
+            return status
+
+    def throttle(self, size):
+        if self.bandwidth:
+            time.sleep(float(size) / self.bandwidth)
+
+    # Direct access to the contents
+
+    def put_object(self, container, name, data):
+        with self.lock:
+            self.containers.setdefault(container, {})[name] = FakeObject(data)
+
+    def get_object(self, container, name):
+        return self.containers[container][name].data
+
+    def run_expirer(self):
+        """ Remove objects past their X-Delete-At as the swift object expirer would, until then expired objects
+            are still listed but a GET or HEAD of them is a 404.
+            Returns the number of objects removed.
+        """
+        removed = 0
+        with self.lock:
+            for objects in self.containers.itervalues():
+                for name in [name for name, obj in objects.iteritems() if obj.expired()]:
+                    del objects[name]
+                    removed += 1
+        return removed
+
+    def count(self, method):
+        with self.lock:
+            self.stats[method] = self.stats.get(method, 0) + 1
+
+    def listing(self, names, params):
+        """ Apply the prefix, marker, end_marker, delimiter and limit listing params to a sorted list of names.
+            Returns the names and the subdir entries from the delimiter in listing order.
+        """
+        prefix = params.get('prefix', '')
+        marker = params.get('marker', '')
+        end_marker = params.get('end_marker')
+        delimiter = params.get('delimiter')
+        limit = min(int(params.get('limit', self.listing_limit)), self.listing_limit)
+
+        results = []
+        for name in names:
+            if not name.startswith(prefix) or name <= marker:
+                continue
+            if end_marker is not None and name >= end_marker:
+                break
+            if delimiter:
+                index = name.find(delimiter, len(prefix))
+                if index != -1:
+                    subdir = name[:index + len(delimiter)]
+                    if subdir > marker and (len(results) == 0 or results[-1] != (subdir, True)):
+                        results.append((subdir, True))
+                    if len(results) >= limit:
+                        break
+                    continue
+            results.append((name, False))
+            if len(results) >= limit:
+                break
+        return results
+
+
+class _ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    stopped = False
+
+    def handle_error(self, request, client_address):
+        # Clients may hold keep-alive connections past shutdown, their handlers failing then is expected, as is a
+        # client dropping a connection part way, for example a reader closed before the end of an object
+        error = sys.exc_info()[1]
+        if self.stopped or (isinstance(error, socket.error) and error.errno in (errno.ECONNRESET, errno.EPIPE)):
+            return
+        HTTPServer.handle_error(self, request, client_address)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive so connection reuse by the client can be measured
+    wbufsize = -1  # Buffer responses, written line by line they interact badly with delayed acks
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server.fake.count('connections')
+        with self.server.fake.lock:
+            self.server.fake.connections.add(self.connection)
+
+    def finish(self):
+        try:
+            BaseHTTPRequestHandler.finish(self)
+        finally:
+            with self.server.fake.lock:
+                self.server.fake.connections.discard(self.connection)
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def fake(self):
+        return self.server.fake
+
+    def read_body(self):
+        """ Read the request body, either by content length or chunked transfer encoding. """
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(';')[0].strip(), 16)
+                if size == 0:
+                    while self.rfile.readline().strip():  # trailers
+                        pass
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            body = ''.join(chunks)
+        else:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.fake.throttle(len(body))
+        return body
+
+    def respond(self, status, body='', headers=None, send_body=True):
+        self.send_response(status)
+        headers = headers or {}
+        headers.setdefault('Content-Type', 'text/plain; charset=utf-8')
+        headers['Content-Length'] = str(len(body))
+        headers['X-Trans-Id'] = uuid.uuid4().hex
+        for name, value in headers.iteritems():
+            self.send_header(name, value)
+        self.end_headers()
+        if send_body and len(body) > 0:
+            self.fake.throttle(len(body))
+            self.wfile.write(body)
+        self.wfile.flush()
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_HEAD(self):
+        self.handle_request('HEAD')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+    def handle_request(self, method):
+        url = urlparse.urlparse(self.path)
+        params = dict(urlparse.parse_qsl(url.query, keep_blank_values=True))
+        parts = [urllib.unquote(part) for part in url.path.lstrip('/').split('/', 3)]
+
+        if parts[0] == 'v2.0':
+            return self.keystone_auth()
+        elif parts[0] == 'auth':
+            return self.v1_auth()
+        elif parts[0] != 'v1' or len(parts) < 2 or parts[1] != ACCOUNT:
+            return self.respond(404, 'Not Found')
+
+        self.fake.count(method)
+        if self.headers.get('X-Auth-Token') not in self.fake.tokens:
+            self.read_body()
+            return self.respond(401, 'Unauthorized')
+        if self.fake.latency:
+            time.sleep(self.fake.latency)
+        status = self.fake.injected_error()
+        if status is not None:
+            self.read_body()
+            return self.respond(status, 'Injected error')
+
+        container = parts[2] if len(parts) > 2 and parts[2] else None
+        name = parts[3] if len(parts) > 3 and parts[3] else None
+        if container is None:
+            if method == 'POST' and 'bulk-delete' in params:
+                return self.bulk_delete()
+            return self.account(method, params)
+        elif name is None:
+            return self.container(method, container, params)
+        return self.object(method, container, name)
+
+    def keystone_auth(self):
+        body = json.loads(self.read_body() or '{}')
+        credentials = body.get('auth', {}).get('passwordCredentials', {})
+        if credentials.get('username') != self.fake.user or credentials.get('password') != self.fake.key:
+            return self.respond(401, 'Unauthorized')
+        token = self.fake.new_token()
+        endpoint = {'region': self.fake.region, 'publicURL': self.fake.storage_url,
+                    'internalURL': self.fake.storage_url, 'adminURL': self.fake.storage_url}
+        access = {'access': {
+            'token': {'id': token, 'expires': '2099-01-01T00:00:00Z',
+                      'tenant': {'id': ACCOUNT, 'name': body['auth'].get('tenantName', 'test')}},
+            'serviceCatalog': [{'type': 'object-store', 'name': 'swift', 'endpoints': [endpoint]}],
+            'user': {'id': self.fake.user, 'name': self.fake.user}}}
+        self.respond(200, json.dumps(access), {'Content-Type': 'application/json'})
+
+    def v1_auth(self):
+        if self.headers.get('X-Auth-User', '').split(':')[-1] != self.fake.user or \
+                self.headers.get('X-Auth-Key') != self.fake.key:
+            return self.respond(401, 'Unauthorized')
+        token = self.fake.new_token()
+        self.respond(200, headers={'X-Storage-Url': self.fake.storage_url, 'X-Auth-Token': token,
+                                   'X-Storage-Token': token})
+
+    def send_listing(self, results, params, send_body, entry):
+        # As with swift an empty json listing is still a 200 with [], a plain one a 204
+        if params.get('format') == 'json':
+            body = json.dumps([entry(name, subdir) for name, subdir in results])
+            status = 200
+            content_type = 'application/json; charset=utf-8'
+        else:
+            body = ''.join(name + '\n' for name, subdir in results)
+            status = 200 if len(results) > 0 else 204
+            content_type = 'text/plain; charset=utf-8'
+        self.respond(status, body, {'Content-Type': content_type}, send_body)
+
+    def account(self, method, params):
+        if method not in ('GET', 'HEAD'):
+            return self.respond(405, 'Method Not Allowed')
+        with self.fake.lock:
+            containers = dict((name, (len(objects), sum(len(obj.data) for obj in objects.itervalues())))
+                              for name, objects in self.fake.containers.iteritems())
+        results = self.fake.listing(sorted(containers), params)
+
+        def entry(name, subdir):
+            if subdir:
+                return {'subdir': name}
+            return {'name': name, 'count': containers[name][0], 'bytes': containers[name][1]}
+
+        self.send_listing(results, params, method == 'GET', entry)
+
+    def container(self, method, container, params):
+        with self.fake.lock:
+            objects = self.fake.containers.get(container)
+            if method == 'PUT':
+                created = objects is None
+                if created:
+                    self.fake.containers[container] = {}
+            elif method == 'DELETE' and objects is not None and len(objects) == 0:
+                del self.fake.containers[container]
+            elif objects is not None:
+                objects = dict(objects)
+        if method == 'PUT':
+            self.read_body()
+            return self.respond(201 if created else 202)
+        if objects is None:
+            return self.respond(404, 'Not Found')
+        if method == 'DELETE':
+            return self.respond(409 if len(objects) > 0 else 204)
+        if method not in ('GET', 'HEAD'):
+            return self.respond(405, 'Method Not Allowed')
+
+        results = self.fake.listing(sorted(objects), params)
+
+        def entry(name, subdir):
+            if subdir:
+                return {'subdir': name}
+            return objects[name].listing(name)
+
+        self.send_listing(results, params, method == 'GET', entry)
+
+    def object(self, method, container, name):
+        if method == 'PUT':
+            data = self.read_body()
+            if container not in self.fake.containers:
+                return self.respond(404, 'Not Found')
+            new = FakeObject(data, self.headers.get('Content-Type', 'application/octet-stream'))
+            if self.headers.get('ETag', new.etag).strip('"') != new.etag:
+                return self.respond(422, 'Unprocessable Entity')
+            with self.fake.lock:
+                self.fake.containers[container][name] = new
+            return self.respond(201, headers={'Etag': new.etag})
+
+        with self.fake.lock:
+            objects = self.fake.containers.get(container, {})
+            obj = objects.pop(name, None) if method == 'DELETE' else objects.get(name)
+        if obj is None or (method != 'DELETE' and obj.expired()):
+            return self.respond(404, 'Not Found')
+        if method == 'DELETE':
+            return self.respond(204)
+        if method == 'POST':
+            return self.post_object(obj)
+        if method not in ('GET', 'HEAD'):
+            return self.respond(405, 'Method Not Allowed')
+        headers = {'Etag': obj.etag, 'Content-Type': obj.content_type,
+                   'Last-Modified': obj.last_modified.strftime('%a, %d %b %Y %H:%M:%S GMT')}
+        if obj.delete_at is not None:
+            headers['X-Delete-At'] = str(obj.delete_at)
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if match is not None:  # A single range, open ended or not
+            start = int(match.group(1))
+            end = len(obj.data) - 1
+            if match.group(2) != '':
+                end = min(int(match.group(2)), end)
+            if start > end:
+                return self.respond(416, 'Requested Range Not Satisfiable')
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, len(obj.data))
+            return self.respond(206, obj.data[start:end + 1], headers, method == 'GET')
+        self.respond(200, obj.data, headers, method == 'GET')
+
+    def post_object(self, obj):
+        """ Update the object metadata, only the expiry headers are kept. """
+        self.read_body()
+        if 'X-Remove-Delete-At' in self.headers:
+            obj.delete_at = None
+        elif 'X-Delete-At' in self.headers:
+            try:
+                delete_at = int(self.headers['X-Delete-At'])
+            except ValueError:
+                return self.respond(400, 'Non-integer X-Delete-At')
+            if delete_at <= time.time():
+                return self.respond(400, 'X-Delete-At in past')
+            obj.delete_at = delete_at
+        self.respond(202)
+
+    def bulk_delete(self):
+        """ The bulk middleware delete, the body is a newline separated list of url encoded container/object paths.
+        """
+        deleted = not_found = 0
+        errors = []
+        for line in self.read_body().splitlines():
+            path = urllib.unquote(line.strip()).lstrip('/')
+            if len(path) == 0:
+                continue
+            container, _, name = path.partition('/')
+            with self.fake.lock:
+                objects = self.fake.containers.get(container)
+                if objects is None:
+                    not_found += 1
+                elif len(name) == 0:
+                    if len(objects) > 0:
+                        errors.append([path, '409 Conflict'])
+                    else:
+                        del self.fake.containers[container]
+                        deleted += 1
+                elif objects.pop(name, None) is None:
+                    not_found += 1
+                else:
+                    deleted += 1
+        result = {'Number Deleted': deleted, 'Number Not Found': not_found, 'Errors': errors,
+                  'Response Status': '400 Bad Request' if len(errors) > 0 else '200 OK', 'Response Body': ''}
+        self.respond(200, json.dumps(result), {'Content-Type': 'application/json'})
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve a fake swift cluster for manual testing.')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to each storage request')
+    parser.add_argument('--bandwidth', type=int, help='Bytes per second for object bodies')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of storage requests to fail')
+    args = parser.parse_args(argv)
+
+    fake = FakeSwift(latency=args.latency, bandwidth=args.bandwidth, error_rate=args.error_rate).start(args.port)
+    print 'Serving fake swift, auth url %s user/key %s/%s' % (fake.auth_url, fake.user, fake.key)
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,311 @@
+""" Benchmarks of the metadata, diff, pickle, retention and upload paths against synthetic trees.
+    Run with `python -m benchmarks.run`, results are written as json and each benchmark's time per file is checked
+    against the thresholds in benchmarks/thresholds.json and optionally a previous results file.
+
+Copyright 2014 Hewlett-Packard Development Company, L.P.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software 
+and associated documentation files (the "Software"), to deal in the Software without restriction, 
+including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, 
+and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, 
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or 
+substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, 
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR 
+PURPOSE AND NONINFRINGEMENT.
+
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR 
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF 
+OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+import argparse
+from datetime import datetime, timedelta
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from vertica_backup.directory_metadata import DirectoryMetadata, FileMetadata
+from vertica_backup.object_store.fs import FSStore
+from vertica_backup.object_store.swift import SwiftStore
+from vertica_backup.object_store.swift_pool import ConnectionPool, TokenCache
+from vertica_backup.retry import RetryPolicy
+from vertica_backup import sync
+from vertica_backup.walker import walk_files, WALKER
+
+from benchmarks.fake_swift import FakeSwift
+from benchmarks.tree import churn_tree, generate_tree
+
+THRESHOLDS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'thresholds.json')
+
+benchmarks = []
+
+
+def benchmark(func):
+    """ Register a benchmark, a function taking the context dict and returning the number of files it handled or
+        None if it was skipped.
+    """
+    benchmarks.append(func)
+    return func
+
+
+def requires(*names):
+    """ Note the benchmarks which must run first to set up the state in the context this one uses. """
+    def wrap(func):
+        func.requires = names
+        return func
+    return wrap
+
+
+def selected(only):
+    """ Return the benchmarks to run for the names in only, with those they require, in the order registered. """
+    by_name = dict((func.__name__, func) for func in benchmarks)
+    needed = set()
+    pending = list(only)
+    while len(pending) > 0:
+        name = pending.pop()
+        if name not in needed:
+            needed.add(name)
+            pending.extend(getattr(by_name[name], 'requires', ()))
+    return [func for func in benchmarks if func.__name__ in needed]
+
+
+@benchmark
+def metadata_cold(context):
+    """ FSStore.get_metadata with no previous pickle, every file is hashed. """
+    context['current'] = DirectoryMetadata(context['source'], datetime.today())
+    return len(context['current'].metadata)
+
+
+@benchmark
+def walk_os(context):
+    """ The os.walk and os.stat listing get_metadata used before the walker, for comparison. """
+    count = 0
+    base_dir = context['source'].base_dir
+    for dirpath, dirnames, filenames in os.walk(context['source'].prefix_dir):
+        for fname in filenames:
+            path = os.path.join(dirpath, fname)
+            path.split(base_dir, 1)[1]
+            os.stat(path)
+            count += 1
+    return count
+
+
+@benchmark
+def walk_serial(context):
+    """ The scandir walker in a single thread, the listing part of get_metadata. """
+    source = context['source']
+    return sum(1 for item in walk_files(source.prefix_dir, source.prefix_dir[len(source.base_dir):], threads=1))
+
+
+@benchmark
+def walk_parallel(context):
+    """ The scandir walker with its default threads. """
+    source = context['source']
+    return sum(1 for item in walk_files(source.prefix_dir, source.prefix_dir[len(source.base_dir):]))
+
+
+@benchmark
+@requires('metadata_cold')
+def metadata_warm(context):
+    """ FSStore.get_metadata with a previous pickle so hashes come from the cache. """
+    context['current'].save(context['source'])
+    return len(DirectoryMetadata(context['source']).metadata)
+
+
+@benchmark
+@requires('metadata_cold')
+def diff(context):
+    """ DirectoryMetadata.diff between today's tree and yesterday's. """
+    context['yesterday'].diff(context['current'])
+    return len(context['current'].metadata)
+
+
+@benchmark
+@requires('metadata_cold')
+def pickle_save(context):
+    context['current'].save(context['pickles'])
+    return len(context['current'].metadata)
+
+
+@benchmark
+@requires('pickle_save')
+def pickle_load(context):
+    DirectoryMetadata.load_pickle(context['pickles'])
+    return len(context['current'].metadata)
+
+
+@benchmark
+def retention_merge(context):
+    """ Combining retained pickles as the retention phase does, one pickle per day of churn. """
+    combined = DirectoryMetadata()
+    count = 0
+    for pickle in context['retained'].list_pickles():
+        pickle_metadata = DirectoryMetadata.load_pickle(context['retained'], pickle)
+        combined.metadata.update(pickle_metadata.metadata)
+        count += len(pickle_metadata.metadata)
+    return count
+
+
+@benchmark
+@requires('metadata_cold')
+def upload_fsstore(context):
+    """ A full backup_to_stores run into an empty FSStore. """
+    target = FSStore(os.path.join(context['work_dir'], 'target'), context['prefix_dir'])
+    sync.backup_to_stores(context['current'], [(target, 7)], context['source_dir'])
+    return len(context['current'].metadata)
+
+
+@benchmark
+@requires('metadata_cold')
+def upload_swift(context):
+    """ A full backup_to_stores run into the fake swift server, exercising the connection pool and retries. """
+    if 'swift' not in context:
+        return None
+    sync.backup_to_stores(context['current'], [(context['swift'], 7)], context['source_dir'])
+    return len(context['current'].metadata)
+
+
+@benchmark
+@requires('metadata_cold')
+def pickle_swift(context):
+    """ Saving and loading the pickle through SwiftStore.open against the fake swift server. """
+    if 'swift' not in context:
+        return None
+    context['current'].save(context['swift'])
+    return len(DirectoryMetadata.load_pickle(context['swift']).metadata)
+
+
+@benchmark
+@requires('upload_swift')
+def listing_swift(context):
+    """ SwiftStore.get_metadata of everything uploaded to the fake swift server. """
+    if 'swift' not in context:
+        return None
+    return len(context['swift'].get_metadata())
+
+
+def swift_store(fake, work_dir, prefix_dir):
+    """ Return a SwiftStore for the fake server, seeding a token cache so keystone is not needed. """
+    token_cache = TokenCache(os.path.join(work_dir, 'tokens.json'))
+    pool = ConnectionPool(fake.auth_url, fake.user, fake.key, 'bench', fake.region, token_cache)
+    token_cache.put(pool.cache_key, fake.storage_url, fake.new_token())
+    return SwiftStore(fake.key, fake.region, 'bench', fake.auth_url, fake.user, prefix_dir, domain='bench',
+                      hostname='host1', retry_policy=RetryPolicy(base_delay=0.01), pool=pool)
+
+
+def setup(work_dir, files, retain, sparse):
+    """ Build the trees and stores the benchmarks use. """
+    context = {'work_dir': work_dir}
+    source_dir = os.path.join(work_dir, 'source')
+    context['source_dir'] = source_dir
+    context['prefix_dir'] = generate_tree(source_dir, files=files, sparse=sparse)
+    context['source'] = FSStore(source_dir, context['prefix_dir'])
+    context['yesterday'] = DirectoryMetadata(context['source'], datetime.today() - timedelta(days=1))
+    churn_tree(source_dir, context['prefix_dir'], sparse=sparse)
+
+    for name in ('pickles', 'retained', 'target'):
+        os.makedirs(os.path.join(work_dir, name))
+    context['pickles'] = FSStore(os.path.join(work_dir, 'pickles'), context['prefix_dir'])
+
+    # Retained pickles for retention, each day a small fraction of files are replaced
+    context['retained'] = FSStore(os.path.join(work_dir, 'retained'), context['prefix_dir'])
+    day_metadata = dict(context['yesterday'].metadata)
+    for day in range(retain):
+        day_pickle = DirectoryMetadata(date=datetime.today() - timedelta(days=day + 2))
+        for index, path in enumerate(sorted(day_metadata)[:len(day_metadata) // 20]):
+            old = day_metadata.pop(path)
+            new_path = '%s.%d' % (path, day)
+            day_metadata[new_path] = FileMetadata(new_path, old.bytes, old.mtime, old.hash)
+        day_pickle.metadata = dict(day_metadata)
+        day_pickle.save(context['retained'])
+    return context
+
+
+def check(results, thresholds, baseline=None, tolerance=0.25):
+    """ Return a list of regressions, benchmarks slower than their threshold or the baseline plus tolerance. """
+    regressions = []
+    for name, result in sorted(results.iteritems()):
+        limit = thresholds.get(name)
+        if limit is not None and result['us_per_file'] > limit:
+            regressions.append('%s took %.1fus per file, threshold %.1fus' % (name, result['us_per_file'], limit))
+        if baseline is not None and name in baseline:
+            previous = baseline[name]['us_per_file']
+            if result['us_per_file'] > previous * (1 + tolerance):
+                regressions.append('%s took %.1fus per file, baseline %.1fus' % (name, result['us_per_file'], previous))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the vertica_backup benchmarks.')
+    parser.add_argument('--files', type=int, default=20000, help='Number of files in the synthetic tree')
+    parser.add_argument('--retain', type=int, default=7, help='Number of pickles for the retention benchmark')
+    parser.add_argument('--dense', action='store_true', help='Write random data rather than sparse files')
+    parser.add_argument('--work-dir', help='Directory for the trees, a temporary directory by default')
+    parser.add_argument('--output', default='bench_results.json', help='Where to write the json results')
+    parser.add_argument('--baseline', help='A previous results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed slowdown relative to the baseline')
+    parser.add_argument('--swift', action='store_true', help='Also run the benchmarks against a fake swift server')
+    parser.add_argument('--swift-latency', type=float, default=0.0, help='Seconds of latency per swift request')
+    parser.add_argument('--swift-error-rate', type=float, default=0.0, help='Fraction of swift requests to fail')
+    parser.add_argument('--only', action='append', help='Run only the named benchmark, may be repeated')
+    args = parser.parse_args(argv)
+    unknown = set(args.only or ()) - set(func.__name__ for func in benchmarks)
+    if len(unknown) > 0:
+        parser.error('Unknown benchmarks %s, choose from %s' %
+                     (', '.join(sorted(unknown)), ', '.join(func.__name__ for func in benchmarks)))
+
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.WARNING)
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='vertica_backup_bench')
+    fake = None
+    try:
+        print 'Generating a %d file tree in %s, walking with %s' % (args.files, work_dir, WALKER)
+        context = setup(work_dir, args.files, args.retain, not args.dense)
+        if args.swift:
+            fake = FakeSwift(latency=args.swift_latency, error_rate=args.swift_error_rate, seed=0).start()
+            context['swift'] = swift_store(fake, work_dir, context['prefix_dir'])
+
+        results = {}
+        for func in selected(args.only) if args.only else benchmarks:
+            start = time.time()
+            count = func(context)
+            seconds = time.time() - start
+            if count is None or (args.only and func.__name__ not in args.only):
+                continue  # Skipped or only run to set up a benchmark which was asked for
+            results[func.__name__] = {'seconds': seconds, 'files': count,
+                                      'us_per_file': seconds * 1e6 / count if count else 0.0}
+            print '%-20s %8.3f seconds %10d files %10.1f us/file' % (func.__name__, seconds, count,
+                                                                    results[func.__name__]['us_per_file'])
+        if fake is not None:
+            print 'Fake swift stats: %s' % json.dumps(fake.stats, sort_keys=True)
+    finally:
+        if fake is not None:
+            fake.stop()
+        if args.work_dir is None:
+            shutil.rmtree(work_dir)
+
+    with open(THRESHOLDS) as thresholds_file:
+        thresholds = json.load(thresholds_file)
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+
+    regressions = check(results, thresholds, baseline, args.tolerance)
+    with open(args.output, 'w') as output:
+        json.dump({'files': args.files, 'time': time.time(), 'results': results, 'regressions': regressions},
+                  output, indent=2, sort_keys=True)
+
+    for regression in regressions:
+        print 'REGRESSION: ' + regression
+    return 1 if len(regressions) > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,110 @@
+""" Generate synthetic Vertica shaped backup trees for benchmarking.
+    The layout follows a vbr hard link backup, backup_dir/v_<db>_node####/<snapshot>/ holding the node's data
+    directories with ROS files spread over 3 digit subdirectories, the catalog snapshot and the snapshot
+    .txt/.info files.
+
+Copyright 2014 Hewlett-Packard Development Company, L.P.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software 
+and associated documentation files (the "Software"), to deal in the Software without restriction, 
+including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, 
+and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, 
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or 
+substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, 
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR 
+PURPOSE AND NONINFRINGEMENT.
+
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR 
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF 
+OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+import argparse
+import os
+import random
+import sys
+
+
+def ros_size(rng, median, sigma, max_size):
+    """ A ROS data file size from a lognormal distribution, most are small with a long tail of large ones. """
+    return min(int(rng.lognormvariate(0, sigma) * median), max_size)
+
+
+def generate_tree(backup_dir, dbname='bench', snapshot='bench_snap', node=1, files=10000, fan_out=1000,
+                  median_size=65536, sigma=2.0, max_size=2 ** 30, sparse=True, seed=0):
+    """ Create a synthetic node backup under backup_dir returning the prefix_dir, <vnode>/<snapshot>.
+        Files are created in .fdb/.pidx pairs, sparse files are created by truncating to the size so large trees
+        take little disk space but still have to be read in full to hash them.
+    """
+    rng = random.Random(seed)
+    vnode = 'v_%s_node%04d' % (dbname, node)
+    prefix_dir = os.path.join(vnode, snapshot)
+    snapshot_dir = os.path.join(backup_dir, prefix_dir)
+    data_dir = os.path.join(snapshot_dir, 'var', 'vertica', 'data', dbname, vnode + '_data')
+    catalog_dir = os.path.join(snapshot_dir, 'var', 'vertica', 'catalog', dbname, vnode + '_catalog', 'Snapshots')
+
+    def write(path, size):
+        parent = os.path.dirname(path)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        with open(path, 'wb') as afile:
+            if sparse:
+                afile.truncate(size)
+            else:
+                afile.write(os.urandom(size))
+
+    for index in range(files // 2):
+        sid = '%018x%022x' % (rng.getrandbits(72), index)
+        subdir = os.path.join(data_dir, '%03d' % (index % fan_out))
+        write(os.path.join(subdir, sid + '_0.fdb'), ros_size(rng, median_size, sigma, max_size))
+        write(os.path.join(subdir, sid + '_0.pidx'), rng.randint(64, 4096))
+
+    write(os.path.join(catalog_dir, 'catalog.ctlg'), 1024 * 1024)
+    write(os.path.join(snapshot_dir, snapshot + '.txt'), 4096)
+    write(os.path.join(snapshot_dir, snapshot + '.info'), 512)
+    return prefix_dir
+
+
+def churn_tree(backup_dir, prefix_dir, fraction=0.05, seed=1, sparse=True, median_size=65536, sigma=2.0,
+               max_size=2 ** 30):
+    """ Simulate a day of mergeouts, replacing fraction of the ROS files with new uniquely named ones.
+        Returns the number of files replaced.
+    """
+    rng = random.Random(seed)
+    data_files = []
+    for dirpath, dirnames, filenames in os.walk(os.path.join(backup_dir, prefix_dir)):
+        data_files.extend(os.path.join(dirpath, fname) for fname in filenames if fname.endswith('.fdb'))
+    replaced = rng.sample(data_files, int(len(data_files) * fraction))
+    for path in replaced:
+        os.remove(path)
+        new_path = os.path.join(os.path.dirname(path), '%040x_0.fdb' % rng.getrandbits(160))
+        with open(new_path, 'wb') as afile:
+            size = ros_size(rng, median_size, sigma, max_size)
+            if sparse:
+                afile.truncate(size)
+            else:
+                afile.write(os.urandom(size))
+    return len(replaced)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate a synthetic Vertica node backup tree.')
+    parser.add_argument('backup_dir')
+    parser.add_argument('--files', type=int, default=10000, help='Number of files in the tree')
+    parser.add_argument('--nodes', type=int, default=1, help='Number of nodes to generate')
+    parser.add_argument('--fan-out', type=int, default=1000, help='Number of data subdirectories')
+    parser.add_argument('--median-size', type=int, default=65536, help='Median ROS file size in bytes')
+    parser.add_argument('--sigma', type=float, default=2.0, help='Spread of the lognormal file size distribution')
+    parser.add_argument('--dense', action='store_true', help='Write random data rather than sparse files')
+    args = parser.parse_args(argv)
+
+    for node in range(1, args.nodes + 1):
+        print generate_tree(args.backup_dir, node=node, files=args.files, fan_out=args.fan_out,
+                            median_size=args.median_size, sigma=args.sigma, sparse=not args.dense, seed=node)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -20,21 +20,26 @@ OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FR
 OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 """
+import json
 import os
+import pipes
 import socket
 import tempfile
 
 from fabric.api import *
 from fabric.colors import *
 
+from vertica_backup.restore_cluster import ClusterRestore, DAY, NodeDownload
+
 # todo setup detection of backup_dir, data_dir and catalog_dir from the the config files and remove references to /var/vertica, update readme
 
 
 @task
 @runs_once
-def restore(dbname=None, restore_domain=None):
+def restore(dbname=None, restore_domain=None, bandwidth=None):
     """ The master task that calls all the sub tasks walking through the entire process from download to restore to restoration of the previous db.
         Run this with the name of one node in the run list, other nodes will be discovered from there.
+        bandwidth optionally limits the download to that many bytes per second for the whole cluster.
     """
     env.abort_on_prompts = False
     env.warn_only = False
@@ -65,8 +70,8 @@ def restore(dbname=None, restore_domain=None):
     execute(set_active_backup, suffix=restore_domain)
     # First download the db this will take awhile, so can be skipped when not needed
     if prompt('Skip Download? [y/n] ') != 'y':
-        day = prompt('Please specify YYYY_MM_DD of the backup you would like to restore:')
-        execute(download_backup, restore_domain, dbname, day=day)
+        day = prompt('Please specify YYYY_MM_DD of the backup you would like to restore:', validate=DAY.pattern)
+        cluster_download(restore_domain, dbname, day, cluster_nodes, None if bandwidth is None else int(bandwidth))
 
     # Switch to the new
     prompt(magenta('Ready to disable the running db and switch to the restored db, press enter to continue.'))
@@ -93,24 +98,97 @@ def restore(dbname=None, restore_domain=None):
         execute(start_db, dbname, hosts=primary_node)
 
 
+class FabricNodeDownload(NodeDownload):
+    """ A node download run with fabric's sudo, so the user, password and sudo prefix of the fabric env are used.
+        The download runs in the background on the node and writes its exit status beside its progress file, the
+        restore polls both and copies the node's output into the local log when it finishes.
+    """
+    def remote_sudo(self, command):
+        with settings(hide('everything'), host_string=self.host, warn_only=True):
+            return sudo(command, pty=False)
+
+    def prepare(self):
+        if self.work_dir is not None:
+            return
+        work_dir = self.remote_sudo('mktemp -d -t vertica_restore.XXXXXX')
+        if work_dir.failed:
+            abort('Unable to make a directory for the download progress on %s' % self.host)
+        self.work_dir = work_dir.strip()
+        self.progress_path = os.path.join(self.work_dir, 'restore_progress.json')
+
+    def set_bandwidth(self, share):
+        path = pipes.quote(self.bandwidth_path)
+        if self.remote_sudo('echo %d > %s.new && mv %s.new %s' % (share, path, path, path)).failed:
+            abort('Unable to set the bandwidth of the download on %s' % self.host)
+        self.share = share
+
+    def start(self, command):
+        self.attempts += 1
+        self.state = 'running'
+        self.progress = {}
+        exit_path = os.path.join(self.work_dir, 'exit_status')
+        script = '%s > %s 2>&1; echo $? > %s' % (' '.join(pipes.quote(arg) for arg in command),
+                                                 os.path.join(self.work_dir, 'output'), exit_path)
+        self.remote_sudo('rm -f %s; nohup sh -c %s > /dev/null 2>&1 < /dev/null &' % (exit_path, pipes.quote(script)))
+        puts('Started download to %s (%s), attempt %d' % (self.host, self.vnode, self.attempts))
+
+    def poll(self):
+        if self.state != 'running':
+            return None
+        exit_status = self.remote_sudo('cat %s' % os.path.join(self.work_dir, 'exit_status'))
+        if exit_status.failed or exit_status.strip() == '':
+            return None
+        with open(self.log_path, 'a') as log_file:
+            log_file.write(self.remote_sudo('cat %s' % os.path.join(self.work_dir, 'output')) + '\n')
+        returncode = int(exit_status.strip())
+        self.state = 'done' if returncode == 0 else 'failed'
+        return returncode
+
+    def fetch_progress(self):
+        progress = self.remote_sudo('cat %s' % self.progress_path)
+        if progress.succeeded:
+            try:
+                self.progress = json.loads(progress)
+            except ValueError:
+                pass
+
+    def cleanup(self):
+        if self.work_dir is not None:
+            self.remote_sudo('rm -rf %s' % self.work_dir)
+            self.work_dir = None
+
+
+class FabricClusterRestore(ClusterRestore):
+    """ Restores with the node downloads run through fabric rather than plain ssh. """
+    def make_node(self, host, vnode, log_dir):
+        return FabricNodeDownload(host, vnode, log_dir)
+
+
+def cluster_download(domain, dbname, day, cluster_nodes, bandwidth=None):
+    """ Download a Vertica backup from swift to all nodes in parallel, showing the combined progress and retrying
+        failed nodes. The downloads run in the background on the nodes and are watched with fabric's sudo.
+        bandwidth is the total bytes per second shared by the nodes still downloading.
+    """
+    nodes = [(ip, vnode) for vnode, ip in sorted(cluster_nodes.iteritems())]
+    restore = FabricClusterRestore(nodes, '/opt/vertica/config/%s_backup.yaml' % dbname, domain, day,
+                                   snapshot_name=domain.replace('.', '_') + '_' + dbname, bandwidth=bandwidth)
+    if restore.run() != 0:
+        abort('The download failed on some nodes, see the restore_<host>.log files.')
+
+
 @task
 @parallel
 def download_backup(domain, dbname, day=''):
-    """ Download a Vertica backup from swift.
+    """ Download a Vertica backup from swift to a single node.
     """
     with settings(hide('running', 'output')):
-        # set the snapshot name in dbname_backup.yaml
-        sudo('cp /opt/vertica/config/%s_backup.yaml /opt/vertica/config/%s_backup.yaml-backup' % (dbname, dbname))
-        sudo(
-            "sed 's/^snapshot_name:.*/snapshot_name: %s/' /opt/vertica/config/%s_backup.yaml-backup > /opt/vertica/config/%s_backup.yaml" %
-            (domain.replace('.', '_') + '_' + dbname, dbname, dbname)
-        )
-
         # todo this assumes you are downloading to a cluster with an existing db
         data_v_node = sudo('ls /var/vertica/data/%s' % dbname)
         v_node = data_v_node[:data_v_node.index('_data')]
 
-    sudo('vertica_restore_download /opt/vertica/config/%s_backup.yaml %s %s %s' % (dbname, domain, v_node, day))
+    # The snapshot name is overridden for this run rather than editing the config
+    sudo('vertica_restore_download --set snapshot_name=%s /opt/vertica/config/%s_backup.yaml %s %s %s' %
+         (domain.replace('.', '_') + '_' + dbname, dbname, domain, v_node, day))
 
 
 @task
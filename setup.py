@@ -16,15 +16,20 @@ setup(
     keywords="vertica swift openstack cloud backup",
     url="https://github.com/tkuhlman/vertica-swift-backup",
     test_suite="nose.collector",
-    install_requires=["setuptools", "python-swiftclient", "python-keystoneclient", "PyYAML"],
-    packages=find_packages(exclude=["tests"]),
+    install_requires=["setuptools", "python-swiftclient", "python-keystoneclient", "PyYAML", "scandir"],
+    packages=find_packages(exclude=["tests", "benchmarks"]),
     include_package_data=True,
     data_files=[('share/vertica-swift-backup/examples', ['backup.yaml-example']),
                 ('share/vertica-swift-backup/restore', ['restore/README.md', 'restore/fabfile.py', 'restore/vertica.py'])],
     entry_points={
         'console_scripts': [
             'vertica_backup = vertica_backup.backup:main',
-            'vertica_restore_download = vertica_backup.restore_download:main'
+            'vertica_restore_download = vertica_backup.restore_download:main',
+            'vertica_profile_report = vertica_backup.profiling:main',
+            'vertica_backup_report = vertica_backup.report:main',
+            'vertica_restore_cluster = vertica_backup.restore_cluster:main',
+            'vertica_verify = vertica_backup.verify:main',
+            'vertica_audit = vertica_backup.audit:main'
         ]
     }
 )
@@ -0,0 +1,240 @@
+""" Tests SwiftStore against the in-process fake swift server
+"""
+from cStringIO import StringIO
+from datetime import datetime
+import hashlib
+import json
+import os
+import shutil
+import socket
+import tempfile
+import time
+
+from benchmarks.fake_swift import FakeSwift
+from vertica_backup.directory_metadata import DirectoryMetadata, FileMetadata
+from vertica_backup.expiry import ExpiryError, ExpiryPolicy
+from vertica_backup.object_store.swift import RangePolicy, SwiftException, SwiftReader, SwiftStore
+from vertica_backup.object_store.swift_pool import ConnectionPool, TokenCache
+from vertica_backup.retry import FailureQueue, RetryPolicy
+
+fake = None
+work_dir = None
+
+
+def setup_module():
+    global fake, work_dir
+    fake = FakeSwift().start()
+    work_dir = tempfile.mkdtemp()
+
+
+def teardown_module():
+    fake.stop()
+    shutil.rmtree(work_dir)
+
+
+def get_store(prefix='v_test_node0001', hostname='host1', read_only=False):
+    """ Return a SwiftStore with a token cache seeded from the fake so keystone is not needed. """
+    token_cache = TokenCache(os.path.join(work_dir, 'tokens.json'))
+    pool = ConnectionPool(fake.auth_url, fake.user, fake.key, 'test', fake.region, token_cache, size=2)
+    token_cache.put(pool.cache_key, fake.storage_url, fake.new_token())
+    return SwiftStore(fake.key, fake.region, 'test', fake.auth_url, fake.user, prefix, domain='example.com',
+                      hostname=hostname, retry_policy=RetryPolicy(base_delay=0), pool=pool, read_only=read_only)
+
+
+def test_read_only():
+    # A missing container is left alone, even with a container whose name it prefixes present
+    fake.put_object('example.com_host20', 'v_test_node0001/file', 'data')
+    store = get_store(hostname='host2', read_only=True)
+    assert not store.exists()
+    assert 'example.com_host2' not in fake.containers
+    assert get_store(hostname='host20', read_only=True).exists()
+
+
+def test_upload_download():
+    store = get_store()
+    assert 'example.com_host1' in fake.containers
+
+    source = os.path.join(work_dir, 'source')
+    os.makedirs(os.path.join(source, 'v_test_node0001', 'data'))
+    with open(os.path.join(source, 'v_test_node0001', 'data', 'file1'), 'w') as data_file:
+        data_file.write('some data')
+    assert store.upload('v_test_node0001/data/file1', source) == 9
+
+    metadata = store.get_metadata()
+    assert metadata.keys() == ['v_test_node0001/data/file1']
+    assert metadata['v_test_node0001/data/file1'].bytes == 9
+    assert store.list_dir() == ['v_test_node0001/']
+    assert store.list_dir('v_test_node0001') == ['v_test_node0001/data/']
+
+    assert store.download('v_test_node0001/data/file1', os.path.join(work_dir, 'dest')) == 9
+    store.delete('v_test_node0001/data/file1')
+    store.delete('v_test_node0001/data/file1')  # A missing object is not an error
+    assert len(store.get_metadata()) == 0
+
+
+def test_retry_and_reuse():
+    store = get_store()
+    connections = fake.stats['connections']
+    fake.fail_next(2)
+    fake.put_object(store.container, 'v_test_node0001/file2', 'more data')
+    assert store.get_metadata()['v_test_node0001/file2'].bytes == 9
+    assert fake.stats['errors'] >= 2
+
+    # Once the failed connections are replaced further requests reuse a pooled connection
+    connections = fake.stats['connections']
+    for i in range(5):
+        store.list_dir()
+    assert fake.stats['connections'] == connections
+
+
+def test_listing_params():
+    names = ['a/1', 'a/2', 'b/1', 'c']
+    assert fake.listing(names, {'delimiter': '/'}) == [('a/', True), ('b/', True), ('c', False)]
+    assert fake.listing(names, {'prefix': 'a/', 'marker': 'a/1'}) == [('a/2', False)]
+    assert fake.listing(names, {'limit': '2'}) == [('a/1', False), ('a/2', False)]
+
+
+def test_domain_index():
+    store = get_store('v_test_node0002/snapshot')
+    store.update_index()
+    # A second snapshot of the same node in its own container has its own entry
+    other = get_store('v_test_node0002/other', hostname='host9')
+    other.update_index()
+    assert sorted(fake.containers['example.com-index'].keys()) == ['v_test_node0002/other',
+                                                                   'v_test_node0002/snapshot']
+
+    gets = fake.stats.get('GET', 0)
+    found = SwiftStore(fake.key, fake.region, 'test', fake.auth_url, fake.user, 'v_test_node0002/snapshot',
+                       domain='example.com', vnode='v_test_node0002', pool=store.pool)
+    assert found.container == 'example.com_host1'
+    assert fake.stats['GET'] - gets == 2  # The index entry and the account listing for the container check
+    assert SwiftStore(fake.key, fake.region, 'test', fake.auth_url, fake.user, 'v_test_node0002/other',
+                      domain='example.com', vnode='v_test_node0002', pool=store.pool).container == 'example.com_host9'
+
+    # An entry by vnode alone, from backups made before snapshots were indexed, is still found
+    fake.put_object('example.com-index', 'v_test_node0005', json.dumps({'vnode': 'v_test_node0005',
+                                                                       'hostname': 'host5', 'container': None}))
+    assert SwiftStore(fake.key, fake.region, 'test', fake.auth_url, fake.user, 'v_test_node0005/snapshot',
+                      domain='example.com', vnode='v_test_node0005', pool=store.pool).hostname == 'host5'
+
+    # Without an index entry the containers are scanned
+    fake.put_object('example.com_host1', 'v_test_node0003/file', 'data')
+    assert SwiftStore(fake.key, fake.region, 'test', fake.auth_url, fake.user, 'v_test_node0003/snapshot',
+                      domain='example.com', vnode='v_test_node0003', pool=store.pool).hostname == 'host1'
+
+
+def test_stat():
+    store = get_store()
+    fake.put_object(store.container, 'v_test_node0001/stat_file', 'stat data')
+    file_metadata = store.stat('v_test_node0001/stat_file')
+    assert (file_metadata.bytes, file_metadata.hash) == (9, fake.containers[store.container]['v_test_node0001/stat_file'].etag)
+    assert store.stat('v_test_node0001/missing') is None
+
+
+def test_expiry():
+    store = get_store('v_test_node0004')
+    for name in ('old', 'kept'):
+        fake.put_object(store.container, 'v_test_node0004/' + name, name)
+    store_metadata = DirectoryMetadata(store)
+    previous = DirectoryMetadata()
+    previous.metadata = dict(store_metadata.metadata)
+    current = DirectoryMetadata()
+    current.metadata = {'v_test_node0004/kept': store_metadata.metadata['v_test_node0004/kept']}
+    policy = ExpiryPolicy(interval=60, threads=2)
+    failures = FailureQueue()
+
+    # Dropped from the backup the object is set to expire after the retained backups
+    expiring = {}
+    assert policy.apply(store, expiring, current, previous, store_metadata, 2, [], failures) == []
+    delete_at = fake.containers[store.container]['v_test_node0004/old'].delete_at
+    assert expiring == {'v_test_node0004/old': delete_at}
+    assert abs(delete_at - (time.time() + 180)) < 5
+
+    # Only objects the store has not been left to expire are deleted by the client
+    to_del = ['v_test_node0004/old', 'v_test_node0004/stray']
+    assert policy.apply(store, expiring, current, current, store_metadata, 2, to_del, failures) == \
+        ['v_test_node0004/stray']
+
+    # Referenced again the expiry is cleared
+    assert policy.apply(store, expiring, previous, current, store_metadata, 2, [], failures) == []
+    assert fake.containers[store.container]['v_test_node0004/old'].delete_at is None
+    assert expiring == {} and len(failures) == 0
+
+    # An object which can't have its expiry cleared may still expire, so the backup can't rely on it
+    fake.put_object(store.container, 'v_test_node0004/gone', 'gone')
+    store_metadata = DirectoryMetadata(store)
+    del fake.containers[store.container]['v_test_node0004/gone']
+    expiring = {'v_test_node0004/gone': int(time.time() + 86400), 'v_test_node0004/old': int(time.time() + 86400)}
+    current.metadata = dict(store_metadata.metadata)
+    try:
+        policy.clear(store, expiring, current)
+        assert False, 'The failed expiry clear was not raised'
+    except ExpiryError:
+        pass
+    assert expiring.keys() == ['v_test_node0004/gone']
+
+    # Past or close to its delete time an object can't be relied on so it is left out of the store metadata
+    policy.remove_expired({'v_test_node0004/old': time.time() + policy.margin - 1}, store_metadata)
+    assert sorted(store_metadata.metadata.keys()) == ['v_test_node0004/gone', 'v_test_node0004/kept']
+
+
+def test_open():
+    store = get_store()
+    data = ''.join(str(i) + '\n' for i in range(100000))
+    with store.open('stream_file', 'w') as stream_file:
+        stream_file.write(data)
+    puts = fake.stats['PUT']
+    with store.open('stream_file', 'r') as stream_file:
+        assert stream_file.readline() == '0\n'
+        assert stream_file.read() == data[2:]
+    assert fake.stats['PUT'] == puts  # Reading does not upload the file again
+
+    # A connection failing part way resumes with a ranged GET from where it got to
+    reader = SwiftReader(store, 'stream_file')
+    chunks = iter(reader)
+    first = next(chunks)
+
+    def broken():
+        raise socket.error('connection reset')
+        yield
+    reader._body = broken()
+    assert first + ''.join(chunks) == data
+
+    with store.open('stream_file', 'a') as stream_file:
+        stream_file.write('appended')
+    assert fake.get_object(store.container, 'stream_file') == data + 'appended'
+
+
+def test_ranged_download():
+    store = get_store()
+    store.ranges = RangePolicy(threshold=1000, range_size=300000, streams=3)
+    data = os.urandom(1000000)
+    store.upload_file('v_test_node0001/data/large', StringIO(data), len(data))
+    file_metadata = FileMetadata('v_test_node0001/data/large', len(data), datetime.today(), hashlib.md5(data).hexdigest())
+    dest = os.path.join(work_dir, 'ranged')
+    local_path = os.path.join(dest, 'v_test_node0001/data/large')
+
+    gets = fake.stats['GET']
+    assert store.download('v_test_node0001/data/large', dest, file_metadata) == len(data)
+    assert fake.stats['GET'] - gets == 4
+    with open(local_path, 'rb') as local_file:
+        assert local_file.read() == data
+    assert not os.path.exists(local_path + '.part.progress')
+
+    # An interrupted download resumes with the ranges it did not finish
+    os.rename(local_path, local_path + '.part')
+    with open(local_path + '.part.progress', 'w') as progress_file:
+        json.dump({'size': len(data), 'hash': file_metadata.hash, 'range_size': 300000, 'done': [0, 600000]},
+                  progress_file)
+    gets = fake.stats['GET']
+    assert store.download('v_test_node0001/data/large', dest, file_metadata) == len(data)
+    assert fake.stats['GET'] - gets == 2
+
+    # A corrupt download is not kept
+    file_metadata.hash = hashlib.md5('other data').hexdigest()
+    try:
+        store.download('v_test_node0001/data/large', dest, file_metadata)
+        assert False, 'The md5 mismatch was not detected'
+    except SwiftException:
+        pass
+    assert not os.path.exists(local_path + '.part') and not os.path.exists(local_path + '.part.progress')
@@ -0,0 +1,70 @@
+""" Tests the domain wide backup audit against the fake swift server
+"""
+from datetime import datetime, timedelta
+import json
+import os
+import shutil
+import tempfile
+
+from benchmarks.fake_swift import FakeSwift
+from vertica_backup.audit import audit_domain, CRITICAL, OK, WARNING
+from vertica_backup.object_store.swift import classify_error
+from vertica_backup.object_store.swift_pool import ConnectionPool, TokenCache
+from vertica_backup.retry import RetryPolicy
+
+
+def pickle_name(date):
+    return date.strftime('%Y_%m_%d_%H%M') + '.pickle'
+
+
+def test_audit_domain():
+    work_dir = tempfile.mkdtemp()
+    fake = FakeSwift().start()
+    try:
+        now = datetime(2014, 6, 10, 12, 0)
+        fresh = now - timedelta(hours=2)
+        for host in ('host1', 'host2', 'host3'):
+            fake.put_object('example.com_' + host, pickle_name(fresh - timedelta(days=1)), 'x' * 1000)
+            fake.put_object('example.com_' + host, pickle_name(fresh), 'x' * 1000)
+            fake.put_object('example.com_' + host, 'v_db_node0001/data/file', 'data')
+        fake.put_object('example.com_host4', pickle_name(now - timedelta(hours=30)), 'x' * 1000)
+        fake.put_object('example.com_host5', pickle_name(fresh), 'x' * 100)
+        fake.containers['example.com_host6'] = {}
+        fake.put_object('other.com_host1', pickle_name(fresh), 'x' * 1000)
+        # A node with a custom container found through the index, and one whose container is gone
+        fake.put_object('custom', pickle_name(fresh), 'x' * 1000)
+        fake.put_object('example.com-index', 'v_db_node0007',
+                        json.dumps({'vnode': 'v_db_node0007', 'hostname': 'host7', 'container': 'custom'}))
+        fake.put_object('example.com-index', 'v_db_node0008',
+                        json.dumps({'vnode': 'v_db_node0008', 'hostname': 'host8', 'container': 'gone'}))
+        # Two snapshots of one node, each in its own container
+        fake.put_object('snap_a', pickle_name(fresh), 'x' * 1000)
+        fake.put_object('snap_b', pickle_name(fresh), 'x' * 1000)
+        for snapshot in ('a', 'b'):
+            fake.put_object('example.com-index', 'v_db_node0009/' + snapshot,
+                            json.dumps({'vnode': 'v_db_node0009', 'snapshot_name': snapshot, 'hostname': 'host9',
+                                        'container': 'snap_' + snapshot}))
+
+        token_cache = TokenCache(os.path.join(work_dir, 'tokens.json'))
+        pool = ConnectionPool(fake.auth_url, fake.user, fake.key, 'test', fake.region, token_cache, size=4)
+        token_cache.put(pool.cache_key, fake.storage_url, fake.new_token())
+        audits = audit_domain(pool, RetryPolicy(1, base_delay=0, classifier=classify_error), 'example.com',
+                              threads=4, now=now)
+
+        results = dict((str(audit), (audit.status(), audit.kinds())) for audit in audits)
+        assert results == {
+            'example.com_host1': (OK, set()),
+            'example.com_host2': (OK, set()),
+            'example.com_host3': (OK, set()),
+            'example.com_host4': (WARNING, set(['stale'])),
+            'example.com_host5': (WARNING, set(['size'])),
+            'example.com_host6': (CRITICAL, set(['missing'])),
+            'v_db_node0007 (custom)': (OK, set()),
+            'v_db_node0008 (gone)': (CRITICAL, set(['missing'])),
+            'v_db_node0009/a (snap_a)': (OK, set()),
+            'v_db_node0009/b (snap_b)': (OK, set()),
+        }
+        assert [audit.age(now) for audit in audits if audit.container == 'example.com_host1'] == [2]
+    finally:
+        fake.stop()
+        shutil.rmtree(work_dir)
@@ -0,0 +1,107 @@
+""" Tests running several snapshots in one backup and the tiered backup drain
+"""
+from datetime import datetime, timedelta
+import os
+import shutil
+import tempfile
+
+from vertica_backup.backup import DRAINED_NAME, shared_roots, snapshot_configs, start_drain, tier_retention
+from vertica_backup.directory_metadata import DirectoryMetadata
+from vertica_backup.metrics import run_metrics
+from vertica_backup.object_store.fs import FSStore
+from vertica_backup import sync
+
+
+def test_snapshot_configs():
+    config = {'backup_dir': '/backup', 'dbname': 'db1', 'snapshot_name': 'west', 'retain': 7,
+              'stores': [{'type': 'fs', 'path': '/mnt/backup'}]}
+    assert snapshot_configs(config) == [config]
+
+    config['snapshots'] = [{'snapshot_name': 'east'},
+                           {'dbname': 'db2', 'backup_dir': '/backup2', 'stores': [{'type': 'fs', 'path': '/mnt/db2'}]}]
+    snapshots = snapshot_configs(config)
+    assert [(snapshot['dbname'], snapshot['snapshot_name'], snapshot['retain']) for snapshot in snapshots] == \
+        [('db1', 'east', 7), ('db2', 'west', 7)]
+    assert shared_roots(snapshots) == []
+
+    # Snapshots with pickles in the same place can't be backed up together
+    config['snapshots'].append({'dbname': 'db3', 'backup_dir': '/backup3'})
+    assert shared_roots(snapshot_configs(config)) == [2]
+
+
+def test_shared_hash_cache():
+    base_dir = tempfile.mkdtemp()
+    try:
+        for snapshot in ('west', 'east'):
+            os.makedirs(os.path.join(base_dir, 'v_db_node0001', snapshot))
+        with open(os.path.join(base_dir, 'v_db_node0001', 'west', 'file'), 'w') as data_file:
+            data_file.write('some data')
+        os.link(os.path.join(base_dir, 'v_db_node0001', 'west', 'file'),
+                os.path.join(base_dir, 'v_db_node0001', 'east', 'file'))
+
+        hash_cache = {}
+        west = FSStore(base_dir, 'v_db_node0001/west', hash_cache=hash_cache).get_metadata()
+        east = FSStore(base_dir, 'v_db_node0001/east', hash_files=False, hash_cache=hash_cache).get_metadata()
+        assert east['v_db_node0001/east/file'].hash == west['v_db_node0001/west/file'].hash
+    finally:
+        shutil.rmtree(base_dir)
+
+
+def tier_backup(config, source, date, number):
+    """ Replace the snapshot's data with a new file and back it up to the tier as retention allows. """
+    snapshot_dir = os.path.join(source, 'v_node0001', 'snap')
+    if os.path.exists(snapshot_dir):
+        shutil.rmtree(snapshot_dir)
+    os.makedirs(snapshot_dir)
+    with open(os.path.join(snapshot_dir, 'file%d' % number), 'w') as data_file:
+        data_file.write('backup %d' % number)
+
+    tier_store = FSStore(config['tier_dir'], 'v_node0001/snap')
+    retain, undrained = tier_retention(config, tier_store)
+    current_metadata = DirectoryMetadata(FSStore(source, 'v_node0001/snap'), date)
+    assert sync.backup_to_stores(current_metadata, [(tier_store, retain)], source) == [(0, [])]
+    return undrained
+
+
+def test_tier_drain():
+    base_dir = tempfile.mkdtemp()
+    try:
+        config = {'log_dir': base_dir, 'tier_dir': os.path.join(base_dir, 'tier'), 'tier_retain': 1, 'retain': 2,
+                  'dbname': 'db', 'snapshot_name': 'snap', 'prometheus_textfile_dir': base_dir,
+                  'stores': [{'type': 'fs', 'path': os.path.join(base_dir, 'offsite')}]}
+        for name in ('tier', 'offsite'):
+            os.makedirs(os.path.join(base_dir, name))
+        source = os.path.join(base_dir, 'source')
+        tier_store = FSStore(config['tier_dir'], 'v_node0001/snap')
+        offsite_store = FSStore(os.path.join(base_dir, 'offsite'), 'v_node0001/snap')
+        dates = [datetime(2015, 1, 1) + timedelta(days=day) for day in range(5)]
+        pickles = [date.strftime("%Y_%m_%d_%H%M") + '.pickle' for date in dates]
+
+        # Drained in the forked child, the parent's metrics are untouched
+        assert tier_backup(config, source, dates[0], 0) == 0
+        run_metrics.add('objects_uploaded', 7)
+        pid = start_drain(config, config['tier_dir'], 'v_node0001/snap')
+        assert os.waitpid(pid, 0)[1] == 0
+        assert offsite_store.list_pickles() == pickles[:1]
+        assert open(os.path.join(config['tier_dir'], DRAINED_NAME)).read() == pickles[0]
+        assert os.path.exists(os.path.join(base_dir, 'backup_drain.json'))
+        with open(os.path.join(base_dir, 'vertica_backup_drain.prom')) as prom_file:
+            assert 'vertica_backup_objects_uploaded{dbname="db",snapshot="snap",store=' in prom_file.read()
+        assert run_metrics.get('objects_uploaded') == 7
+        run_metrics.reset()
+
+        # With the drain stalled the tier keeps every undrained backup, beyond tier_retain
+        assert [tier_backup(config, source, dates[day], day) for day in range(1, 4)] == [0, 1, 2]
+        assert tier_store.list_pickles() == pickles[3:0:-1]
+        for day in range(1, 4):
+            assert os.path.exists(os.path.join(config['tier_dir'], 'v_node0001', 'snap', 'file%d' % day))
+
+        # Once the newest backup is drained the tier is back to tier_retain
+        pid = start_drain(config, config['tier_dir'], 'v_node0001/snap')
+        assert os.waitpid(pid, 0)[1] == 0
+        assert offsite_store.list_pickles() == [pickles[3], pickles[0]]
+        assert os.path.exists(os.path.join(base_dir, 'offsite', 'v_node0001', 'snap', 'file3'))
+        assert tier_backup(config, source, dates[4], 4) == 0
+        assert tier_store.list_pickles() == pickles[4:]
+    finally:
+        shutil.rmtree(base_dir)
@@ -0,0 +1,41 @@
+""" Tests sharing the upload budget between nodes through leases
+"""
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from vertica_backup.budget import UploadBudget
+from vertica_backup.object_store.fs import FSStore
+
+
+def test_budget():
+    lease_dir = tempfile.mkdtemp()
+    try:
+        store = FSStore(lease_dir, '')
+        node1 = UploadBudget(store, 'node1', concurrency=5, bandwidth=1000)
+        node2 = UploadBudget(store, 'node2', concurrency=5, bandwidth=1000, node_bandwidth=400)
+        node1.refresh()
+        node2.refresh()
+        node1.refresh()
+        assert node1.nodes == node2.nodes == ['node1', 'node2']
+        assert (node1.slots.limit, node2.slots.limit) == (3, 2)
+        assert (node1.throttle.rate, node2.throttle.rate) == (500, 400)
+
+        # A lapsed lease no longer counts and is removed once it is well past its expiry
+        with open(os.path.join(lease_dir, 'node3.lease'), 'w') as lease_file:
+            json.dump({'node': 'node3', 'expires': time.time() - 1}, lease_file)
+        node1.refresh()
+        assert node1.nodes == ['node1', 'node2'] and os.path.exists(os.path.join(lease_dir, 'node3.lease'))
+        node1.refresh(time.time() + node1.ttl)
+        assert not os.path.exists(os.path.join(lease_dir, 'node3.lease'))
+
+        # A node finishing lends its share to the others
+        node2.release()
+        assert not os.path.exists(os.path.join(lease_dir, 'node2.lease'))
+        node1.refresh()
+        assert node1.nodes == ['node1']
+        assert (node1.slots.limit, node1.throttle.rate) == (5, 1000)
+    finally:
+        shutil.rmtree(lease_dir)
@@ -0,0 +1,45 @@
+""" Tests the run statistics records and the regression check of the report
+"""
+from datetime import datetime
+import shutil
+import tempfile
+
+from vertica_backup.directory_metadata import DirectoryMetadata, FileMetadata
+from vertica_backup.history import list_stats, load_stats, save_stats
+from vertica_backup.metrics import run_metrics
+from vertica_backup.object_store.fs import FSStore
+from vertica_backup.report import regressed
+
+
+def test_save_stats():
+    store_dir = tempfile.mkdtemp()
+    try:
+        store = FSStore(store_dir, 'v_test_node0001')
+        run_metrics.reset()
+        run_metrics.phase('upload', 10, {'store': str(store)})
+        run_metrics.add('bytes_uploaded', 1000, {'store': str(store)})
+        run_metrics.add('bytes_uploaded', 5000, {'store': 'another store'})
+
+        for day in (1, 2, 3):
+            metadata = DirectoryMetadata(date=datetime(2014, 1, day))
+            metadata.metadata = {'file': FileMetadata('file', 200, datetime(2014, 1, 1), 'hash')}
+            save_stats(metadata, store, keep=2)
+
+        assert list_stats(store) == ['2014_01_03_0000.stats.json', '2014_01_02_0000.stats.json']
+        record = load_stats(store, '2014_01_03_0000.stats.json')
+        assert record['counters']['bytes_uploaded'] == 1000
+        assert record['throughput']['upload'] == 100
+        assert record['snapshot_bytes'] == 200
+    finally:
+        run_metrics.reset()
+        shutil.rmtree(store_dir)
+
+
+def record(rate):
+    return {'counters': {'bytes_uploaded': 2 ** 30}, 'throughput': {'upload': rate}}
+
+
+def test_regressed():
+    assert regressed([record(100), record(100), record(10)]) is None  # Too little history
+    assert regressed([record(100), record(90), record(110), record(95)]) is None
+    assert regressed([record(100), record(90), record(110), record(50)]) == 0.5
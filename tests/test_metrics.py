@@ -0,0 +1,76 @@
+""" Tests the run Metrics
+"""
+import json
+
+from vertica_backup.metrics import Histogram, LATENCY_BUCKETS, Metrics
+
+
+def test_histogram():
+    hist = Histogram((1, 10, float('inf')))
+    for value in (0.5, 1, 5, 100):
+        hist.observe(value)
+    assert hist.counts == [2, 1, 1]
+    assert hist.count == 4
+    assert hist.sum == 106.5
+
+
+def test_counters_and_throughput():
+    metrics = Metrics()
+    metrics.add('bytes_uploaded', 1000, {'store': 'a'})
+    metrics.add('bytes_uploaded', 3000, {'store': 'b'})
+    metrics.phase('upload', 2, {'store': 'a'})
+    metrics.phase('upload', 2, {'store': 'a'})
+    assert metrics.get('bytes_uploaded', {'store': 'b'}) == 3000
+    assert metrics.total('bytes_uploaded') == 4000
+    assert metrics.throughput() == {('upload', (('store', 'a'),)): 250}
+    assert metrics.perfdata(['bytes_uploaded', 'retries']) == 'bytes_uploaded=4000 retries=0'
+
+
+def test_output_formats():
+    metrics = Metrics()
+    metrics.phase('diff', 1.5)
+    metrics.add('retries', 2)
+    metrics.observe('upload_seconds', 0.2, {'store': 'a'})
+
+    as_dict = json.loads(json.dumps(metrics.to_dict()))
+    assert as_dict['phases'] == [{'name': 'diff', 'value': 1.5}]
+    assert as_dict['counters'] == [{'name': 'retries', 'value': 2}]
+
+    text = metrics.prometheus()
+    assert 'vertica_backup_phase_seconds{phase="diff"} 1.500000' in text
+    assert 'vertica_backup_retries 2' in text
+    assert 'vertica_backup_upload_seconds_bucket{store="a",le="0.25"} 1' in text
+    assert 'vertica_backup_upload_seconds_bucket{store="a",le="+Inf"} 1' in text
+    assert 'vertica_backup_upload_seconds_count{store="a"} 1' in text
+
+
+def test_prometheus_grouping():
+    metrics = Metrics()
+    for store in ('a', 'b'):
+        metrics.add('bytes_uploaded', 1000, {'store': store})
+        metrics.observe('upload_seconds', 0.2, {'store': store})
+
+    # One TYPE line per metric, followed by the samples of every label set
+    lines = metrics.prometheus().splitlines()
+    assert lines.count('# TYPE vertica_backup_bytes_uploaded gauge') == 1
+    start = lines.index('# TYPE vertica_backup_bytes_uploaded gauge')
+    assert lines[start + 1:start + 3] == ['vertica_backup_bytes_uploaded{store="a"} 1000',
+                                          'vertica_backup_bytes_uploaded{store="b"} 1000']
+    assert lines.count('# TYPE vertica_backup_upload_seconds histogram') == 1
+    start = lines.index('# TYPE vertica_backup_upload_seconds histogram')
+    samples = lines[start + 1:start + 1 + 2 * (len(LATENCY_BUCKETS) + 2)]
+    assert all(line.startswith('vertica_backup_upload_seconds_') for line in samples)
+    assert len([line for line in samples if 'store="b"' in line]) == len(LATENCY_BUCKETS) + 2
+
+
+def test_prometheus_labels():
+    metrics = Metrics()
+    metrics.phase('diff', 1.5)
+    metrics.add('retries', 2)
+    metrics.observe('upload_seconds', 0.2, {'store': 'a'})
+
+    text = metrics.prometheus({'snapshot': 'snap', 'dbname': 'db'})
+    assert 'vertica_backup_phase_seconds{dbname="db",snapshot="snap",phase="diff"} 1.500000' in text
+    assert 'vertica_backup_retries{dbname="db",snapshot="snap"} 2' in text
+    assert 'vertica_backup_upload_seconds_bucket{dbname="db",snapshot="snap",store="a",le="0.25"} 1' in text
+    assert 'vertica_backup_upload_seconds_count{dbname="db",snapshot="snap",store="a"} 1' in text
@@ -0,0 +1,48 @@
+""" Tests the dry-run plan estimates
+"""
+from datetime import datetime
+import os
+import shutil
+import tempfile
+
+from vertica_backup.backup import plan_backup
+from vertica_backup.directory_metadata import DirectoryMetadata, FileMetadata
+from vertica_backup.plan import estimate_diff, plan_entry
+
+
+def metadata(files):
+    directory = DirectoryMetadata()
+    directory.metadata = dict((path, FileMetadata(path, size, datetime(2014, 1, 1), f_hash))
+                              for path, size, f_hash in files)
+    return directory
+
+
+def test_estimate_diff():
+    # Files not hashed for the plan match on size alone
+    local = metadata([('same', 10, None), ('resized', 10, None), ('changed', 10, 'new'), ('new', 5, None)])
+    store = metadata([('same', 10, 'a'), ('resized', 20, 'b'), ('changed', 10, 'old'), ('old', 7, 'c')])
+    assert estimate_diff(local, store) == (set(['resized', 'changed', 'new']), set(['old']))
+
+
+def test_plan_entry():
+    local = metadata([('a', 100, None), ('b', 300, None)])
+    assert plan_entry('store', 'upload', ['a', 'b'], local, 100)['seconds'] == 4
+    assert plan_entry('store', 'delete', ['a', 'b'], local, 1, unit='objects')['seconds'] == 2
+    assert plan_entry('store', 'upload', ['a'], local, None)['seconds'] is None
+    assert plan_entry('store', 'upload', [], local, None)['seconds'] == 0
+
+
+def test_plan_read_only():
+    base_dir = tempfile.mkdtemp()
+    try:
+        os.makedirs(os.path.join(base_dir, 'backup', 'v_db_node0001', 'snap'))
+        with open(os.path.join(base_dir, 'backup', 'v_db_node0001', 'snap', 'file'), 'w') as data_file:
+            data_file.write('some data')
+        config = {'backup_dir': os.path.join(base_dir, 'backup'), 'dbname': 'db', 'snapshot_name': 'snap',
+                  'retain': 2, 'stores': [{'type': 'fs', 'path': os.path.join(base_dir, 'offsite')}]}
+
+        # The plan does not create the store, it plans the first backup into an empty one
+        assert plan_backup(config) == 0
+        assert not os.path.exists(os.path.join(base_dir, 'offsite'))
+    finally:
+        shutil.rmtree(base_dir)
@@ -0,0 +1,61 @@
+""" Tests the run Profiler
+"""
+import json
+import logging
+import os
+import pstats
+import shutil
+import tempfile
+import threading
+
+from vertica_backup.profiling import Profiler, run_profiler, tracemalloc
+from vertica_backup.utils import LogTime
+
+log = logging.getLogger(__name__)
+
+
+def busy(count):
+    return sum(index * index for index in xrange(count))
+
+
+def test_disabled_by_default():
+    assert not run_profiler.enabled
+    profiler = Profiler()
+    profiler.phase_start('diff')
+    profiler.phase_end()
+    assert profiler.out_dir is None
+    assert not hasattr(profiler.local, 'stack')
+
+
+def test_phase_profiles():
+    log_dir = tempfile.mkdtemp()
+    try:
+        run_profiler.start(log_dir, 'test', 0.01)
+        try:
+            with LogTime(log.debug, 'Outer', phase='upload', labels={'store': 'a'}):
+                with LogTime(log.debug, 'Inner', phase='diff'):
+                    busy(1000)
+            worker = threading.Thread(target=busy, args=(100000,), name='worker')
+            worker.start()
+            worker.join()
+        finally:
+            run_profiler.stop()
+
+        profile_dirs = os.listdir(log_dir)
+        assert len(profile_dirs) == 1 and profile_dirs[0].startswith('profile_test_')
+        out_dir = os.path.join(log_dir, profile_dirs[0])
+        written = os.listdir(out_dir)
+        for name in ('001_upload_a', '002_diff'):
+            assert name + '.prof' in written
+            if tracemalloc is None:
+                with open(os.path.join(out_dir, name + '.objects.json')) as objects_file:
+                    assert len(json.load(objects_file)['objects']) > 0
+            else:
+                assert name + '.tracemalloc' in written
+        assert 'samples.jsonl' in written
+
+        # The thread started while profiling is profiled on its own
+        functions = [function for filename, line, function in pstats.Stats(os.path.join(out_dir, 'threads.prof')).stats]
+        assert 'busy' in functions
+    finally:
+        shutil.rmtree(log_dir)
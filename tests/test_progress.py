@@ -0,0 +1,60 @@
+""" Tests the progress status file
+"""
+from cStringIO import StringIO
+import json
+import os
+import tempfile
+
+from vertica_backup.progress import current_transfer, ProgressReader, ProgressReporter
+
+
+def test_progress_file():
+    status_fd, status_path = tempfile.mkstemp()
+    os.close(status_fd)
+    try:
+        reporter = ProgressReporter()
+        reporter.start(status_path, interval=0)
+        tracker = reporter.track('upload', 'swift', 1000, 4)
+        tracker.update(250)
+        with open(status_path) as status_file:
+            status = json.load(status_file)['transfers'][0]
+        assert (status['bytes_done'], status['bytes_total'], status['objects_done']) == (250, 1000, 1)
+        assert status['finished'] is None
+
+        tracker.update(750, 3)
+        tracker.finish()
+        with open(status_path) as status_file:
+            status = json.load(status_file)['transfers'][0]
+        assert status['objects_done'] == 4 and status['eta_seconds'] == 0 and status['finished'] is not None
+    finally:
+        os.remove(status_path)
+
+
+def test_partial_progress():
+    status_fd, status_path = tempfile.mkstemp()
+    os.close(status_fd)
+    try:
+        reporter = ProgressReporter()
+        reporter.start(status_path, interval=0)
+        tracker = reporter.track('upload', 'swift', 1000, 1)
+
+        # Bytes read by the store show up while the object is still being transferred
+        with tracker.transfer():
+            reader = ProgressReader(StringIO('x' * 1000), current_transfer())
+            reader.read(300)
+            with open(status_path) as status_file:
+                status = json.load(status_file)['transfers'][0]
+            assert (status['bytes_done'], status['objects_done']) == (300, 0)
+            reader.read()
+            tracker.update(1000)
+        assert current_transfer() is None
+        with open(status_path) as status_file:
+            status = json.load(status_file)['transfers'][0]
+        assert (status['bytes_done'], status['objects_done']) == (1000, 1)
+
+        # A failed transfer's partial bytes are dropped
+        with tracker.transfer() as transfer:
+            transfer.advance(500)
+        assert tracker.partial == {}
+    finally:
+        os.remove(status_path)
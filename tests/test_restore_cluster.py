@@ -0,0 +1,97 @@
+""" Tests the cluster restore orchestration with a local shell standing in for ssh
+"""
+import argparse
+import json
+import os
+import pipes
+import shutil
+import tempfile
+
+from vertica_backup.restore_cluster import ClusterRestore, valid_day
+
+# Runs the remote command locally, the host argument is ignored
+LOCAL_SSH = ['sh', '-c', 'eval "$2"', 'ssh']
+
+
+class LocalRestore(ClusterRestore):
+    """ Each node's first download to host2 fails, the others write a finished progress file and succeed. """
+    def remote_command(self, node, share):
+        progress = json.dumps({'transfers': [{'operation': 'download', 'bytes_done': 100, 'bytes_total': 100,
+                                              'throughput_bytes_per_second': 0.0, 'eta_seconds': 0}]})
+        marker = node.host + '.failed'
+        command = 'echo %s > %s; echo %s > %s.share' % (pipes.quote(progress), node.progress_path, share, node.host)
+        if node.host == 'host2':
+            command = 'test -e %s || { touch %s; exit 1; }; %s' % (marker, marker, command)
+        return ['sh', '-c', command]
+
+
+class RebalanceRestore(ClusterRestore):
+    """ host1 finishes at once, host2 runs until its bandwidth file gives it the whole budget or a few seconds pass. """
+    def remote_command(self, node, share):
+        command = 'echo {} > %s' % node.progress_path
+        if node.host == 'host2':
+            path = pipes.quote(node.bandwidth_path)
+            command = 'for i in $(seq 100); do grep -qx 1000 %s && break; sleep 0.05; done; cat %s > host2.share; %s' \
+                % (path, path, command)
+        return ['sh', '-c', command]
+
+
+def test_retry_failed_node():
+    work_dir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        os.chdir(work_dir)
+        restore = LocalRestore([('host1', 'v_db_node0001'), ('host2', 'v_db_node0002')], 'config.yaml',
+                               'example.com', '2014_01_01', bandwidth=1000, retries=1, ssh=LOCAL_SSH,
+                               log_dir=work_dir, interval=0)
+        assert restore.run() == 0
+        assert [node.attempts for node in restore.nodes] == [1, 2]
+        assert open('host1.share').read().strip() == '500'
+
+        # Each node had its own private progress directory, removed once the restore finished
+        progress_dirs = [os.path.dirname(node.progress_path) for node in restore.nodes]
+        assert len(set(progress_dirs)) == 2
+        assert not any(os.path.exists(progress_dir) for progress_dir in progress_dirs)
+
+        status = json.load(open('restore_cluster.json'))
+        assert status['nodes']['host2']['state'] == 'done'
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir)
+
+
+def test_rebalance():
+    work_dir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        os.chdir(work_dir)
+        restore = RebalanceRestore([('host1', 'v_db_node0001'), ('host2', 'v_db_node0002')], 'config.yaml',
+                                   'example.com', '2014_01_01', bandwidth=1000, ssh=LOCAL_SSH, log_dir=work_dir,
+                                   interval=0)
+        assert restore.run() == 0
+        # host2 started with half and was given all of the bandwidth once host1 finished
+        assert [node.share for node in restore.nodes] == [500, 1000]
+        assert open('host2.share').read().strip() == '1000'
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir)
+
+
+def test_remote_command():
+    restore = ClusterRestore([('host1', 'v_db_node0001')], '/opt/vertica/config/db backup.yaml', 'example.com',
+                             '2014_01_01', snapshot_name='restored', sudo=True,
+                             progress_path='/opt/vertica/log/restore_progress.json')
+    node = restore.nodes[0]
+    assert node.command_line(restore.remote_command(node, 500)) == \
+        "sudo -i vertica_restore_download --set restore_progress_file=/opt/vertica/log/restore_progress.json " \
+        "--set snapshot_name=restored --set restore_bandwidth=500 " \
+        "--set restore_bandwidth_file=/opt/vertica/log/restore_bandwidth '/opt/vertica/config/db backup.yaml' " \
+        "example.com v_db_node0001 2014_01_01"
+
+
+def test_empty_day():
+    try:
+        valid_day('')
+        assert False, 'An empty day was accepted'
+    except argparse.ArgumentTypeError:
+        pass
@@ -0,0 +1,139 @@
+""" Tests partial restores selected by path patterns and restores seeded from a warm standby
+"""
+from datetime import datetime
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from benchmarks.fake_swift import FakeSwift
+from vertica_backup.directory_metadata import DirectoryMetadata
+from vertica_backup.object_store.fs import FSStore
+from vertica_backup.object_store.swift import SwiftStore
+from vertica_backup.object_store.swift_pool import ConnectionPool, TokenCache
+from vertica_backup.restore_download import download, follow_bandwidth, get_standby_store, PathFilter, sync_standby
+from vertica_backup.retry import RetryPolicy
+from vertica_backup.utils import Throttle
+
+PREFIX = 'v_db_node0001/snap'
+CATALOG = 'v_db_node0001/snap/catalog/v_db_node0001_catalog/Snapshots/catalog.ctlg'
+
+
+def write(base_dir, path, data):
+    full_path = os.path.join(base_dir, path)
+    if not os.path.exists(os.path.dirname(full_path)):
+        os.makedirs(os.path.dirname(full_path))
+    with open(full_path, 'w') as data_file:
+        data_file.write(data)
+
+
+def test_path_filter():
+    path_filter = PathFilter(PREFIX, '/catalog', include=['data/*.gt'], exclude=['data/skip*'])
+    assert path_filter(PREFIX + '/data/a.gt')
+    assert not path_filter(PREFIX + '/data/skip.gt')
+    assert not path_filter(PREFIX + '/data/a.fdb')
+    assert path_filter(PREFIX + '/snap.txt')  # Epoch files and the catalog are always restored
+    assert path_filter(CATALOG)
+
+
+def remote_backup(fake, work_dir, date, files):
+    """ Return a SwiftStore on the fake holding a backup of the files, a dict of paths relative to the snapshot and
+        their contents, with the epoch files for the date.
+    """
+    remote_dir = os.path.join(work_dir, 'remote')
+    if os.path.exists(remote_dir):
+        shutil.rmtree(remote_dir)
+    date_str = date.strftime('%Y_%m_%d_%H%M')
+    for path, data in files.iteritems():
+        write(remote_dir, os.path.join(PREFIX, path), data)
+    write(remote_dir, PREFIX + '/snap.txt_' + date_str, 'manifest')
+    write(remote_dir, CATALOG + '_' + date_str, 'catalog')
+    token_cache = TokenCache(os.path.join(work_dir, 'tokens.json'))
+    pool = ConnectionPool(fake.auth_url, fake.user, fake.key, 'test', fake.region, token_cache, size=2)
+    token_cache.put(pool.cache_key, fake.storage_url, fake.new_token())
+    remote = SwiftStore(fake.key, fake.region, 'test', fake.auth_url, fake.user, PREFIX, domain='example.com',
+                        hostname='host1', retry_policy=RetryPolicy(base_delay=0), pool=pool)
+    source = FSStore(remote_dir, PREFIX)
+    for path in source.get_metadata():
+        remote.upload(path, remote_dir)
+    DirectoryMetadata(source, date).save(remote)
+    return remote
+
+
+def test_partial_download():
+    work_dir = tempfile.mkdtemp()
+    fake = FakeSwift().start()
+    try:
+        # The backup with a data file selected and one not, plus a stale local file outside the filter
+        local_dir = os.path.join(work_dir, 'local')
+        write(local_dir, PREFIX + '/data/stale.fdb', 'stale')
+        remote = remote_backup(fake, work_dir, datetime(2014, 1, 1), {'data/a.gt': 'a', 'data/b.fdb': 'b'})
+        local = FSStore(local_dir, PREFIX)
+        DirectoryMetadata(local, datetime(2013, 1, 1)).save(local)
+
+        config = {'log_dir': work_dir, 'catalog_dir': '/catalog', 'snapshot_name': 'snap'}
+        assert download(config, remote, local, '2014_01_01_0000.pickle', PathFilter(PREFIX, '/catalog', ['data/*.gt'])) == 0
+
+        assert sorted(local.get_metadata().keys()) == [CATALOG, PREFIX + '/data/a.gt', PREFIX + '/data/stale.fdb',
+                                                       PREFIX + '/snap.txt']
+        assert sorted(os.listdir(local_dir)) == ['2014_01_01_0000.partial', 'v_db_node0001']
+    finally:
+        fake.stop()
+        shutil.rmtree(work_dir)
+
+
+def test_standby():
+    work_dir = tempfile.mkdtemp()
+    fake = FakeSwift().start()
+    try:
+        config = {'log_dir': work_dir, 'catalog_dir': '/catalog', 'snapshot_name': 'snap',
+                  'backup_dir': os.path.join(work_dir, 'backup')}
+        remote = remote_backup(fake, work_dir, datetime(2014, 1, 1), {'data/a.gt': 'a', 'data/b.fdb': 'b'})
+
+        # The standby is kept beside the backup dir, which is left alone
+        assert get_standby_store(config, PREFIX) is None
+        standby = FSStore(os.path.join(work_dir, 'backup_standby'), PREFIX)
+        assert sync_standby(config, remote, standby) == 0
+        assert standby.list_pickles() == ['2014_01_01_0000.pickle']
+        assert not os.path.exists(config['backup_dir'])
+        assert get_standby_store(config, PREFIX) is not None
+
+        # A restore takes the unchanged files from the standby, only downloading the epoch files
+        local = FSStore(config['backup_dir'], PREFIX)
+        os.makedirs(local.prefix_dir)
+        gets = fake.stats['GET']
+        assert download(config, remote, local, '2014_01_01_0000.pickle',
+                        standby_store=get_standby_store(config, PREFIX)) == 0
+        assert fake.stats['GET'] - gets == 3  # The pickle and the two epoch files
+        assert sorted(local.get_metadata().keys()) == [CATALOG, PREFIX + '/data/a.gt', PREFIX + '/data/b.fdb',
+                                                       PREFIX + '/snap.txt']
+
+        # A newer backup syncs into the standby without touching the restored files linked from it
+        remote = remote_backup(fake, work_dir, datetime(2014, 1, 2), {'data/a.gt': 'changed', 'data/c.gt': 'c'})
+        assert sync_standby(config, remote, standby) == 0
+        assert standby.list_pickles() == ['2014_01_02_0000.pickle']
+        with open(os.path.join(local.prefix_dir, 'data', 'a.gt')) as restored:
+            assert restored.read() == 'a'
+        assert os.path.exists(os.path.join(local.prefix_dir, 'data', 'b.fdb'))
+    finally:
+        fake.stop()
+        shutil.rmtree(work_dir)
+
+
+def test_follow_bandwidth():
+    work_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(work_dir, 'restore_bandwidth')
+        throttle = Throttle(1000)
+        stop_following = threading.Event()
+        follow_bandwidth(path, throttle, 0.01, stop_following)
+        write(work_dir, 'restore_bandwidth', '2000\n')
+        for attempt in range(100):
+            if throttle.rate == 2000:
+                break
+            time.sleep(0.01)
+        assert throttle.rate == 2000
+    finally:
+        stop_following.set()
+        shutil.rmtree(work_dir)
@@ -0,0 +1,65 @@
+""" Tests the RetryPolicy and FailureQueue
+"""
+from vertica_backup.retry import FAIL, FailureQueue, RECONNECT, RetryPolicy
+
+
+class Flaky(object):
+    """ A callable which fails the given number of times before succeeding. """
+    def __init__(self, failures, error=IOError):
+        self.failures = failures
+        self.error = error
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise self.error('failure %d' % self.calls)
+        return self.calls
+
+
+def test_retry_succeeds():
+    policy = RetryPolicy(attempts=3, base_delay=0)
+    assert policy.call('flaky', Flaky(2)) == 3
+    assert policy.retries == 2
+
+
+def test_retry_exhausted():
+    policy = RetryPolicy(attempts=3, base_delay=0)
+    flaky = Flaky(5)
+    try:
+        policy.call('flaky', flaky)
+        assert False, 'Expected an IOError'
+    except IOError:
+        pass
+    assert flaky.calls == 3
+
+
+def test_classifier():
+    reconnects = []
+    policy = RetryPolicy(attempts=3, base_delay=0, classifier=lambda ex: RECONNECT)
+    assert policy.call('flaky', Flaky(1), reconnect=lambda: reconnects.append(1)) == 2
+    assert reconnects == [1]
+
+    policy = RetryPolicy(attempts=3, base_delay=0, classifier=lambda ex: FAIL)
+    flaky = Flaky(1)
+    try:
+        policy.call('flaky', flaky)
+        assert False, 'Expected an IOError'
+    except IOError:
+        pass
+    assert flaky.calls == 1
+
+
+def test_delay_bounds():
+    policy = RetryPolicy(base_delay=1, max_delay=10)
+    for attempt in range(1, 10):
+        assert 0 <= policy.delay(attempt) <= min(10, 2 ** attempt)
+
+
+def test_failure_queue():
+    queue = FailureQueue()
+    queue.add('recovers', Flaky(1))
+    queue.add('broken', Flaky(5))
+    assert queue.retry() == []
+    assert queue.retry() == [2]
+    assert queue.descriptions() == ['broken']
@@ -0,0 +1,37 @@
+""" Tests ordering the uploads of a backup
+"""
+from datetime import datetime
+
+from vertica_backup.directory_metadata import FileMetadata
+from vertica_backup.metrics import run_metrics
+from vertica_backup.schedule import estimate_makespan, schedule
+
+
+def test_schedule():
+    sizes = {'data/small1': 1, 'data/small2': 2, 'data/big': 10, 'data/medium': 5, 'snap.info': 3, 'catalog.ctlg': 4}
+    metadata = dict((path, FileMetadata(path, size, datetime.today(), None)) for path, size in sizes.iteritems())
+
+    assert schedule(sizes.keys(), metadata, 2) == \
+        ['data/big', 'data/medium', 'catalog.ctlg', 'snap.info', 'data/small2', 'data/small1']
+    assert run_metrics.get('schedule_makespan_bytes') == 13
+    assert run_metrics.get('schedule_ideal_bytes') == 12
+
+    ordered = schedule(sizes.keys(), metadata, 2, first=['*.info'], last=['*.ctlg'])
+    assert ordered == ['snap.info', 'data/big', 'data/medium', 'data/small2', 'data/small1', 'catalog.ctlg']
+    assert run_metrics.get('scheduled_objects', {'class': 'last'}) == 1
+
+    # A large file started last leaves one thread uploading alone
+    assert estimate_makespan([1, 1, 1, 1, 10], 2) == 12
+    assert estimate_makespan([10, 1, 1, 1, 1], 2) == 10
+
+
+def test_interleave_small_files():
+    sizes = {'data/big': 30 << 20, 'data/medium': 20 << 20, 'data/large': 10 << 20, 'snap.info': 3,
+             'data/small1': 1000, 'data/small2': 2000, 'data/small3': 3000, 'data/small4': 4000}
+    metadata = dict((path, FileMetadata(path, size, datetime.today(), None)) for path, size in sizes.iteritems())
+
+    # The small files are shared out after the large ones in size order, priority classes are interleaved separately
+    assert schedule(sizes.keys(), metadata, 2, first=['*.info']) == \
+        ['snap.info', 'data/big', 'data/small4', 'data/medium', 'data/small3', 'data/large', 'data/small2',
+         'data/small1']
+    assert run_metrics.get('scheduled_small_objects') == 5
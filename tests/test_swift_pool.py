@@ -0,0 +1,61 @@
+""" Tests the TokenCache shared between processes
+"""
+import os
+import shutil
+import tempfile
+
+from vertica_backup.object_store.swift_pool import TokenCache
+
+auth_calls = []
+
+
+def auth():
+    auth_calls.append(1)
+    return 'https://swift/v1/AUTH_test', 'token%d' % len(auth_calls)
+
+
+def test_token_cache():
+    cache_fd, cache_path = tempfile.mkstemp()
+    os.close(cache_fd)
+    try:
+        cache = TokenCache(cache_path, ttl=3600)
+        assert cache.get('key', auth) == (('https://swift/v1/AUTH_test', 'token1'), True)
+        # A second cache on the same file, as another process would have, reuses the token
+        assert TokenCache(cache_path).get('key', auth) == (('https://swift/v1/AUTH_test', 'token1'), False)
+
+        cache.invalidate('key', 'token1')
+        assert cache.get('key', auth) == (('https://swift/v1/AUTH_test', 'token2'), True)
+
+        expired = TokenCache(cache_path, ttl=-1)
+        expired.get('other', auth)
+        assert expired.get('other', auth)[1]
+    finally:
+        os.remove(cache_path)
+
+
+def test_unsafe_token_cache():
+    cache_dir = tempfile.mkdtemp()
+    try:
+        # A symlink planted in place of the cache is not followed
+        target_path = os.path.join(cache_dir, 'target')
+        with open(target_path, 'w') as target_file:
+            target_file.write('precious')
+        link_path = os.path.join(cache_dir, 'link.json')
+        os.symlink(target_path, link_path)
+        assert TokenCache(link_path).get('key', auth)[1]
+        with open(target_path) as target_file:
+            assert target_file.read() == 'precious'
+
+        # A cache others can read is neither read nor written
+        open_path = os.path.join(cache_dir, 'open.json')
+        with open(open_path, 'w') as open_file:
+            open_file.write('{"key": {"url": "https://evil", "token": "planted", "expires": 9999999999}}')
+        os.chmod(open_path, 0644)
+        assert TokenCache(open_path).get('key', auth)[1]
+        assert 'planted' in open(open_path).read()
+
+        created_path = os.path.join(cache_dir, 'created.json')
+        TokenCache(created_path).get('key', auth)
+        assert os.stat(created_path).st_mode & 0777 == 0600
+    finally:
+        shutil.rmtree(cache_dir)
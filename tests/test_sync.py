@@ -0,0 +1,193 @@
+""" Tests the teed upload of a snapshot to multiple stores
+"""
+from datetime import datetime
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from vertica_backup.directory_metadata import DirectoryMetadata
+from vertica_backup.object_store.fs import FSStore
+from vertica_backup import sync
+
+test_dirs = {}
+
+
+class SlowFSStore(FSStore):
+    """ An FSStore which is too slow to keep up with the tee. """
+    def upload_file(self, relative_path, file_obj, size):
+        time.sleep(0.2)
+        return FSStore.upload_file(self, relative_path, file_obj, size)
+
+
+class ThrottledReader(object):
+    """ Reads from a file object at a limited pace. """
+    def __init__(self, file_obj):
+        self.file_obj = file_obj
+
+    def read(self, size=-1):
+        time.sleep(0.01)
+        return self.file_obj.read(size)
+
+
+class RecordingFSStore(FSStore):
+    """ An FSStore noting in events how each upload was done, reading through the tee slowly if throttled is set. """
+    def __init__(self, base_dir, prefix_dir, events, throttled=False):
+        FSStore.__init__(self, base_dir, prefix_dir)
+        self.events = events
+        self.throttled = throttled
+
+    def upload_file(self, relative_path, file_obj, size):
+        if self.throttled:
+            file_obj = ThrottledReader(file_obj)
+        size = FSStore.upload_file(self, relative_path, file_obj, size)
+        self.events.append((self.base_dir, 'tee'))
+        return size
+
+    def upload(self, relative_path, base_dir):
+        size = FSStore.upload(self, relative_path, base_dir)
+        self.events.append((self.base_dir, 'direct'))
+        return size
+
+
+class ConcurrentFSStore(RecordingFSStore):
+    """ A RecordingFSStore taking a while over each upload, counting the most uploads running at once. """
+    def __init__(self, base_dir, prefix_dir, events):
+        RecordingFSStore.__init__(self, base_dir, prefix_dir, events)
+        self.lock = threading.Lock()
+        self.running = 0
+        self.most_running = 0
+
+    def _running(self, upload, *args):
+        with self.lock:
+            self.running += 1
+            self.most_running = max(self.most_running, self.running)
+        try:
+            time.sleep(0.1)
+            return upload(self, *args)
+        finally:
+            with self.lock:
+                self.running -= 1
+
+    def upload_file(self, relative_path, file_obj, size):
+        return self._running(RecordingFSStore.upload_file, relative_path, file_obj, size)
+
+    def upload(self, relative_path, base_dir):
+        return self._running(RecordingFSStore.upload, relative_path, base_dir)
+
+
+class SlowListingFSStore(RecordingFSStore):
+    """ A RecordingFSStore taking a second to list, noting in events when the listing is done. """
+    def get_metadata(self):
+        time.sleep(1)
+        metadata = RecordingFSStore.get_metadata(self)
+        self.events.append((self.base_dir, 'listed'))
+        return metadata
+
+
+def setup():
+    base = tempfile.mkdtemp()
+    test_dirs['base'] = base
+    test_dirs['source'] = os.path.join(base, 'source')
+    os.makedirs(os.path.join(test_dirs['source'], 'v_node0001', 'snap', 'data'))
+    for index in range(5):
+        with open(os.path.join(test_dirs['source'], 'v_node0001', 'snap', 'data', 'file%d' % index), 'wb') as afile:
+            afile.write(os.urandom(200000))
+
+
+def teardown():
+    shutil.rmtree(test_dirs['base'])
+
+
+def test_backup_to_stores():
+    current = DirectoryMetadata(FSStore(test_dirs['source'], 'v_node0001/snap'), datetime.today())
+    targets = []
+    for name, store_class in (('one', FSStore), ('two', FSStore), ('slow', SlowFSStore)):
+        os.makedirs(os.path.join(test_dirs['base'], name))
+        targets.append((store_class(os.path.join(test_dirs['base'], name), 'v_node0001/snap'), 2))
+
+    assert sync.backup_to_stores(current, targets, test_dirs['source'], tee_buffer=2, tee_timeout=0.05) == [(0, [])] * 3
+    for store, retain in targets:
+        assert len(store.list_pickles()) == 1
+        assert current.diff(DirectoryMetadata(store)) == (set(), set())
+
+
+def test_throttled_store():
+    os.makedirs(os.path.join(test_dirs['source'], 'v_node0002', 'snap'))
+    with open(os.path.join(test_dirs['source'], 'v_node0002', 'snap', 'large'), 'wb') as large_file:
+        large_file.write(os.urandom(2 * 1024 * 1024))
+    current = DirectoryMetadata(FSStore(test_dirs['source'], 'v_node0002/snap'), datetime.today())
+    events = []
+    targets = []
+    for name in ('fast', 'throttled'):
+        os.makedirs(os.path.join(test_dirs['base'], name))
+        store = RecordingFSStore(os.path.join(test_dirs['base'], name), 'v_node0002/snap', events, name == 'throttled')
+        targets.append((store, 2))
+
+    # The throttled store falls a buffer behind and reads the file itself, the fast store is not held to its pace
+    assert sync.backup_to_stores(current, targets, test_dirs['source'], tee_buffer=4, tee_timeout=60) == [(0, [])] * 2
+    assert sorted(events) == [(targets[0][0].base_dir, 'tee'), (targets[1][0].base_dir, 'direct')]
+    for store, retain in targets:
+        assert current.diff(DirectoryMetadata(store)) == (set(), set())
+
+
+def test_upload_threads():
+    current = DirectoryMetadata(FSStore(test_dirs['source'], 'v_node0001/snap'), datetime.today())
+    events = []
+    targets = []
+    for name in ('threaded1', 'threaded2'):
+        os.makedirs(os.path.join(test_dirs['base'], name))
+        targets.append((ConcurrentFSStore(os.path.join(test_dirs['base'], name), 'v_node0001/snap', events), 2))
+
+    assert sync.backup_to_stores(current, targets, test_dirs['source'], upload_threads=5) == [(0, [])] * 2
+    for store, retain in targets:
+        assert store.most_running > 1
+        assert current.diff(DirectoryMetadata(store)) == (set(), set())
+    # The first file at least is teed to both stores, the rest are teed unless a store had work queued
+    assert len(events) == 2 * len(current.metadata)
+    assert len([event for event in events if event[1] == 'tee']) >= 2
+
+
+def test_slow_listing():
+    current = DirectoryMetadata(FSStore(test_dirs['source'], 'v_node0001/snap'), datetime.today())
+    events = []
+    targets = []
+    for name, store_class in (('listed', RecordingFSStore), ('slow_listing', SlowListingFSStore)):
+        os.makedirs(os.path.join(test_dirs['base'], name))
+        targets.append((store_class(os.path.join(test_dirs['base'], name), 'v_node0001/snap', events), 2))
+
+    # The store diffed first uploads everything while the other is still listing, which then catches up on its own
+    assert sync.backup_to_stores(current, targets, test_dirs['source']) == [(0, [])] * 2
+    listed = events.index((targets[1][0].base_dir, 'listed'))
+    assert len([event for event in events[:listed] if event[0] == targets[0][0].base_dir]) == len(current.metadata)
+    for store, retain in targets:
+        assert current.diff(DirectoryMetadata(store)) == (set(), set())
+
+
+def test_threaded_fsstore_upload():
+    store = FSStore(os.path.join(test_dirs['base'], 'threaded_fs'), 'v_node0001/snap')
+    source = os.path.join(test_dirs['source'], 'v_node0001', 'snap', 'data', 'file0')
+    go = threading.Event()
+    errors = []
+
+    # Every thread makes the same new directories at the same moment
+    def upload(index):
+        go.wait()
+        for depth in range(20):
+            dirs = ['d%d' % level for level in range(depth)]
+            relative_path = '/'.join(['v_node0001/snap'] + dirs + ['file%d' % index])
+            try:
+                with open(source, 'rb') as source_file:
+                    store.upload_file(relative_path, source_file, 200000)
+            except Exception, ex:
+                errors.append(ex)
+
+    threads = [threading.Thread(target=upload, args=(index,)) for index in range(8)]
+    for thread in threads:
+        thread.start()
+    go.set()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert len(store.get_metadata()) == 8 * 20
@@ -0,0 +1,32 @@
+""" Tests the shared utilities
+"""
+import threading
+import time
+
+from vertica_backup.utils import Slots, Throttle
+
+
+def test_throttle():
+    throttle = Throttle(1000)
+    start = time.time()
+    throttle.consume(1000)  # The first second's worth is allowed as a burst
+    assert time.time() - start < 0.1
+    throttle.consume(200)
+    assert 0.15 < time.time() - start < 0.5
+
+
+def test_slots():
+    slots = Slots(1)
+    order = []
+
+    def second():
+        with slots.hold():
+            order.append('second')
+    with slots.hold():
+        thread = threading.Thread(target=second)
+        thread.start()
+        time.sleep(0.1)
+        order.append('first')  # The second holder waits for the slot
+        slots.set_limit(2)
+        thread.join(1)
+    assert order == ['first', 'second']
@@ -0,0 +1,89 @@
+""" Tests verification of backups in a store and restored locally
+"""
+from datetime import datetime
+import os
+import shutil
+import tempfile
+import time
+
+from vertica_backup.directory_metadata import DirectoryMetadata
+from vertica_backup.epoch import EpochFiles
+from vertica_backup.object_store.fs import FSStore
+from vertica_backup.verify import CRITICAL, OK, verify_local, verify_store, WARNING
+
+work_dir = None
+
+
+def setup():
+    global work_dir
+    work_dir = tempfile.mkdtemp()
+    os.makedirs(os.path.join(work_dir, 'v_test_node0001', 'data'))
+    for index in range(10):
+        with open(os.path.join(work_dir, 'v_test_node0001', 'data', 'file%d' % index), 'w') as data_file:
+            data_file.write('data %d' % index)
+    DirectoryMetadata(FSStore(work_dir, 'v_test_node0001'), datetime(2014, 1, 1)).save(FSStore(work_dir, ''))
+
+
+def teardown():
+    shutil.rmtree(work_dir)
+
+
+def test_verify_local():
+    store = FSStore(work_dir, 'v_test_node0001')
+    verification = verify_local(store, '2014_01_01_0000.pickle', time.time() + 60, threads=4)
+    assert verification.status() == OK
+    assert verification.checked == 10
+
+    with open(os.path.join(work_dir, 'v_test_node0001', 'data', 'file3'), 'w') as data_file:
+        data_file.write('data X')  # Same size, different content
+    os.remove(os.path.join(work_dir, 'v_test_node0001', 'data', 'file4'))
+    verification = verify_local(store, '2014_01_01_0000.pickle', time.time() + 60, threads=4)
+    assert verification.status() == CRITICAL
+    assert len(verification.problems) == 2
+
+    # With no time left nothing is checked and the result is a warning
+    assert verify_local(store, '2014_01_01_0000.pickle', time.time() - 1).status() == WARNING
+
+
+def test_verify_store():
+    store = FSStore(work_dir, 'v_test_node0001')
+    os.remove(os.path.join(work_dir, 'v_test_node0001', 'data', 'file5'))
+    verification = verify_store(store, '2014_01_01_0000.pickle', time.time() + 60, sample=10)
+    assert verification.status() == CRITICAL
+    assert 'v_test_node0001/data/file5 is missing' in verification.problems
+
+
+def test_verify_restored():
+    """ A tree restored by restore_download has the epoch files back under their standard names. """
+    restore_dir = tempfile.mkdtemp()
+    try:
+        prefix_dir = os.path.join(restore_dir, 'v_test_node0001', 'snap')
+        snapshots_dir = os.path.join(prefix_dir, 'catalog', 'db', 'v_test_node0001_catalog', 'Snapshots')
+        os.makedirs(snapshots_dir)
+        for path in (os.path.join(prefix_dir, 'snap.txt'), os.path.join(prefix_dir, 'snap.info'),
+                     os.path.join(snapshots_dir, 'catalog.ctlg'), os.path.join(prefix_dir, 'data')):
+            with open(path, 'w') as epoch_file:
+                epoch_file.write(os.path.basename(path))
+        date = datetime(2014, 1, 1)
+        epoch_files = EpochFiles(prefix_dir, '/catalog/db', 'snap', date)
+        epoch_files.archive()
+        store = FSStore(restore_dir, 'v_test_node0001/snap')
+        DirectoryMetadata(store, date).save(store)
+        epoch_files.restore()
+
+        verification = verify_local(store, '2014_01_01_0000.pickle', time.time() + 60, 2, '/catalog/db', 'snap')
+        assert verification.status() == OK, verification.message()
+        assert verification.checked == 4
+
+        # Without the epoch file names the restored files look missing
+        assert len(verify_local(store, '2014_01_01_0000.pickle', time.time() + 60).problems) == 3
+    finally:
+        shutil.rmtree(restore_dir)
+
+
+def test_verify_store_deadline():
+    # The listing does not start once the time is up, the verification is incomplete rather than failed
+    store = FSStore(work_dir, 'v_test_node0001')
+    verification = verify_store(store, '2014_01_01_0000.pickle', time.time() - 1)
+    assert verification.status() == WARNING
+    assert verification.checked == 0
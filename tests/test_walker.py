@@ -0,0 +1,47 @@
+""" Tests the parallel directory walker against os.walk
+"""
+import os
+import shutil
+import tempfile
+
+from vertica_backup import walker
+
+
+def expected_files(base_dir, prefix):
+    found = {}
+    for dirpath, dirnames, filenames in os.walk(os.path.join(base_dir, prefix)):
+        for fname in filenames:
+            path = os.path.join(dirpath, fname)
+            found[os.path.relpath(path, base_dir)] = os.stat(path).st_size
+    return found
+
+
+def test_walk_files():
+    base_dir = tempfile.mkdtemp()
+    scandir = walker.scandir
+    try:
+        for index in range(50):
+            dir_path = os.path.join(base_dir, 'v_db_node0001', 'snap', 'data', str(index % 7), str(index % 3))
+            if not os.path.exists(dir_path):
+                os.makedirs(dir_path)
+            with open(os.path.join(dir_path, 'file%d' % index), 'w') as data_file:
+                data_file.write('x' * index)
+        with open(os.path.join(base_dir, 'v_db_node0001', 'snap', 'snap.txt'), 'w') as data_file:
+            data_file.write('epoch')
+        os.symlink('data', os.path.join(base_dir, 'v_db_node0001', 'snap', 'link'))  # Not followed, as os.walk
+        expected = expected_files(base_dir, 'v_db_node0001/snap')
+        assert len(expected) == 51
+
+        for use_scandir in (True, False):
+            if not use_scandir:
+                walker.scandir = None
+            for threads in (1, 4):
+                found = dict((path, stats.st_size) for path, stats in
+                             walker.walk_files(os.path.join(base_dir, 'v_db_node0001/snap'), 'v_db_node0001/snap',
+                                               threads))
+                assert found == expected
+
+        assert list(walker.walk_files(os.path.join(base_dir, 'missing'), 'missing')) == []
+    finally:
+        walker.scandir = scandir
+        shutil.rmtree(base_dir)
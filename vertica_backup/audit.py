@@ -0,0 +1,231 @@
+""" Audit that every node of a domain has a recent backup in swift.
+    The <domain>_<hostname> containers, and any containers named in the domain index, are listed concurrently for
+    their newest pickles. The result is one nagios status line with a line per node giving the age and size of its
+    newest backup and any problems, missing or stale backups and pickles much smaller or larger than the node's
+    previous one or the other nodes'.
+
+Copyright 2014 Hewlett-Packard Development Company, L.P.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software 
+and associated documentation files (the "Software"), to deal in the Software without restriction, 
+including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, 
+and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, 
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or 
+substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, 
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR 
+PURPOSE AND NONINFRINGEMENT.
+
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR 
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF 
+OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+import argparse
+from datetime import datetime
+import json
+import logging
+import socket
+import sys
+import time
+import yaml
+
+import swiftclient
+
+from object_store.swift import classify_error, index_container
+from object_store.swift_pool import get_pool, get_token_cache
+from retry import RetryPolicy
+from utils import run_parallel, sizeof_fmt
+
+log = logging.getLogger(__name__)
+
+OK = 0
+WARNING = 1
+CRITICAL = 2
+STATUS_NAMES = {OK: 'OK', WARNING: 'WARNING', CRITICAL: 'CRITICAL'}
+
+
+class NodeAudit(object):
+    """ The newest backups found for one node's container and the problems with them.
+        pickles is a list of (name, bytes) newest first, problems a list of (status, kind, message).
+    """
+    def __init__(self, container, vnode=None):
+        self.container = container
+        self.vnode = vnode
+        self.pickles = []
+        self.problems = []
+
+    def __str__(self):
+        if self.vnode is None:
+            return self.container
+        return '%s (%s)' % (self.vnode, self.container)
+
+    def problem(self, status, kind, message):
+        self.problems.append((status, kind, message))
+
+    def status(self):
+        return max([status for status, kind, message in self.problems] or [OK])
+
+    def kinds(self):
+        return set(kind for status, kind, message in self.problems)
+
+    def age(self, now):
+        """ Hours since the newest backup, None without one. """
+        if len(self.pickles) == 0:
+            return None
+        return (now - datetime.strptime(self.pickles[0][0][:15], '%Y_%m_%d_%H%M')).total_seconds() / 3600
+
+    def detail(self, now):
+        if len(self.pickles) == 0:
+            msg = '%s %s: no backup' % (STATUS_NAMES[self.status()], self)
+        else:
+            msg = '%s %s: newest %s, %.1f hours old, pickle %s' % (STATUS_NAMES[self.status()], self,
+                                                                  self.pickles[0][0], self.age(now),
+                                                                  sizeof_fmt(self.pickles[0][1]))
+        if len(self.problems) > 0:
+            msg += ', ' + '; '.join(message for status, kind, message in self.problems)
+        return msg
+
+
+def _call(pool, retry_policy, description, method, *args, **kwargs):
+    """ Call the named method of a pooled swift connection with the retry policy. """
+    def attempt():
+        with pool.connection() as conn:
+            return getattr(conn, method)(*args, **kwargs)
+
+    return retry_policy.call(description, attempt)
+
+
+def domain_containers(pool, retry_policy, domain, threads=32):
+    """ Return a dictionary of container to vertica node name, None where the node is not known, for the
+        <domain>_<hostname> containers and those in the domain index. Nodes from index entries with a snapshot are
+        named <vnode>/<snapshot_name>.
+    """
+    containers = dict((container['name'], None) for container in
+                      _call(pool, retry_policy, 'listing account', 'get_account', prefix=domain + '_',
+                            full_listing=True)[1])
+    try:
+        names = [entry['name'] for entry in _call(pool, retry_policy, 'listing the domain index', 'get_container',
+                                                  index_container(domain), full_listing=True)[1]]
+    except swiftclient.ClientException, ex:
+        if ex.http_status != 404:
+            raise
+        names = []
+
+    def lookup(name):
+        return json.loads(_call(pool, retry_policy, 'index lookup for %s' % name, 'get_object',
+                                index_container(domain), name)[1])
+
+    entries = run_parallel(lookup, names, threads)
+    # Sorted so an entry with a snapshot replaces the older vnode only entry for the same container
+    for name in sorted(entries):
+        entry = entries[name]
+        if isinstance(entry, Exception):
+            log.error('Error reading the domain index entry for %s: %s' % (name, entry))
+            continue
+        containers[entry.get('container') or '%s_%s' % (domain, entry['hostname'])] = name
+    return containers
+
+
+def list_backups(pool, retry_policy, container):
+    """ Return (name, bytes) of the pickles in the root of container, newest first. """
+    listing = _call(pool, retry_policy, 'listing %s' % container, 'get_container', container, delimiter='/',
+                    full_listing=True)[1]
+    pickles = [(entry['name'], entry['bytes']) for entry in listing
+               if 'name' in entry and entry['name'].endswith('.pickle')]
+    pickles.sort(reverse=True)
+    return pickles
+
+
+def _outside(size, reference, ratio):
+    return reference > 0 and (size * ratio < reference or size > reference * ratio)
+
+
+def audit_domain(pool, retry_policy, domain, threads=32, warning_age=26, critical_age=50, size_ratio=2.0,
+                 now=None):
+    """ List the newest backups of every node in the domain concurrently, returning a NodeAudit for each container.
+        A backup older than warning_age or critical_age hours is a problem of that status. A newest pickle more than
+        size_ratio times smaller or larger than the node's previous pickle, or the median of the nodes, is a warning.
+    """
+    if now is None:
+        now = datetime.today()
+    containers = domain_containers(pool, retry_policy, domain, threads)
+    audits = [NodeAudit(container, vnode) for container, vnode in containers.iteritems()]
+
+    def fetch(audit):
+        audit.pickles = list_backups(pool, retry_policy, audit.container)
+
+    for audit, error in run_parallel(fetch, audits, threads).iteritems():
+        if isinstance(error, swiftclient.ClientException) and error.http_status == 404:
+            audit.problem(CRITICAL, 'missing', 'container not found')
+        elif isinstance(error, Exception):
+            audit.problem(CRITICAL, 'missing', 'error listing the container: %s' % error)
+
+    sizes = sorted(audit.pickles[0][1] for audit in audits if len(audit.pickles) > 0)
+    median = sizes[len(sizes) // 2] if len(sizes) >= 3 else 0
+    for audit in audits:
+        if len(audit.pickles) == 0:
+            if len(audit.problems) == 0:
+                audit.problem(CRITICAL, 'missing', 'no backup found')
+            continue
+        age = audit.age(now)
+        if age > critical_age:
+            audit.problem(CRITICAL, 'stale', 'older than %d hours' % critical_age)
+        elif age > warning_age:
+            audit.problem(WARNING, 'stale', 'older than %d hours' % warning_age)
+        size = audit.pickles[0][1]
+        if len(audit.pickles) > 1 and _outside(size, audit.pickles[1][1], size_ratio):
+            audit.problem(WARNING, 'size', 'pickle was %s in the previous backup' % sizeof_fmt(audit.pickles[1][1]))
+        if _outside(size, median, size_ratio):
+            audit.problem(WARNING, 'size', 'pickle differs from the median of %s' % sizeof_fmt(median))
+    return audits
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check every node in a domain has a recent backup in swift.')
+    parser.add_argument('config', help='The backup config file with the swift credentials')
+    parser.add_argument('domain', nargs='?', help='The domain to audit, by default the domain of this host')
+    parser.add_argument('--threads', type=int, help='Concurrent swift requests, default audit_threads')
+    args = parser.parse_args(argv)
+
+    config = yaml.load(open(args.config, 'r'))
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.WARNING)
+    domain = args.domain or socket.getfqdn().split('.', 1)[1]
+    threads = args.threads or config.get('audit_threads', 32)
+    expected = config.get('audit_nodes')
+    start = time.time()
+
+    try:
+        token_cache = get_token_cache(config)
+        pool = get_pool(config['swift_url'], config['swift_user'], config['swift_key'], config['swift_tenant'],
+                        config['swift_region'], token_cache, threads)
+        retry_policy = RetryPolicy(config.get('retry_attempts', 5), max_delay=config.get('retry_max_delay', 120),
+                                   classifier=classify_error)
+        now = datetime.today()
+        audits = audit_domain(pool, retry_policy, domain, threads, config.get('audit_warning_age', 26),
+                              config.get('audit_critical_age', 50), config.get('audit_size_ratio', 2.0), now)
+    except Exception, ex:
+        log.exception('Error auditing %s' % domain)
+        print 'CRITICAL: Audit of %s failed with an error: %s' % (domain, ex)
+        return CRITICAL
+
+    status = max([audit.status() for audit in audits] or [OK])
+    counts = dict((kind, len([audit for audit in audits if kind in audit.kinds()]))
+                  for kind in ('missing', 'stale', 'size'))
+    msg = '%d nodes in %s, %d missing, %d stale, %d size anomalies' % (len(audits), domain, counts['missing'],
+                                                                       counts['stale'], counts['size'])
+    if expected is not None and len(audits) < expected:
+        status = CRITICAL
+        msg += ', %d nodes expected' % expected
+    print '%s: %s|duration=%.1fs nodes=%d missing=%d stale=%d anomalies=%d' % (
+        STATUS_NAMES[status], msg, time.time() - start, len(audits), counts['missing'], counts['stale'],
+        counts['size'])
+    for audit in sorted(audits, key=lambda audit: (-audit.status(), str(audit))):
+        print audit.detail(now)
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
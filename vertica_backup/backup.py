@@ -25,138 +25,410 @@ OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
 from datetime import datetime
+import fcntl
 import logging
 import os
 import requests.packages.urllib3
+import socket
 import subprocess
 import sys
 import time
 import yaml
 
+from budget import UploadBudget
 from directory_metadata import DirectoryMetadata
 from epoch import EpochFiles
+from expiry import ExpiryPolicy
 from object_store.fs import FSStore
 from object_store.swift import SwiftStore
-from utils import calculate_paths, delete_pickles, LogTime, sizeof_fmt
+from metrics import run_metrics, write_atomic, write_run_metrics
+from object_store.swift_pool import get_pool, get_token_cache, record_pool_stats, reset_pools
+import plan
+from profiling import run_profiler
+from progress import run_progress
+from retry import RetryPolicy
+import sync
+from utils import calculate_paths, delete_pickles, LogTime, Throttle
 
 log = logging.getLogger(__name__)
 vbr_bin = '/opt/vertica/bin/vbr.py'
 
+# Counters from the run metrics included in the nagios perfdata
+PERFDATA_COUNTERS = ('bytes_uploaded', 'objects_uploaded', 'objects_skipped', 'objects_deleted', 'objects_failed',
+                     'retries', 'hash_cache_hits', 'hash_cache_misses')
 
-def nagios_exit(exit_status, msg, duration, warn):
-    """ Exit in a format fitting for a nagios plugin.
-        Backup failure isn't considered critical so only exit good or warning.
+# Written to the tier by the drain, the name of the newest backup drained to every offsite store
+DRAINED_NAME = 'drained'
+
+
+class VbrError(Exception):
+    """ Raised when the vbr backup fails, the message includes its output. """
+    pass
+
+
+def nagios_status(exit_status, msg, duration, warn, warning=False):
+    """ Return the nagios exit code and status line for a backup.
+        Backup failure isn't considered critical so only good or warning.
+        Setting warning reports a warning regardless of the duration.
     """
     if exit_status != 0:
-        print "ERROR: Backup Failed! Exit status %d! %s" % (exit_status, msg)
-        sys.exit(1)
-    elif duration > warn:
-        print "WARNING: " + msg
-        sys.exit(1)
+        return 1, "ERROR: Backup Failed! Exit status %d! %s" % (exit_status, msg)
+    elif warning or (duration > warn):
+        return 1, "WARNING: " + msg
     else:
-        print "OK: " + msg
-        sys.exit(0)
+        return 0, "OK: " + msg
 
 
 def run_vbr(config):
-    """ Run the vbr command according to the values in the configuration.
+    """ Run the vbr command according to the values in the configuration, raising a VbrError if it fails.
     """
-    output = None
     try:
         vbr_command = [vbr_bin, '--config-file', config['vbr_config'], '--task', 'backup']
         os.environ['LANG'] = 'en_US.UTF-8'  # vbr requires this to be set
         log.info('Running vbr command: %s' % vbr_command)
         output = subprocess.check_output(vbr_command, stderr=subprocess.STDOUT)
     except subprocess.CalledProcessError, cpe:
-        nagios_exit(cpe.returncode, "vbr run failed\n%s" % cpe.output, 0, config['warning'])
+        raise VbrError("vbr run failed with exit status %d\n%s" % (cpe.returncode, cpe.output))
 
     # Turns out vbr is not always good about a failed exit code
     for line in output.splitlines():
         if line == 'backup failed!':
-            nagios_exit(2, "vbr run failed\n%s" % output, 0, config['warning'])
+            raise VbrError("vbr run failed\n%s" % output)
 
 
-def main(argv=None):
-    if argv is None:
-        argv = sys.argv
-    if len(argv) != 2:
-        print "Usage: " + argv[0] + " <config file> "
+def get_swift_store(config, prefix_dir, throttle=None, slots=None, read_only=False):
+    """ Return a SwiftStore built from the swift settings in the config, with transfers limited by the throttle and
+        uploads by the slots if given. A read_only store does not create its container.
+    """
+    retry_policy = RetryPolicy(config.get('retry_attempts', 5), max_delay=config.get('retry_max_delay', 120))
+    token_cache = get_token_cache(config)
+    pool = get_pool(config['swift_url'], config['swift_user'], config['swift_key'], config['swift_tenant'],
+                    config['swift_region'], token_cache, config.get('pool_size', 8))
+    return SwiftStore(config['swift_key'], config['swift_region'], config['swift_tenant'],
+                      config['swift_url'], config['swift_user'], prefix_dir, retry_policy=retry_policy, pool=pool,
+                      throttle=throttle, container=config.get('swift_container'), slots=slots, read_only=read_only)
+
+
+def get_stores(config, prefix_dir, throttle=None, slots=None, read_only=False):
+    """ Return a list of (store, retain) for each store listed in the config.
+        Each entry in the optional stores list overrides the top level swift settings and retain. An entry with
+        type fs is an FSStore at path. Without a stores list the top level swift settings define the only store.
+        Transfers to all the swift stores share the throttle and uploads the slots if given.
+        With read_only set missing containers and directories are not created.
+    """
+    targets = []
+    for entry in config.get('stores', [{}]):
+        settings = dict(config)
+        settings.update(entry)
+        if settings.get('type', 'swift') == 'fs':
+            if not read_only and not os.path.exists(settings['path']):
+                os.makedirs(settings['path'])
+            store = FSStore(settings['path'], prefix_dir)
+        else:
+            store = get_swift_store(settings, prefix_dir, throttle, slots, read_only)
+        targets.append((store, settings['retain']))
+    return targets
+
+
+def snapshot_configs(config):
+    """ Return a config for each snapshot to back up.
+        Each entry in the optional snapshots list overrides the top level settings, typically dbname, snapshot_name,
+        vbr_config and retain. Without a snapshots list the config describes the only snapshot.
+    """
+    snapshots = []
+    for entry in config.get('snapshots', [{}]):
+        settings = dict(config)
+        settings.update(entry)
+        settings.pop('snapshots', None)
+        snapshots.append(settings)
+    return snapshots
+
+
+def metrics_labels(config):
+    """ Return the labels telling apart the exported run metrics of each snapshot. """
+    return {'dbname': config['dbname'], 'snapshot': config['snapshot_name']}
+
+
+def store_roots(config):
+    """ Return identifiers for the roots of the local backup dir and each store in the config.
+        The pickles are kept in these roots so snapshots backed up together must not share any.
+    """
+    roots = [('fs', os.path.realpath(config['backup_dir']))]
+    for entry in config.get('stores', [{}]):
+        settings = dict(config)
+        settings.update(entry)
+        if settings.get('type', 'swift') == 'fs':
+            roots.append(('fs', os.path.realpath(settings['path'])))
+        else:
+            roots.append(('swift', settings['swift_url'], settings['swift_tenant'], settings['swift_region'],
+                          settings.get('swift_container')))
+    if config.get('tier_dir') is not None:
+        roots.append(('fs', os.path.realpath(config['tier_dir'])))
+    return roots
+
+
+def shared_roots(snapshots):
+    """ Return the indexes of the snapshot configs with a store root in common with an earlier one. """
+    seen = set()
+    conflicts = []
+    for index, snapshot_config in enumerate(snapshots):
+        roots = set(store_roots(snapshot_config))
+        if len(roots & seen) > 0:
+            conflicts.append(index)
+        seen.update(roots)
+    return conflicts
+
+
+def get_throttle(config):
+    """ Return a Throttle for the backup_bandwidth in the config or None if it is not set. """
+    if config.get('backup_bandwidth') is None:
+        return None
+    return Throttle(config['backup_bandwidth'])
+
+
+def get_budget(config, node=None):
+    """ Return an UploadBudget for the budget_concurrency and budget_bandwidth in the config, None if neither is set.
+        The leases are kept in budget_dir if set, otherwise in the swift budget_container which defaults to
+        <domain>-budget. The node defaults to this host's name. If the lease store can't be set up the error is logged
+        and None returned so the backup runs without the budget.
+    """
+    if config.get('budget_concurrency') is None and config.get('budget_bandwidth') is None:
+        return None
+    hostname, domain = socket.getfqdn().split('.', 1)
+    try:
+        if config.get('budget_dir') is not None:
+            if not os.path.exists(config['budget_dir']):
+                os.makedirs(config['budget_dir'])
+            store = FSStore(config['budget_dir'], '')
+        else:
+            settings = dict(config)
+            settings['swift_container'] = config.get('budget_container', domain + '-budget')
+            store = get_swift_store(settings, '')
+    except Exception:
+        log.exception('Error setting up the upload budget lease store, uploading without the budget')
+        return None
+    return UploadBudget(store, node or hostname, config.get('budget_concurrency'), config.get('budget_bandwidth'),
+                        config.get('budget_interval', 30), config.get('budget_ttl', 120),
+                        config.get('backup_bandwidth'))
+
+
+def backup_to_stores(config, current_metadata, targets, base_dir, budget=None):
+    """ Run the backup from base_dir to all targets, updating the domain index of each swift store it succeeded for.
+        With retention_mode expire, retention in the swift stores is left to object expiration.
+        If an upload budget is given its lease is held for the duration.
+        Returns an exit status and a list describing each store which failed or had objects which failed.
+    """
+    exit_status = 0
+    failed = []
+    expiry = None
+    if config.get('retention_mode', 'delete') == 'expire':
+        expiry = ExpiryPolicy(config.get('expire_interval', 86400), config.get('expire_grace', 1),
+                              config.get('expire_threads', 8), config.get('expire_lag', 86400),
+                              config.get('expire_margin', 3600))
+    if budget is not None:
+        budget.start()
+    try:
+        results = sync.backup_to_stores(current_metadata, targets, base_dir,
+                                        config.get('tee_buffer', 256), config.get('tee_timeout', 60), expiry,
+                                        config.get('upload_threads', 1), config.get('upload_first', []),
+                                        config.get('upload_last', []))
+    finally:
+        if budget is not None:
+            budget.release()
+    for (store, retain), (status, failures) in zip(targets, results):
+        if status == 0 and isinstance(store, SwiftStore):
+            try:
+                store.update_index()
+            except Exception:
+                log.exception('Error updating the domain index in %s' % store)
+        if status != 0:
+            exit_status = 1
+        if len(failures) > 0:
+            log.error('Operations on %s which failed after retries:\n%s' % (store, '\n'.join(failures)))
+            failed.append('%s (%d failed objects)' % (store, len(failures)))
+        elif status != 0:
+            failed.append(str(store))
+    return exit_status, failed
+
+
+def count_undrained(tier_store):
+    """ Return the number of backups in the local tier newer than the last one drained to every offsite store, as
+        recorded by the drain in the tier, or all of them if none is recorded. Only the tier is read, so the local
+        backup never waits on the offsite stores.
+    """
+    tier_pickles = tier_store.list_pickles()
+    try:
+        with tier_store.open(DRAINED_NAME, 'r') as drained_file:
+            drained = drained_file.read().strip()
+    except IOError:
+        return len(tier_pickles)
+    return len([name for name in tier_pickles if name > drained])
+
+
+def tier_retention(config, tier_store):
+    """ Return the number of backups to retain in the local tier and how many of those are not yet drained offsite.
+        The tier_retain setting is raised so the new backup and every undrained one are kept for the drain.
+    """
+    undrained = count_undrained(tier_store)
+    return max(config.get('tier_retain', config['retain']), undrained + 1), undrained
+
+
+def drain(config, tier_dir, prefix_dir):
+    """ Upload the newest backup in the local tier to the offsite stores, applying their retention.
+        Only one drain runs at a time, a drain started while another is running waits for it and then uploads
+        whatever is newest in the tier at that point.
+        Returns an exit status, 0 for success.
+    """
+    lock_file = open(os.path.join(config['log_dir'], 'backup_drain.lock'), 'w')
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    try:
+        tier_store = FSStore(tier_dir, prefix_dir)
+
+        tier_metadata = DirectoryMetadata.load_pickle(tier_store)
+        if tier_metadata is None:
+            log.error('No backup found in the local tier %s to drain.' % tier_dir)
+            return 1
+        pickle_name = tier_metadata.date.strftime("%Y_%m_%d_%H%M") + '.pickle'
+        budget = get_budget(config, socket.getfqdn().split('.', 1)[0] + '-drain')
+        throttle = get_throttle(config)
+        if budget is not None and budget.throttle is not None:
+            throttle = budget.throttle
+        slots = budget.slots if budget is not None else None
+        targets = [(store, retain) for store, retain in get_stores(config, prefix_dir, throttle, slots)
+                   if pickle_name not in store.list_pickles()]
+        if len(targets) == 0:
+            log.info('Offsite drain skipped, %s is already complete offsite.' % pickle_name)
+            write_atomic(os.path.join(tier_dir, DRAINED_NAME), pickle_name)
+            return 0
+
+        with LogTime(log.info, "Offsite drain of %s completed" % pickle_name, phase='total'):
+            exit_status, failed = backup_to_stores(config, tier_metadata, targets, tier_dir, budget)
+        if exit_status == 0:
+            write_atomic(os.path.join(tier_dir, DRAINED_NAME), pickle_name)
+        else:
+            log.error('Offsite drain of %s failed for %s' % (pickle_name, ', '.join(failed)))
+        record_pool_stats()
+        write_run_metrics(os.path.join(config['log_dir'], 'backup_drain.json'), config.get('prometheus_textfile_dir'),
+                          'vertica_backup_drain', metrics_labels(config))
+        return exit_status
+    except Exception:
+        log.exception('Unhandled Exception in offsite drain')
         return 1
+    finally:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
 
-    requests.packages.urllib3.disable_warnings()
-    config_file = argv[1]
-    config = yaml.load(open(config_file, 'r'))
 
-    # Setup logging
-    log_path = os.path.join(config['log_dir'], 'backup_' + datetime.today().strftime('%A') + '.log')
-    logging.basicConfig(format='%(asctime)s %(message)s', filename=log_path, level=logging.INFO)
+def start_drain(config, tier_dir, prefix_dir):
+    """ Fork a background process which drains the local tier offsite, returning its pid in the parent.
+    """
+    pid = os.fork()
+    if pid != 0:
+        return pid
+
+    # The child detaches from the cron job so that job can finish and report the local status
+    os.setsid()
+    reset_pools()
+    run_metrics.reset()
+    if run_profiler.enabled:  # The sampler thread did not survive the fork, start a separate profile
+        run_profiler.stop()
+        run_profiler.start(config['log_dir'], 'backup_drain', config.get('profile_interval', 10))
+    run_progress.start(os.path.join(config['log_dir'], 'backup_drain_progress.json'), config.get('progress_interval', 5))
+    exit_status = 1
+    try:
+        exit_status = drain(config, tier_dir, prefix_dir)
+    finally:
+        run_profiler.stop()
+        logging.shutdown()
+        os._exit(exit_status)
 
+
+def plan_backup(config):
+    """ Print what a backup would upload to and delete from each store and estimate how long it would take, without
+        running vbr or transferring anything. The stores are opened read only, one not yet created is planned as
+        empty. Returns an exit status.
+    """
+    base_dir, prefix_dir = calculate_paths(config)
+    local_metadata = DirectoryMetadata(FSStore(base_dir, prefix_dir, hash_files=False))
+    tier_dir = config.get('tier_dir')
+    if tier_dir is None:
+        targets = get_stores(config, prefix_dir, read_only=True)
+    else:
+        targets = [(FSStore(tier_dir, prefix_dir), config.get('tier_retain', config['retain']))]
+
+    entries = []
+    for store, retain in targets:
+        if store.exists():
+            store_metadata = DirectoryMetadata(store)
+            to_del = plan.estimate_retention(store, store_metadata, retain)
+            upload_rate, delete_rate = plan.history_rates(store)
+        else:
+            print '%s does not exist yet, the first backup creates it.' % store
+            store_metadata = DirectoryMetadata()
+            to_del = set()
+            upload_rate, delete_rate = None, None
+        to_add = plan.estimate_diff(local_metadata, store_metadata)[0]
+        entries.append(plan.plan_entry(store, 'upload', to_add, local_metadata, upload_rate))
+        entries.append(plan.plan_entry(store, 'delete', to_del, store_metadata, delete_rate, unit='objects'))
+
+    plan.print_plan(entries)
+    if len(targets) > 1:
+        print 'Stores are uploaded to concurrently so the total is an upper bound.'
+    if tier_dir is not None:
+        print 'Tiered mode, the offsite drain from %s is not included.' % tier_dir
+    return 0
+
+
+def backup_snapshot(config, hash_cache=None, throttle=None, budget=None):
+    """ Run vbr for the snapshot then back it up to its stores, or the local tier.
+        The hash_cache, throttle and upload budget are shared by all the snapshots backed up in a run.
+        Returns the exit status, status message, duration in minutes and whether to warn regardless of the duration.
+    """
     # log_time is not used here so the timing can be reported to nagios
     start = time.time()
     exit_status = 0
     epoch_files = None
+    tier_dir = config.get('tier_dir')
+    undrained = 0
+    failed = []
 
     # Run the vbr backup command - The vbr run is quite fast typically completing in less than a minute
     if config['run_vbr']:
-        run_vbr(config)  # If this fails it will sys.exit with an appropriately bad nagios error
+        try:
+            with LogTime(log.info, "vbr completed", seconds=True, phase='vbr'):
+                run_vbr(config)
+        except VbrError, ex:
+            log.error(str(ex))
+            return 1, str(ex), (time.time() - start) / 60, False
 
     try:
         catalog_dir = config['catalog_dir']
         base_dir, prefix_dir = calculate_paths(config)
-        swift_store = SwiftStore(config['swift_key'], config['swift_region'], config['swift_tenant'],
-                                 config['swift_url'], config['swift_user'], prefix_dir)
-        fs_store = FSStore(base_dir, prefix_dir)
+        fs_store = FSStore(base_dir, prefix_dir, hash_cache=hash_cache, walk_threads=config.get('walk_threads', 1))
         upload_time = datetime.today()
 
         epoch_files = EpochFiles(os.path.join(base_dir, prefix_dir), catalog_dir, config['snapshot_name'], upload_time)
         epoch_files.archive()
 
-        # Grab the local and swift metadata
+        # Grab the local metadata
         current_metadata = DirectoryMetadata(fs_store, upload_time)
         current_metadata.save(fs_store)
-        swift_metadata = DirectoryMetadata(swift_store)
-
-        # Compare the files in the current backup and swift and upload as necessary, then delete as necessary
-        with LogTime(log.debug, "Diff operation completed", seconds=True):
-            to_add, do_not_del = current_metadata.diff(swift_metadata)
-
-        size_uploaded = 0
-        with LogTime(log.info, "Uploaded Completed"):
-            for relative_path in to_add:
-                size_uploaded += swift_store.upload(relative_path, base_dir)
-        log.info("\tUploaded %s in %d items" % (sizeof_fmt(size_uploaded), len(to_add)))
-
-        with LogTime(log.info, "Determining items to delete, retaining %d backups" % config['retain']):
-            # Grab the pickle names I want to combine, relying on these being in order by date, newest first
-            pickles = swift_store.list_pickles()
-            combine_pickles = pickles[:config['retain']]
-
-            # Take metadata in all these pickles combine.
-            # It would be good to check that there is no overlap in filenames with different content.
-            combined_metadata = DirectoryMetadata()
-            for pickle in combine_pickles:
-                pickle_metadata = DirectoryMetadata.load_pickle(swift_store, pickle)
-                combined_metadata.metadata.update(pickle_metadata.metadata)
-
-            # Do a diff with all that is in swift, anything in swift but not in the combined set can be deleted.
-            should_be_empty, to_del = combined_metadata.diff(swift_metadata)
-            if len(should_be_empty) != 0:
-                exit_status = 1
-                log.error(
-                    "ERROR: Found files in the %d combined retained backups that were not in swift.\n%s"
-                    % (config['retain'], should_be_empty)
-                )
-
-        with LogTime(log.info, "Deleted %d items" % len(to_del)):
-            for relative_path in to_del:
-                swift_store.delete(relative_path)
-
-        # Upload today's metadata pickle, this is done last so its presence an indication the backup is done.
-        current_metadata.save(swift_store)
+
+        if tier_dir is None:
+            targets = get_stores(config, prefix_dir, throttle, budget.slots if budget is not None else None)
+            exit_status, failed = backup_to_stores(config, current_metadata, targets, base_dir, budget)
+        else:
+            # Tiered mode, the backup is completed to the local tier and then drained to swift in the background.
+            # Backups not yet drained are always retained in the tier so the drain can finish them. The offsite
+            # stores are only opened by the drain, so the local backup completes even with swift unreachable.
+            if not os.path.exists(tier_dir):
+                os.makedirs(tier_dir)
+            tier_store = FSStore(tier_dir, prefix_dir)
+            tier_retain, undrained = tier_retention(config, tier_store)
+            exit_status, failed = backup_to_stores(config, current_metadata, [(tier_store, tier_retain)], base_dir)
 
         #Clean up old pickles
         delete_pickles(fs_store)
-        delete_pickles(swift_store, config['retain'])
 
     except Exception:
         log.exception('Unhandled Exception in Backup upload')
@@ -165,14 +437,112 @@ def main(argv=None):
             epoch_files.restore()
         exit_status = 1
 
-    # Status message and exit
+    record_pool_stats()
+
+    # Status message
     stop = time.time()
+    run_metrics.phase('total', stop - start)
     duration = (stop - start) / 60
-    duration_msg = "Backup completed in %d minutes total. Thresholds, warn %d.|%d" % \
-                   (duration, config['warning'], duration)
-    log.info(duration_msg)
+    if tier_dir is None:
+        duration_msg = "Backup completed in %d minutes total. Thresholds, warn %d." % (duration, config['warning'])
+    else:
+        if exit_status == 0:
+            drain_pid = start_drain(config, tier_dir, prefix_dir)
+            log.info("Started offsite drain in process %d" % drain_pid)
+        if undrained == 0:
+            offsite_msg = "offsite complete for the previous backup"
+        else:
+            offsite_msg = "offsite drain behind by %d backups" % undrained
+        duration_msg = "Snapshot safe locally in %d minutes total, %s. Thresholds, warn %d." % \
+                       (duration, offsite_msg, config['warning'])
+    if len(failed) > 0:
+        duration_msg = "Problems with %s. " % ', '.join(failed) + duration_msg
+    # A drain that has not caught up with the previous backup is reported as a warning
+    return exit_status, duration_msg, duration, undrained > 0
 
-    nagios_exit(exit_status, duration_msg, duration, config['warning'])
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    args = [arg for arg in argv[1:] if arg != '--plan']
+    if len(args) != 1:
+        print "Usage: " + argv[0] + " [--plan] <config file> "
+        print "With --plan the transfers a backup would do and their duration are estimated without running it"
+        return 1
+
+    requests.packages.urllib3.disable_warnings()
+    config_file = args[0]
+    config = yaml.load(open(config_file, 'r'))
+    snapshots = snapshot_configs(config)
+
+    if len(args) != len(argv) - 1:
+        logging.basicConfig(format='%(asctime)s %(message)s', level=logging.WARNING)
+        for snapshot_config in snapshots:
+            if len(snapshots) > 1:
+                print '%s/%s:' % (snapshot_config['dbname'], snapshot_config['snapshot_name'])
+            plan_backup(snapshot_config)
+        return 0
+
+    # Setup logging
+    log_path = os.path.join(config['log_dir'], 'backup_' + datetime.today().strftime('%A') + '.log')
+    logging.basicConfig(format='%(asctime)s %(message)s', filename=log_path, level=logging.INFO)
+
+    if config.get('profile', False):
+        run_profiler.start(config['log_dir'], 'backup', config.get('profile_interval', 10))
+    run_progress.start(config.get('progress_file', os.path.join(config['log_dir'], 'backup_progress.json')),
+                       config.get('progress_interval', 5))
+
+    # Snapshots are backed up one after another sharing the swift connections, hash cache and bandwidth budget,
+    # each has its own pickle, run metrics and status.
+    hash_cache = {}
+    throttle = get_throttle(config)
+    budget = get_budget(config)
+    if budget is not None and budget.throttle is not None:
+        throttle = budget.throttle
+    statuses = []
+    conflicts = shared_roots(snapshots)
+    for index, snapshot_config in enumerate(snapshots):
+        name = '%s_%s' % (snapshot_config['dbname'], snapshot_config['snapshot_name'])
+        if index in conflicts:
+            msg = 'The backup dir or a store of snapshot %s is already used by another snapshot, set its own ' \
+                  'backup_dir, stores or swift_container.' % name
+            log.error(msg)
+            statuses.append((name, nagios_status(1, msg, 0, snapshot_config['warning'])))
+            continue
+        metrics_path = os.path.splitext(log_path)[0] + '.json'
+        prometheus_name = 'vertica_backup'
+        if len(snapshots) > 1:
+            log.info('Backing up snapshot %s of database %s' %
+                     (snapshot_config['snapshot_name'], snapshot_config['dbname']))
+            run_metrics.reset()
+            metrics_path = os.path.splitext(log_path)[0] + '_%s.json' % name
+            prometheus_name += '_' + name
+
+        exit_status, msg, duration, warning = backup_snapshot(snapshot_config, hash_cache, throttle, budget)
+        msg += "|%d %s" % (duration, run_metrics.perfdata(PERFDATA_COUNTERS))
+        log.info(msg)
+        try:
+            write_run_metrics(metrics_path, snapshot_config.get('prometheus_textfile_dir'), prometheus_name,
+                              metrics_labels(snapshot_config))
+        except Exception:
+            log.exception('Error writing the run metrics')
+        statuses.append((name, nagios_status(exit_status, msg, duration, snapshot_config['warning'], warning)))
+    run_profiler.stop()
+
+    if len(statuses) == 1:
+        code, status = statuses[0][1]
+        print status
+        sys.exit(code)
+
+    # Several snapshots are summarized on the first line with each snapshot's own status as the long output
+    problems = [name for name, (code, status) in statuses if code != 0]
+    if len(problems) > 0:
+        print "WARNING: Problems with %d of %d snapshots, %s" % (len(problems), len(statuses), ', '.join(problems))
+    else:
+        print "OK: All %d snapshots backed up" % len(statuses)
+    for name, (code, status) in statuses:
+        print "%s %s" % (name, status.split('|')[0])
+    sys.exit(1 if len(problems) > 0 else 0)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,151 @@
+""" A domain wide upload budget shared by the nodes backing up at the same time.
+    Each node uploading holds a lease object in a store every node can reach, a swift container or a shared filesystem
+    path, and takes its share of the total concurrency and bandwidth among the unexpired leases. A node releases its
+    lease when its uploads are done so those still uploading take over its share.
+
+Copyright 2014 Hewlett-Packard Development Company, L.P.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software 
+and associated documentation files (the "Software"), to deal in the Software without restriction, 
+including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, 
+and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, 
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or 
+substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, 
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR 
+PURPOSE AND NONINFRINGEMENT.
+
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR 
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF 
+OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+import json
+import logging
+import threading
+import time
+
+from metrics import run_metrics
+from utils import Slots, Throttle
+
+log = logging.getLogger(__name__)
+
+LEASE_SUFFIX = '.lease'
+
+
+class UploadBudget(object):
+    """ Limits this node's uploads to its share of a budget split evenly between the nodes holding a lease.
+        The lease is refreshed every interval seconds and lapses after ttl seconds, so a node which dies stops
+        counting against the others within ttl. Leases are compared using each node's own clock, the skew between
+        nodes should be well under ttl.
+        concurrency is the total of simultaneous uploads and bandwidth the total bytes per second for the domain,
+        either can be None for no limit. node_bandwidth caps this node's share of the bandwidth.
+    """
+    def __init__(self, store, node, concurrency=None, bandwidth=None, interval=30, ttl=120, node_bandwidth=None):
+        self.store = store
+        self.node = node
+        self.concurrency = concurrency
+        self.bandwidth = bandwidth
+        self.interval = interval
+        self.ttl = ttl
+        self.node_bandwidth = node_bandwidth
+
+        self.slots = None
+        if concurrency is not None:
+            self.slots = Slots(concurrency)
+        self.throttle = None
+        if bandwidth is not None:
+            self.throttle = Throttle(self._bandwidth_share(1))
+        self.nodes = [node]
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def __str__(self):
+        return '%s in %s' % (self.node + LEASE_SUFFIX, self.store)
+
+    def _bandwidth_share(self, node_count):
+        share = float(self.bandwidth) / node_count
+        if self.node_bandwidth is not None:
+            share = min(share, self.node_bandwidth)
+        return share
+
+    def _concurrency_share(self):
+        """ An even split of the concurrency, the remainder going to the first nodes by name. Every node gets at
+            least one slot so none is starved when there are more nodes than the concurrency.
+        """
+        count = len(self.nodes)
+        extra = 1 if self.nodes.index(self.node) < self.concurrency % count else 0
+        return max(1, self.concurrency // count + extra)
+
+    def active_nodes(self, now):
+        """ Return the sorted names of the nodes with an unexpired lease, removing leases which lapsed more than ttl
+            ago.
+        """
+        nodes = set([self.node])
+        for name in self.store.list_dir() or []:
+            if not name.endswith(LEASE_SUFFIX) or name == self.node + LEASE_SUFFIX:
+                continue
+            try:
+                with self.store.open(name, 'r') as lease_file:
+                    lease = json.load(lease_file)
+            except Exception:
+                log.debug('Unable to read lease %s, it is skipped' % name)
+                continue
+            if lease['expires'] > now:
+                nodes.add(lease['node'])
+            elif lease['expires'] < now - self.ttl:
+                log.info('Removing the lease of %s which expired at %s' % (lease['node'], time.ctime(lease['expires'])))
+                self.store.delete(name)
+        return sorted(nodes)
+
+    def refresh(self, now=None):
+        """ Renew this node's lease and take its share of the budget among the nodes currently holding one. """
+        if now is None:
+            now = time.time()
+        with self.store.open(self.node + LEASE_SUFFIX, 'w') as lease_file:
+            json.dump({'node': self.node, 'expires': now + self.ttl}, lease_file)
+        nodes = self.active_nodes(now)
+        if nodes != self.nodes:
+            log.info('Upload budget shared by %d nodes: %s' % (len(nodes), ', '.join(nodes)))
+        self.nodes = nodes
+
+        run_metrics.set('budget_nodes', len(nodes))
+        if self.slots is not None:
+            self.slots.set_limit(self._concurrency_share())
+            run_metrics.set('budget_concurrency', self.slots.limit)
+        if self.throttle is not None:
+            self.throttle.rate = self._bandwidth_share(len(nodes))
+            run_metrics.set('budget_bandwidth', self.throttle.rate)
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.refresh()
+            except Exception:
+                log.exception('Error refreshing the upload budget lease %s, keeping the current share' % self)
+
+    def start(self):
+        """ Take a lease and keep it refreshed in a background thread until release is called.
+            If the lease store can't be reached the node starts with the whole budget.
+        """
+        try:
+            self.refresh()
+        except Exception:
+            log.exception('Error taking the upload budget lease %s' % self)
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name='upload budget')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def release(self):
+        """ Stop refreshing the lease and remove it, lending this node's share to the others. """
+        if self.thread is not None:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
+        try:
+            self.store.delete(self.node + LEASE_SUFFIX)
+        except Exception:
+            log.exception('Error releasing the upload budget lease %s, it will lapse' % self)
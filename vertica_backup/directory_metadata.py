@@ -21,7 +21,10 @@ OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 from datetime import datetime
 import logging
-import pickle
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 
 from utils import LogTime
 
@@ -62,7 +65,8 @@ class DirectoryMetadata(object):
         if store is None:
             metadata = {}
         else:
-            with LogTime(log.info, "Collected %s metadata" % store.__class__.__name__):
+            with LogTime(log.info, "Collected %s metadata" % store.__class__.__name__, phase='metadata',
+                         labels={'store': str(store)}):
                 metadata = store.get_metadata()
             log.info("\tCollected %d total files" % len(metadata))
 
@@ -91,10 +95,11 @@ class DirectoryMetadata(object):
 
         return additions, other_keys
 
-    def save(self, store):
+    def save(self, store, suffix='.pickle'):
         """ Save to a pickle with today's date as the filename.
+            Only names ending in .pickle are taken as complete backups, others are ignored by load_pickle.
         """
-        pickle_name = self.date.strftime("%Y_%m_%d_%H%M") + '.pickle'
+        pickle_name = self.date.strftime("%Y_%m_%d_%H%M") + suffix
         with store.open(pickle_name, 'w') as pickle_file:
             pickle.dump(self, pickle_file, pickle.HIGHEST_PROTOCOL)
 
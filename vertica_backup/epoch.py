@@ -48,6 +48,10 @@ class EpochFiles(object):
         ]
         return files
 
+    def restored_paths(self):
+        """ Return a dictionary of each date stamped epoch file path to the standard path restore moves it to. """
+        return dict(("%s_%s" % (path, self.date_str), path) for path in self.epoch_files)
+
     @staticmethod
     def _move_file(from_path, to_path):
         """ Move a file on the local filesystem, logging an error if the from file does not exist.
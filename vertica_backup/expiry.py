@@ -0,0 +1,146 @@
+""" Retention by object expiration, objects dropped from a backup are given an X-Delete-At so the store removes them
+    once every retained backup referencing them has rotated out, rather than the client deleting them one by one.
+    The delete times set are tracked in a json file in the store root so they can be cleared if a later backup
+    references the object again and so the client side delete pass only has to reconcile objects the store missed.
+
+Copyright 2014 Hewlett-Packard Development Company, L.P.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software 
+and associated documentation files (the "Software"), to deal in the Software without restriction, 
+including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, 
+and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, 
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or 
+substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, 
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR 
+PURPOSE AND NONINFRINGEMENT.
+
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR 
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF 
+OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+import json
+import logging
+import time
+
+from metrics import run_metrics
+from retry import FailureQueue
+from utils import run_parallel
+
+log = logging.getLogger(__name__)
+
+EXPIRING_NAME = 'expiring.json'
+
+
+class ExpiryError(Exception):
+    pass
+
+
+class ExpiryPolicy(object):
+    """ Settings for offloading retention deletes to the store.
+        interval is the expected seconds between backups, an object dropped from a backup is expired once retain
+        plus grace intervals have passed. lag is how long past its delete time an object can still be listed
+        before the client deletes it itself. An object due to expire within margin seconds is treated as already
+        gone, so it can't expire between the diff and the clearing of its delete time.
+    """
+    def __init__(self, interval=86400, grace=1, threads=8, lag=86400, margin=3600):
+        self.interval = interval
+        self.grace = grace
+        self.threads = threads
+        self.lag = lag
+        self.margin = margin
+
+    def delete_at(self, retain, now):
+        return int(now + (retain + self.grace) * self.interval)
+
+    @staticmethod
+    def load(store):
+        """ Return the tracked delete times from the store, a dictionary of path to unix timestamp. """
+        if EXPIRING_NAME not in (store.list_dir() or []):
+            return {}
+        with store.open(EXPIRING_NAME, 'r') as expiring_file:
+            return json.load(expiring_file)
+
+    @staticmethod
+    def save(store, expiring):
+        with store.open(EXPIRING_NAME, 'w') as expiring_file:
+            json.dump(expiring, expiring_file, sort_keys=True)
+
+    def remove_expired(self, expiring, store_metadata, now=None):
+        """ Drop objects past or within margin seconds of their delete time from store_metadata, the store may still
+            list them but they can't be relied on so a backup needing one uploads it again. Returns the paths removed.
+        """
+        if now is None:
+            now = time.time()
+        expired = [path for path, delete_at in expiring.iteritems()
+                   if delete_at <= now + self.margin and path in store_metadata.metadata]
+        for path in expired:
+            del store_metadata.metadata[path]
+            del expiring[path]
+        return expired
+
+    def _post(self, store, paths, timestamp, counter, labels, failures):
+        """ Set or clear the delete time of the paths concurrently, failures are queued for retry.
+            Returns the paths which succeeded.
+        """
+        results = run_parallel(lambda path: store.set_delete_at(path, timestamp), paths, self.threads)
+        done = []
+        for path in paths:
+            result = results.get(path)
+            if isinstance(result, Exception):
+                log.error('Error setting the expiry of %s in %s. Details:\n%s' % (path, store, result))
+                failures.add('expiry of %s' % path, store.set_delete_at, path, timestamp)
+            else:
+                done.append(path)
+        run_metrics.add(counter, len(done), labels)
+        return done
+
+    def clear(self, store, expiring, current_metadata):
+        """ Clear the delete time of tracked objects the current backup references, retrying failures once.
+            Raises ExpiryError if some still fail, a backup relying on objects the store may yet expire is not
+            complete.
+        """
+        failures = FailureQueue()
+        to_clear = [path for path in current_metadata.metadata if path in expiring]
+        self._post(store, to_clear, None, 'objects_expiry_cleared', {'store': str(store)}, failures)
+        failures.retry()
+        failed = set(args[0] for description, func, args in failures.items)
+        for path in to_clear:
+            if path not in failed:
+                del expiring[path]
+        if len(failed) > 0:
+            raise ExpiryError('Unable to clear the expiry of %d objects in %s' % (len(failed), store))
+
+    def apply(self, store, expiring, current_metadata, previous_metadata, store_metadata, retain, to_del, failures):
+        """ Update the object expiry in store for the current backup and return the subset of to_del the client
+            should still delete.
+            Objects in the previous backup but not the current one are set to expire after the retained backups,
+            tracked objects the current backup references again have their expiry cleared, see clear. The expiring
+            dictionary is updated to match. Of to_del only objects never set to expire or still listed lag seconds after
+            their delete time are returned.
+        """
+        labels = {'store': str(store)}
+        now = time.time()
+
+        # Objects gone from the listing have been expired or deleted, stop tracking them
+        for path in [path for path in expiring if path not in store_metadata.metadata]:
+            del expiring[path]
+
+        self.clear(store, expiring, current_metadata)
+
+        if previous_metadata is not None:
+            to_expire = [path for path in previous_metadata.metadata
+                         if path not in current_metadata.metadata and path in store_metadata.metadata and
+                         path not in expiring]
+            delete_at = self.delete_at(retain, now)
+            for path in self._post(store, to_expire, delete_at, 'objects_expiry_set', labels, failures):
+                expiring[path] = delete_at
+
+        reconcile = [path for path in to_del if path not in expiring or expiring[path] + self.lag < now]
+        run_metrics.add('objects_expiring', len(to_del) - len(reconcile), labels)
+        if len(reconcile) > 0:
+            log.info('Deleting %d objects from %s which were not expired by the store' % (len(reconcile), store))
+        return reconcile
@@ -0,0 +1,94 @@
+""" Compact per run statistics records kept in each store next to the DirectoryMetadata pickles.
+    Unlike the weekday rotated logs these are kept for STATS_RETAIN runs so trends can be reported.
+
+Copyright 2014 Hewlett-Packard Development Company, L.P.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software 
+and associated documentation files (the "Software"), to deal in the Software without restriction, 
+including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, 
+and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, 
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or 
+substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, 
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR 
+PURPOSE AND NONINFRINGEMENT.
+
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR 
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF 
+OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+from datetime import datetime
+import fnmatch
+import json
+import logging
+import re
+import socket
+
+from metrics import run_metrics, TRANSFER_PHASES
+
+log = logging.getLogger(__name__)
+
+STATS_SUFFIX = '.stats.json'
+STATS_RETAIN = 400  # Over a year of daily backups, each record is well under a KB
+
+
+def stats_name(date):
+    """ The stats record name for a backup, matching the name of its pickle. """
+    return date.strftime("%Y_%m_%d_%H%M") + STATS_SUFFIX
+
+
+def build_record(current_metadata, store):
+    """ Return the stats record for the backup of current_metadata to store from the run metrics.
+        Phases and counters specific to the store are merged with those common to the run.
+    """
+    phases, counters = run_metrics.snapshot({'store': str(store)})
+    throughput = {}
+    for phase, counter in TRANSFER_PHASES.iteritems():
+        if phases.get(phase, 0) > 0 and counters.get(counter, 0) > 0:
+            throughput[phase] = counters[counter] / phases[phase]
+    return {
+        'date': current_metadata.date.strftime('%Y-%m-%dT%H:%M:%S'),
+        'hostname': socket.gethostname(),
+        'store': str(store),
+        'files': len(current_metadata.metadata),
+        'snapshot_bytes': sum(file_metadata.bytes for file_metadata in current_metadata.metadata.itervalues()),
+        'duration': sum(seconds for phase, seconds in phases.iteritems() if phase != 'total'),
+        'phases': phases,
+        'counters': counters,
+        'throughput': throughput
+    }
+
+
+def list_stats(store):
+    """ Return the stats record names in the store, newest first. """
+    root_list = store.list_dir()
+    if root_list is None:
+        return []
+    stats_re = re.compile(fnmatch.translate('*' + STATS_SUFFIX))
+    return sorted((name for name in root_list if stats_re.match(name) is not None), reverse=True)
+
+
+def load_stats(store, name):
+    with store.open(name, 'r') as stats_file:
+        return json.load(stats_file)
+
+
+def save_stats(current_metadata, store, keep=STATS_RETAIN):
+    """ Save the stats record for this backup to the store and remove those beyond the newest keep records.
+        The record is informational so errors are logged rather than failing the backup.
+    """
+    try:
+        record = build_record(current_metadata, store)
+        with store.open(stats_name(current_metadata.date), 'w') as stats_file:
+            json.dump(record, stats_file, sort_keys=True)
+        for name in list_stats(store)[keep:]:
+            store.delete(name)
+    except Exception:
+        log.exception('Error saving the run statistics to %s' % store)
+
+
+def record_date(record):
+    return datetime.strptime(record['date'], '%Y-%m-%dT%H:%M:%S')
@@ -0,0 +1,230 @@
+""" Metrics collected during a backup or restore run.
+    Phase durations, counters and latency histograms are gathered in the module level run_metrics and written at the
+    end of the run as json, as a Prometheus node-exporter textfile and as nagios perfdata.
+
+Copyright 2014 Hewlett-Packard Development Company, L.P.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software 
+and associated documentation files (the "Software"), to deal in the Software without restriction, 
+including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, 
+and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, 
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or 
+substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, 
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR 
+PURPOSE AND NONINFRINGEMENT.
+
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR 
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF 
+OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+import json
+import os
+import threading
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, float('inf'))
+
+# The byte counter behind the throughput of each transfer phase
+TRANSFER_PHASES = {'upload': 'bytes_uploaded', 'download': 'bytes_downloaded'}
+
+
+def _key(name, labels):
+    if labels is None:
+        return name, ()
+    return name, tuple(sorted(labels.iteritems()))
+
+
+def _prometheus_name(name, labels, extra=None):
+    """ Format a metric name with labels for the Prometheus text format. """
+    labels = list(labels)
+    if extra is not None:
+        labels.append(extra)
+    if len(labels) == 0:
+        return name
+    return '%s{%s}' % (name, ','.join('%s="%s"' % (label, str(value).replace('"', '\\"')) for label, value in labels))
+
+
+class Histogram(object):
+    """ Counts of observations falling in each bucket along with their count and sum. """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+
+    def to_dict(self):
+        return {'count': self.count, 'sum': self.sum,
+                'buckets': [[str(bound), count] for bound, count in zip(self.buckets, self.counts)]}
+
+
+class Metrics(object):
+    """ A thread safe collection of phase durations, counters and histograms, each optionally labeled.
+    """
+    def __init__(self, prefix='vertica_backup'):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.phases = {}
+        self.counters = {}
+        self.histograms = {}
+
+    def reset(self):
+        with self.lock:
+            self.phases = {}
+            self.counters = {}
+            self.histograms = {}
+
+    def phase(self, name, seconds, labels=None):
+        """ Record the duration of a phase, repeated phases add up. """
+        key = _key(name, labels)
+        with self.lock:
+            self.phases[key] = self.phases.get(key, 0.0) + seconds
+
+    def add(self, name, value=1, labels=None):
+        key = _key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, labels=None):
+        with self.lock:
+            self.counters[_key(name, labels)] = value
+
+    def get(self, name, labels=None):
+        with self.lock:
+            return self.counters.get(_key(name, labels), 0)
+
+    def total(self, name):
+        """ The sum of a counter over all its labels. """
+        with self.lock:
+            return sum(value for (counter, labels), value in self.counters.iteritems() if counter == name)
+
+    def observe(self, name, value, labels=None):
+        key = _key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def snapshot(self, labels=None):
+        """ Return the phases and counters without labels merged with those having exactly the given labels as
+            two plain dictionaries keyed by name, the compact form kept in the run history.
+        """
+        wanted = _key('', labels)[1]
+        phases = {}
+        counters = {}
+        with self.lock:
+            for source, dest in ((self.phases, phases), (self.counters, counters)):
+                for (name, key_labels), value in sorted(source.iteritems(), key=lambda item: len(item[0][1])):
+                    if key_labels == () or key_labels == wanted:
+                        dest[name] = value
+        return phases, counters
+
+    def throughput(self):
+        """ Return a dictionary of bytes per second for each transfer phase that moved data. """
+        rates = {}
+        with self.lock:
+            for (name, labels), seconds in self.phases.iteritems():
+                if name not in TRANSFER_PHASES:
+                    continue
+                transferred = self.counters.get((TRANSFER_PHASES[name], labels), 0)
+                if seconds > 0 and transferred > 0:
+                    rates[(name, labels)] = transferred / seconds
+        return rates
+
+    def to_dict(self):
+        def flatten(items):
+            return [dict(labels, name=name, value=value) for (name, labels), value in sorted(items.iteritems())]
+
+        throughput = self.throughput()
+        with self.lock:
+            return {
+                'phases': flatten(self.phases),
+                'counters': flatten(self.counters),
+                'histograms': flatten(dict((key, hist.to_dict()) for key, hist in self.histograms.iteritems())),
+                'throughput': flatten(throughput),
+            }
+
+    def prometheus(self, labels=None):
+        """ Return the metrics in the Prometheus text exposition format, with the given labels added to every sample
+            to tell apart the runs writing the same metrics.
+        """
+        common = _key('', labels)[1]
+        lines = []
+        throughput = self.throughput()
+        with self.lock:
+            name = '%s_phase_seconds' % self.prefix
+            lines.append('# TYPE %s gauge' % name)
+            for (phase, labels), seconds in sorted(self.phases.iteritems()):
+                lines.append('%s %f' % (_prometheus_name(name, common + labels, ('phase', phase)), seconds))
+
+            # Sorting groups the samples of each metric, which Prometheus needs under a single TYPE line
+            typed = None
+            for (counter, labels), value in sorted(self.counters.iteritems()):
+                name = '%s_%s' % (self.prefix, counter)
+                if name != typed:
+                    lines.append('# TYPE %s gauge' % name)
+                    typed = name
+                lines.append('%s %s' % (_prometheus_name(name, common + labels), value))
+
+            name = '%s_throughput_bytes_per_second' % self.prefix
+            lines.append('# TYPE %s gauge' % name)
+            for (phase, labels), rate in sorted(throughput.iteritems()):
+                lines.append('%s %f' % (_prometheus_name(name, common + labels, ('phase', phase)), rate))
+
+            for (histogram, labels), hist in sorted(self.histograms.iteritems()):
+                name = '%s_%s' % (self.prefix, histogram)
+                if name != typed:
+                    lines.append('# TYPE %s histogram' % name)
+                    typed = name
+                cumulative = 0
+                for bound, count in zip(hist.buckets, hist.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else str(bound)
+                    bucket = _prometheus_name(name + '_bucket', common + labels, ('le', le))
+                    lines.append('%s %d' % (bucket, cumulative))
+                lines.append('%s %f' % (_prometheus_name(name + '_sum', common + labels), hist.sum))
+                lines.append('%s %d' % (_prometheus_name(name + '_count', common + labels), hist.count))
+        return '\n'.join(lines) + '\n'
+
+    def perfdata(self, names):
+        """ Return nagios perfdata for the named counters, each summed over its labels. """
+        return ' '.join("%s=%s" % (name, self.total(name)) for name in names)
+
+    def write_json(self, path):
+        write_atomic(path, json.dumps(self.to_dict(), indent=2, sort_keys=True))
+
+    def write_prometheus(self, path, labels=None):
+        write_atomic(path, self.prometheus(labels))
+
+
+def write_atomic(path, contents):
+    """ Write contents to a temporary file in the same directory then rename it over path, so readers never see
+        a partial file.
+    """
+    tmp_path = '%s.tmp.%d' % (path, os.getpid())
+    with open(tmp_path, 'w') as tmp_file:
+        tmp_file.write(contents)
+    os.rename(tmp_path, path)
+
+
+def write_run_metrics(json_path, textfile_dir=None, name='vertica_backup', labels=None):
+    """ Write the run metrics as json to json_path and, if textfile_dir is set, as name.prom in that directory for
+        the node-exporter textfile collector with labels added to each series.
+    """
+    run_metrics.write_json(json_path)
+    if textfile_dir is not None:
+        run_metrics.write_prometheus(os.path.join(textfile_dir, name + '.prom'), labels)
+
+
+run_metrics = Metrics()
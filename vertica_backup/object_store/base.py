@@ -25,6 +25,9 @@ import re
 class ObjectStore(object):
     """ Abstract base class for Object stores which hold Vertica backups and DirectoryMetadata pickles
     """
+    # Stores which can delete objects themselves at a set time implement set_delete_at
+    supports_expiry = False
+
     def delete(self, path):
         """ Remove path from the ObjectStore
         """
@@ -36,6 +39,11 @@ class ObjectStore(object):
         """
         raise NotImplementedError
 
+    def exists(self):
+        """ Return False if the store has not been created yet, which is left to the first write when opened read only.
+        """
+        return True
+
     def get_metadata(self):
         """ Returns a dictionary with key of path and values of FileMetadata objects
             The metadata object is build from the prefix path of the object store.
@@ -65,6 +73,22 @@ class ObjectStore(object):
         """
         raise NotImplementedError
 
+    def set_delete_at(self, relative_path, timestamp):
+        """ Have the store delete the object at relative_path at the unix timestamp, None cancels a pending delete.
+        """
+        raise NotImplementedError
+
+    def stat(self, relative_path):
+        """ Return a FileMetadata for the object at relative_path in the store or None if it does not exist.
+        """
+        raise NotImplementedError
+
+    def upload_file(self, relative_path, file_obj, size):
+        """ Upload size bytes read from the file like file_obj to relative_path in the store.
+            Returns the file size if successful
+        """
+        raise NotImplementedError
+
     def upload(self, relative_path, base_dir):
         """ Upload the file from os.path.join(base_dir, relative_path) on the local os to relative_path in the store.
             Returns the file size if successful
@@ -21,12 +21,14 @@ OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 from contextlib import contextmanager
 from datetime import datetime
-import hashlib
 import logging
 import os
 import shutil
 
 from ..directory_metadata import FileMetadata, DirectoryMetadata
+from ..metrics import run_metrics
+from ..utils import make_dirs, md5_file
+from ..walker import walk_files
 from . import ObjectStore
 
 log = logging.getLogger(__name__)
@@ -35,11 +37,27 @@ log = logging.getLogger(__name__)
 class FSStore(ObjectStore):
     """ An object store part of a locally mounted filesystem
     """
-    def __init__(self, base_dir, prefix):
+    def __init__(self, base_dir, prefix, hash_files=True, hash_cache=None, walk_threads=1):
+        """ If hash_files is False get_metadata only takes hashes from the previous pickle, files not found there
+            have a hash of None. This avoids reading the data when only an estimate is needed.
+            A hash_cache dictionary shared by several stores lets a file hard linked into more than one of them be
+            hashed once, it is keyed by device, inode, size and mtime.
+            With walk_threads above 1 directories are listed in parallel, this helps on cold caches or network
+            filesystems but the contention slows a walk of cached directories.
+        """
         if base_dir[-1] != '/':  # Make sure there is a trailing / so the relative path does not begin with one
             base_dir += '/'
         self.base_dir = base_dir
         self.prefix_dir = os.path.join(base_dir, prefix)
+        self.hash_files = hash_files
+        self.hash_cache = hash_cache
+        self.walk_threads = walk_threads
+
+    def __str__(self):
+        return self.base_dir
+
+    def exists(self):
+        return os.path.isdir(self.base_dir)
 
     def _get_full_path(self, path):
         if path[0] == '/':
@@ -68,37 +86,50 @@ class FSStore(ObjectStore):
         previous = DirectoryMetadata.load_pickle(self)
         metadata = {}
 
-        for dirpath, dirnames, filenames in os.walk(self.prefix_dir):
-            for fname in filenames:
-                path = os.path.join(dirpath, fname)
-                relative_path = path.split(self.base_dir, 1)[1]
+        for relative_path, stats in walk_files(self.prefix_dir, self.prefix_dir[len(self.base_dir):],
+                                               self.walk_threads):
+            path = self.base_dir + relative_path
+            swift_bytes = stats.st_size
+            mtime = datetime.utcfromtimestamp(stats.st_mtime)
+            cache_key = (stats.st_dev, stats.st_ino, stats.st_size, stats.st_mtime)
+            if (previous is not None) and (relative_path in previous.metadata) and\
+                    (previous.metadata[relative_path].bytes == swift_bytes):
+                swift_hash = previous.metadata[relative_path].hash
+                run_metrics.add('hash_cache_hits')
+            elif self.hash_cache is not None and cache_key in self.hash_cache:
+                swift_hash = self.hash_cache[cache_key]
+                run_metrics.add('hash_cache_hits')
+            elif not self.hash_files:
+                swift_hash = None
+            else:
+                run_metrics.add('hash_cache_misses')
+                run_metrics.add('bytes_hashed', swift_bytes)
                 try:
-                    stats = os.stat(path)
-                except OSError:
-                    log.exception('Error stating a file on disk while building up metadata, skipping file %s' % path)
+                    swift_hash = md5_file(path)
+                except (IOError, OSError):
+                    log.exception('Error reading a file to create the md5 while building up metadata, skipping file %s' % path)
                     continue
-                swift_bytes = stats.st_size
-                mtime = datetime.utcfromtimestamp(stats.st_mtime)
-                if (previous is not None) and (relative_path in previous.metadata) and\
-                        (previous.metadata[relative_path].bytes == swift_bytes):
-                    swift_hash = previous.metadata[relative_path].hash
-                else:
-                    try:
-                        with open(path, 'rb') as afile:
-                            md5_hash = hashlib.md5()
-                            md5_hash.update(afile.read())
-                            swift_hash = md5_hash.hexdigest()
-                    except OSError:
-                        log.exception('Error reading a file to create the md5 while building up metadata, skipping file %s' % path)
-                        continue
-
-                metadata[relative_path] = FileMetadata(relative_path, swift_bytes, mtime, swift_hash)
+
+            if self.hash_cache is not None and swift_hash is not None:
+                self.hash_cache[cache_key] = swift_hash
+            metadata[relative_path] = FileMetadata(relative_path, swift_bytes, mtime, swift_hash)
 
         return metadata
 
     def list_dir(self, path='/'):
         return os.listdir(self._get_full_path(path))
 
+    def stat(self, relative_path):
+        """ Return the FileMetadata of a file in the store, hashing it, or None if it does not exist.
+        """
+        full_path = self._get_full_path(relative_path)
+        try:
+            stats = os.stat(full_path)
+        except OSError:
+            return None
+        return FileMetadata(relative_path, stats.st_size, datetime.utcfromtimestamp(stats.st_mtime),
+                            md5_file(full_path))
+
     @contextmanager
     def open(self, relative_path, flags):
         """ Open a file at the base of the object store + relative path with the appropriate flags
@@ -107,10 +138,21 @@ class FSStore(ObjectStore):
         yield file_obj
         file_obj.close()
 
+    def upload_file(self, relative_path, file_obj, size):
+        """ Write the contents of file_obj to the object store relative_path
+            Return the size if successful
+        """
+        full_path = self._get_full_path(relative_path)
+        make_dirs(os.path.dirname(full_path))
+        with open(full_path, 'wb') as dest:
+            shutil.copyfileobj(file_obj, dest)
+        return os.path.getsize(full_path)
+
     def upload(self, relative_path, base_dir):
         """ Copy the file from base_dir/relative_path to the object store relative_path
             Return the size if successful
         """
         full_path = self._get_full_path(relative_path)
+        make_dirs(os.path.dirname(full_path))
         shutil.copy(os.path.join(base_dir, relative_path), full_path)
         return os.path.getsize(full_path)
@@ -20,37 +20,172 @@ OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
 from contextlib import contextmanager
+import cStringIO
 from datetime import datetime
+import hashlib
 import json
 import logging
 import os
+import shutil
 import socket
+import sys
 import tempfile
-import time
+import threading
 
+import requests
 import swiftclient
 
 from ..directory_metadata import FileMetadata
+from ..progress import current_transfer, ProgressReader
+from ..retry import FAIL, RECONNECT, RETRY, RetryPolicy
+from ..utils import make_dirs, md5_file, run_parallel, ThrottledReader
 from . import ObjectStore
+from .swift_pool import get_pool
 
 log = logging.getLogger(__name__)
 
+CHUNK_SIZE = 65536
+SPOOL_SIZE = 64 * 1048576  # Files opened are held in memory up to this size then spill to disk
+
+
+PART_SUFFIX = '.part'  # A ranged download in progress
+PROGRESS_SUFFIX = '.progress'  # Sidecar of a .part file recording the ranges completed
+
 
 class SwiftException(Exception):
     pass
 
 
+class RangePolicy(object):
+    """ Settings for downloading large objects as parallel byte ranges.
+        Objects of at least threshold bytes are fetched in ranges of range_size bytes, streams ranges at a time, into a
+        preallocated <file>.part. The ranges completed are recorded in a <file>.part.progress sidecar so a download
+        which fails part way resumes with just the ranges still missing.
+    """
+    def __init__(self, threshold=268435456, range_size=67108864, streams=4):
+        self.threshold = threshold
+        self.range_size = range_size
+        self.streams = streams
+
+
+class SwiftReader(object):
+    """ Reads an object from swift in chunks on a pooled connection held until it is closed.
+        If the connection fails part way the read is retried on a new connection with a ranged GET from where it got to.
+    """
+    def __init__(self, store, swift_path):
+        self.store = store
+        self.swift_path = swift_path
+        self.offset = 0
+        self._body = None
+        self._connection = None
+        self._skip = 0
+
+    def _release(self, exc_info=(None, None, None)):
+        """ Return the connection to the pool, or if there was an error let the pool decide whether to keep it. """
+        if self._connection is None:
+            return
+        connection, self._connection = self._connection, None
+        self._body = None
+        self._skip = 0
+        try:
+            connection.__exit__(*exc_info)
+        except Exception:
+            pass  # The pool re-raises the error passed in, it is raised by the caller
+
+    def _next_chunk(self):
+        try:
+            if self._body is None:
+                connection = self.store.pool.connection()
+                conn = connection.__enter__()
+                self._connection = connection
+                headers = {}
+                if self.offset > 0:
+                    headers['Range'] = 'bytes=%d-' % self.offset
+                response_headers, self._body = conn.get_object(self.store.container, self.swift_path,
+                                                               resp_chunk_size=CHUNK_SIZE, headers=headers)
+                if self.offset > 0 and 'content-range' not in response_headers:
+                    self._skip = self.offset  # The range was ignored, drop what was already read
+            chunk = next(self._body, '')
+            while self._skip > 0 and len(chunk) > 0:
+                skipped = min(self._skip, len(chunk))
+                chunk = chunk[skipped:]
+                self._skip -= skipped
+                if len(chunk) == 0:
+                    chunk = next(self._body, '')
+        except Exception:
+            self._release(sys.exc_info())
+            raise
+        if len(chunk) == 0:
+            self._release()
+        return chunk
+
+    def __iter__(self):
+        """ Yield the chunks of the object, each retried from where the previous one ended. """
+        while True:
+            chunk = self.store.retry_policy.call('download of %s' % self.swift_path, self._next_chunk)
+            if len(chunk) == 0:
+                return
+            if self.store.throttle is not None:
+                self.store.throttle.consume(len(chunk))
+            self.offset += len(chunk)
+            yield chunk
+
+    def close(self):
+        self._release()
+
+
+def classify_error(ex):
+    """ Decide how to handle an error from swift for a RetryPolicy.
+        Connection errors and expired auth rebuild the connection, server errors and throttling are retried
+        and any other client error fails immediately.
+    """
+    if isinstance(ex, swiftclient.ClientException):
+        if ex.http_status is None or ex.http_status == 401:
+            return RECONNECT
+        elif ex.http_status in (408, 429, 498) or ex.http_status >= 500:
+            return RETRY
+        else:
+            return FAIL
+    elif isinstance(ex, (socket.error, requests.exceptions.RequestException)):
+        return RECONNECT
+    return FAIL
+
+
+def index_container(domain):
+    """ The container holding the vnode to hostname index for a domain, it does not match the domain_hostname
+        pattern of the backup containers.
+    """
+    return domain + '-index'
+
+
+def index_name(vnode, snapshot_name):
+    """ The name of the domain index entry for a node's backups of one snapshot, each snapshot has its own entry as
+        each can have its own container. Entries made before snapshots were recorded are named by the vnode alone.
+    """
+    return '%s/%s' % (vnode, snapshot_name)
+
+
 class SwiftStore(ObjectStore):
     """ Wraps swiftclient with a number of methods tailored for use by the vertica backup.
 
         Sets the swift container to the domain and puts all files in a subdir for the host.
     """
+    supports_expiry = True
 
-    def __init__(self, key, region, tenant, url, user, prefix, domain=None, hostname=None, vnode=None):
+    def __init__(self, key, region, tenant, url, user, prefix, domain=None, hostname=None, vnode=None,
+                 retry_policy=None, pool=None, throttle=None, container=None, slots=None, ranges=None, read_only=False):
         """ Takes the config object from the backup.py.
             If the domain is specified either the hostname or vnode should be.
             If vnode is specified and hostname isn't the hostname will be discovered from what is in swift. This only
             works if existing backups are in swift and is useful primarily for restore jobs.
+            All swift operations are retried according to the retry_policy, by default a RetryPolicy with 5 attempts.
+            Connections come from the pool, by default the shared ConnectionPool for these credentials.
+            If a Throttle is given transfers are limited to its rate and if Slots are given uploads hold one while
+            running.
+            The container defaults to <domain>_<hostname>, one set explicitly is found by restores through the domain
+            index.
+            Large downloads are split into ranges according to the RangePolicy ranges, by default a RangePolicy().
+            With read_only set a missing container is not created, exists() then returns False.
         """
         self.key = key
         self.region = region
@@ -58,8 +193,18 @@ class SwiftStore(ObjectStore):
         self.url = url
         self.user = user
         self.prefix = prefix
-
-        self.conn = self._connect_swift()
+        if retry_policy is None:
+            retry_policy = RetryPolicy()
+        retry_policy.classifier = classify_error
+        self.retry_policy = retry_policy
+        if pool is None:
+            pool = get_pool(url, user, key, tenant, region)
+        self.pool = pool
+        self.throttle = throttle
+        self.slots = slots
+        if ranges is None:
+            ranges = RangePolicy()
+        self.ranges = ranges
 
         if domain is None:
             hostname, domain = socket.getfqdn().split('.', 1)
@@ -68,41 +213,234 @@ class SwiftStore(ObjectStore):
                 raise SwiftException(
                     'Error creating SwiftStore: If domain is defined then either hostname or vnode must also be.'
                 )
-            hostname = self._get_hostname_from_vnode(domain, vnode)
+            hostname, container = self._get_hostname_from_vnode(domain, vnode)
 
-        self.container = "%s_%s" % (domain, hostname)
+        self.domain = domain
+        self.hostname = hostname
+        if container is None:
+            container = "%s_%s" % (domain, hostname)
+        self.container = container
         log.debug("Using container %s" % self.container)
-        if len(self.conn.get_account(prefix=self.container)[1]) == 0:
+        self.read_only = read_only
+        self.container_exists = self.container in [entry['name'] for entry in
+                                                   self._call('listing account', 'get_account',
+                                                              prefix=self.container)[1]]
+        if not self.container_exists and not read_only:
             log.info("Creating container %s" % self.container)
-            self.conn.put_container(self.container)
+            self._call('creating container', 'put_container', self.container)
+            self.container_exists = True
+
+    def __str__(self):
+        return "swift %s/%s" % (self.region, self.container)
+
+    def exists(self):
+        return self.container_exists
 
-    def _connect_swift(self):
-        """ Start up a swift connection
+    def _call(self, description, method, *args, **kwargs):
+        """ Call the named method of a pooled swift connection with the retry policy.
+            A connection which fails is dropped by the pool so a retry gets a new one.
         """
-        return swiftclient.client.Connection(self.url, self.user, self.key, os_options={"region_name": self.region},
-                                             tenant_name=self.tenant, auth_version=2)
+        def attempt():
+            with self.pool.connection() as conn:
+                return getattr(conn, method)(*args, **kwargs)
 
-    def _download(self, swift_path, local_path):
-        """ Download the file from swift_path to local_path.
+        return self.retry_policy.call(description, attempt)
+
+    @contextmanager
+    def _upload_slot(self):
+        """ Hold one of the upload slots for the duration of the with block, if uploads are limited. """
+        if self.slots is None:
+            yield
+        else:
+            with self.slots.hold():
+                yield
+
+    def _transferred(self, size, transfer=None):
+        """ Account for size bytes moved, with the throttle if set and as progress of the transfer if given. """
+        if self.throttle is not None:
+            self.throttle.consume(size)
+        if transfer is not None:
+            transfer.advance(size)
+
+    def _tracked_reader(self, file_obj, transfer=None):
+        """ Return file_obj wrapped so reads are limited by the throttle and counted as progress of the transfer. """
+        if transfer is not None:
+            file_obj = ProgressReader(file_obj, transfer)
+        if self.throttle is not None:
+            file_obj = ThrottledReader(file_obj, self.throttle)
+        return file_obj
+
+    def _download(self, swift_path, local_path, expected_hash=None):
+        """ Download the file from swift_path to local_path, checking its md5 matches expected_hash if given.
+            The file is written to a .part file renamed into place once complete, so a file already at local_path,
+            which may be hard linked elsewhere, is replaced rather than overwritten.
+            Raises a SwiftException if the download fails after retries.
         """
         log.debug('Download from swift %s' % swift_path)
-        with open(local_path, 'wb') as local_file:
-            try:
-                local_file.write(self.conn.get_object(self.container, swift_path)[1])
-            except swiftclient.ClientException, ex:
-                if ex.http_status == 404:
-                    log.error('Failed downloading %s from swift, file does not exist.' % swift_path)
-                else:
-                    log.error('Error downloading from swift %s. Details:\n%s' % (swift_path, ex.msg))
+        transfer = current_transfer()
+        part_path = local_path + PART_SUFFIX
+
+        def get():
+            # The object is streamed to disk in chunks, each attempt starting the file over
+            md5_hash = hashlib.md5()
+            with self.pool.connection() as conn:
+                body = conn.get_object(self.container, swift_path, resp_chunk_size=CHUNK_SIZE)[1]
+                with open(part_path, 'wb') as local_file:
+                    for chunk in body:
+                        self._transferred(len(chunk), transfer)
+                        md5_hash.update(chunk)
+                        local_file.write(chunk)
+            return md5_hash.hexdigest()
+
+        try:
+            md5 = self.retry_policy.call('download of %s' % swift_path, get)
+        except swiftclient.ClientException, ex:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            if ex.http_status == 404:
+                raise SwiftException('Failed downloading %s from swift, file does not exist.' % swift_path)
+            raise SwiftException('Error downloading from swift %s. Details:\n%s' % (swift_path, ex.msg))
+        if expected_hash is not None and md5 != expected_hash:
+            os.remove(part_path)
+            raise SwiftException('Downloaded %s has md5 %s but %s was expected' % (swift_path, md5, expected_hash))
+        os.rename(part_path, local_path)
+
+    @staticmethod
+    def _save_progress(progress_path, progress):
+        """ Replace the progress sidecar so it is never seen half written. """
+        with open(progress_path + '.tmp', 'w') as progress_file:
+            json.dump(progress, progress_file)
+        os.rename(progress_path + '.tmp', progress_path)
+
+    def _ranged_download(self, swift_path, local_path, size, expected_hash=None):
+        """ Download the object at swift_path of size bytes to local_path as parallel byte ranges.
+            Each range is written at its offset with its own file descriptor, a range which fails part way is retried
+            from where it got to. If ranges still fail after retries a SwiftException is raised leaving the .part file
+            and its progress sidecar so the next attempt only fetches the missing ranges. The whole file's md5 is
+            checked against expected_hash if given, on a mismatch the partial state is removed.
+        """
+        part_path = local_path + PART_SUFFIX
+        progress_path = part_path + PROGRESS_SUFFIX
+        range_size = self.ranges.range_size
+        progress = {'size': size, 'hash': expected_hash, 'range_size': range_size, 'done': []}
+        try:
+            with open(progress_path) as progress_file:
+                saved = json.load(progress_file)
+        except (IOError, ValueError):
+            saved = None
+        if saved is not None and os.path.exists(part_path) and \
+                all(saved.get(key) == progress[key] for key in ('size', 'hash', 'range_size')):
+            progress = saved
+            log.info('Resuming the download of %s with %d of its ranges already done' %
+                     (swift_path, len(progress['done'])))
+        else:
+            with open(part_path, 'wb') as part_file:
+                part_file.truncate(size)
+            self._save_progress(progress_path, progress)
+
+        done = set(progress['done'])
+        starts = [start for start in range(0, size, range_size) if start not in done]
+        lock = threading.Lock()
+        transfer = current_transfer()  # The ranges are fetched in other threads
+
+        def fetch(start):
+            end = min(start + range_size, size)
+            position = [start]
+
+            def get():
+                with self.pool.connection() as conn:
+                    headers, body = conn.get_object(self.container, swift_path, resp_chunk_size=CHUNK_SIZE,
+                                                    headers={'Range': 'bytes=%d-%d' % (position[0], end - 1)})
+                    if 'content-range' not in headers:
+                        raise SwiftException('Swift ignored the range requested for %s' % swift_path)
+                    part_fd = os.open(part_path, os.O_WRONLY)
+                    try:
+                        os.lseek(part_fd, position[0], os.SEEK_SET)
+                        for chunk in body:
+                            self._transferred(len(chunk), transfer)
+                            os.write(part_fd, chunk)
+                            position[0] += len(chunk)
+                    finally:
+                        os.close(part_fd)
+                if position[0] != end:
+                    raise SwiftException('Range %d-%d of %s ended at %d' % (start, end - 1, swift_path, position[0]))
+
+            self.retry_policy.call('download of %s bytes %d-%d' % (swift_path, start, end - 1), get)
+            with lock:
+                progress['done'].append(start)
+                self._save_progress(progress_path, progress)
+
+        results = run_parallel(fetch, starts, self.ranges.streams)
+        errors = [result for result in results.itervalues() if isinstance(result, Exception)]
+        if len(errors) > 0:
+            raise SwiftException('%d of %d ranges of %s failed, a retry resumes with them. First error:\n%s' %
+                                 (len(errors), len(starts), swift_path, errors[0]))
+
+        if expected_hash is not None:
+            md5 = md5_file(part_path)
+            if md5 != expected_hash:
+                os.remove(part_path)
+                os.remove(progress_path)
+                raise SwiftException('Downloaded %s has md5 %s but %s was expected' % (swift_path, md5, expected_hash))
+        os.rename(part_path, local_path)
+        os.remove(progress_path)
+
+    def domain_hostnames(self):
+        """ Return the hostnames of all nodes with a container in this store's domain, including this one.
+        """
+        return [container['name'].split('_', 1)[1]
+                for container in self._call('listing account', 'get_account', prefix=self.domain + '_')[1]]
+
+    def update_index(self):
+        """ Record the hostname and container of this store's vertica node and snapshot in the domain index, an object
+            per vnode and snapshot in the <domain>-index container, so restores can find the host without scanning
+            every container.
+        """
+        vnode, snapshot_name = self.prefix.split('/', 1)
+        name = index_name(vnode, snapshot_name)
+        entry = json.dumps({'vnode': vnode, 'snapshot_name': snapshot_name, 'hostname': self.hostname,
+                            'container': self.container})
+        try:
+            self._call('index update for %s' % name, 'put_object', index_container(self.domain), name, entry,
+                       content_type='application/json')
+        except swiftclient.ClientException, ex:
+            if ex.http_status != 404:
+                raise
+            self._call('creating index container', 'put_container', index_container(self.domain))
+            self._call('index update for %s' % name, 'put_object', index_container(self.domain), name, entry,
+                       content_type='application/json')
 
     def _get_hostname_from_vnode(self, domain, vnode):
         """ Discover a hostname by looking in swift for the hostname associated with a particular vertica node name.
-            This assumes swift has an existing backup and there is a 1 to 1 mapping of vnode name to hostname.
+            The domain index entry for the vnode and this store's snapshot is checked first, then the vnode only
+            entry of older backups. Without either every container in the domain is scanned. This assumes swift has
+            an existing backup and there is a 1 to 1 mapping of vnode name to hostname. Returns the hostname and the
+            container, None for the default container of that hostname.
         """
-        for container in self.conn.get_account(prefix=domain + '_')[1]:
-            for node_name in self.conn.get_object(container['name'], '', query_string='delimiter=/')[1].splitlines():
+        names = [vnode]
+        if '/' in self.prefix:
+            names.insert(0, index_name(vnode, self.prefix.split('/', 1)[1]))
+        for name in names:
+            try:
+                entry = json.loads(self._call('index lookup for %s' % name, 'get_object', index_container(domain),
+                                              name)[1])
+                return entry['hostname'], entry.get('container')
+            except swiftclient.ClientException, ex:
+                if ex.http_status != 404:
+                    log.warning('Error reading the domain index for %s, scanning containers. Details:\n%s' %
+                                (name, ex))
+                    break
+            except ValueError:
+                log.warning('Invalid domain index entry for %s, scanning containers' % name)
+                break
+        log.info('No domain index entry for %s, scanning containers in %s' % (vnode, domain))
+
+        for container in self._call('listing account', 'get_account', prefix=domain + '_')[1]:
+            listing = self._call('listing %s' % container['name'], 'get_object', container['name'], '',
+                                 query_string='delimiter=/')[1]
+            for node_name in listing.splitlines():
                 if vnode == node_name.strip('/'):
-                    return container['name'].split('_', 1)[1]
+                    return container['name'].split('_', 1)[1], None
 
         raise SwiftException('No hostname could be determined from swift for the vnode %s, domain %s' % (vnode, domain))
 
@@ -125,38 +463,48 @@ class SwiftStore(ObjectStore):
         return clean
 
     def _upload(self, local_path, swift_path):
-        """ Upload a file from the local_path to swift.
+        """ Upload a file from the local_path to swift, the file is reopened for each attempt.
         """
         log.debug('Upload to swift %s' % local_path)
-        with open(local_path, 'rb') as object_file:
-            try:
-                self.conn.put_object(self.container, swift_path, object_file)
-            except swiftclient.ClientException, ex:
-                log.error('Error uploading to swift %s, retrying. Details:\n%s' % (local_path, ex.msg))
-                self.conn = self._connect_swift()
-                self.conn.put_object(self.container, swift_path, object_file)
+
+        transfer = current_transfer()
+
+        def put():
+            with open(local_path, 'rb') as object_file:
+                object_file = self._tracked_reader(object_file, transfer)
+                with self._upload_slot(), self.pool.connection() as conn:
+                    conn.put_object(self.container, swift_path, object_file)
+
+        self.retry_policy.call('upload of %s' % local_path, put)
 
     def delete(self, swift_path):
-        """ Delete an object """
+        """ Delete an object, an object which does not exist is not an error.
+            Raises a SwiftException if the delete fails after retries.
+        """
         log.debug('Delete from swift %s' % swift_path)
         try:
-            self.conn.delete_object(self.container, swift_path)
+            self._call('delete of %s' % swift_path, 'delete_object', self.container, swift_path)
         except swiftclient.ClientException, ex:
             if ex.http_status == 404:
                 log.debug('Failed deleting %s from swift, file does not exist.' % swift_path)
             else:
-                log.error('Error deleting from swift %s. Details:\n%s' % (swift_path, ex.msg))
+                raise SwiftException('Error deleting from swift %s. Details:\n%s' % (swift_path, ex.msg))
 
-    def download(self, relative_path, local_path):
+    def download(self, relative_path, local_path, file_metadata=None):
         """ Download the object from swift and store in local_path
+            Given the FileMetadata of the object its md5 is checked and if it is larger than the range threshold it is
+            downloaded as parallel ranges, resuming an earlier attempt.
             Return the size of the object if successful
         """
         file_path = os.path.join(local_path, relative_path)
-        p_dir = os.path.dirname(file_path)
-        if not os.path.exists(p_dir):
-            os.makedirs(p_dir)
+        make_dirs(os.path.dirname(file_path))
 
-        self._download(relative_path, file_path)
+        if file_metadata is None:
+            self._download(relative_path, file_path)
+        elif file_metadata.bytes >= self.ranges.threshold:
+            self._ranged_download(relative_path, file_path, file_metadata.bytes, file_metadata.hash)
+        else:
+            self._download(relative_path, file_path, file_metadata.hash)
         return os.path.getsize(file_path)
 
     def get_metadata(self):
@@ -172,13 +520,8 @@ class SwiftStore(ObjectStore):
         more_results = True
         marker = ''
         while more_results:  # Loop getting all results, only 10000 will be returned in one request.
-            try:
-                swift_files = json.loads(self.conn.get_object(self.container, '', query_string=query_string + marker)[1])
-            except swiftclient.ClientException, ex:
-                log.error('Error retrieving metadata from swift, retrying in 60 seconds. Details:\n%s' % ex.msg)
-                time.sleep(60)
-                self.conn = self._connect_swift()
-                swift_files = json.loads(self.conn.get_object(self.container, '', query_string=query_string + marker)[1])
+            swift_files = json.loads(self._call('metadata listing', 'get_object', self.container, '',
+                                                query_string=query_string + marker)[1])
             metadata.update(self._normalize_metadata(swift_files))
             if len(swift_files) < 10000:
                 more_results = False
@@ -200,28 +543,107 @@ class SwiftStore(ObjectStore):
         else:
             query_string = 'prefix=%s&delimiter=/' % path
 
-        return self.conn.get_object(self.container, '', query_string=query_string)[1].splitlines()
+        return self._call('listing of %s' % path, 'get_object', self.container, '',
+                          query_string=query_string)[1].splitlines()
+
+    def _read_spool(self, path):
+        """ Stream the object at path into memory, or an unlinked temporary file once it is larger than SPOOL_SIZE,
+            returning the file positioned at the start. A real file object is much quicker to unpickle from than a
+            file like object implemented in python.
+        """
+        reader = SwiftReader(self, path)
+        spool = cStringIO.StringIO()
+        in_memory = True
+        try:
+            for chunk in reader:
+                if in_memory and spool.tell() + len(chunk) > SPOOL_SIZE:
+                    disk = tempfile.TemporaryFile()
+                    disk.write(spool.getvalue())
+                    spool, in_memory = disk, False
+                spool.write(chunk)
+        except swiftclient.ClientException, ex:
+            if ex.http_status == 404:
+                raise SwiftException('Failed opening %s from swift, file does not exist.' % path)
+            raise SwiftException('Error opening from swift %s. Details:\n%s' % (path, ex.msg))
+        finally:
+            reader.close()
+        spool.seek(0)
+        return spool
 
     @contextmanager
     def open(self, path, flags):
-        """ Open a file at path in the object store with the appropriate flags
+        """ Open a file at path in the object store with the appropriate flags.
+            The file is held in memory, spilling to disk above SPOOL_SIZE. For reading it is streamed from swift first
+            and for writing or appending it is uploaded when the with block completes without an error.
         """
-        # Download the file to a temporary location
-        tmp_fd, tmp_path = tempfile.mkstemp()
-        os.close(tmp_fd)  # I will be opening/closing the file as needed, leaving this open complicates it
-
-        if (flags.find('r') != -1) or (flags.find('a') != -1):  # Used for reading/appending
-            self._download(path, tmp_path)
-
-        yield_file = open(tmp_path, flags)
-        yield yield_file
-        yield_file.close()
+        if not ('w' in flags or 'a' in flags or '+' in flags):
+            spool = self._read_spool(path)
+            try:
+                yield spool
+            finally:
+                spool.close()
+            return
 
-        if (flags.find('w') != -1) or (flags.find('a') != 1):  # It was used for writing, upload the changed file
-            self._upload(tmp_path, path)
+        spool = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+        try:
+            if 'w' not in flags:  # Appending or updating, start with the existing contents
+                try:
+                    existing = self._read_spool(path)
+                except SwiftException:
+                    if 'a' not in flags:
+                        raise
+                else:
+                    shutil.copyfileobj(existing, spool)
+                    existing.close()
+                if 'a' not in flags:
+                    spool.seek(0)
+            yield spool
+            spool.seek(0, os.SEEK_END)
+            size = spool.tell()
+
+            def put():
+                spool.seek(0)
+                contents = spool
+                if self.throttle is not None:
+                    contents = ThrottledReader(spool, self.throttle)
+                with self._upload_slot(), self.pool.connection() as conn:
+                    conn.put_object(self.container, path, contents, content_length=size)
+
+            self.retry_policy.call('upload of %s' % path, put)
+        finally:
+            spool.close()
+
+    def set_delete_at(self, relative_path, timestamp):
+        """ Set X-Delete-At on the object so swift expires it, a timestamp of None removes it.
+        """
+        if timestamp is None:
+            headers = {'X-Remove-Delete-At': '1'}
+        else:
+            headers = {'X-Delete-At': str(int(timestamp))}
+        self._call('expiry of %s' % relative_path, 'post_object', self.container, relative_path, headers)
 
-        # Cleanup the temporary file descriptor and path
-        os.remove(tmp_path)
+    def stat(self, relative_path):
+        """ Return the FileMetadata from a HEAD of the object, None if it does not exist. The hash is the ETag.
+        """
+        try:
+            headers = self._call('head of %s' % relative_path, 'head_object', self.container, relative_path)
+        except swiftclient.ClientException, ex:
+            if ex.http_status == 404:
+                return None
+            raise
+        mtime = datetime.strptime(headers['last-modified'], '%a, %d %b %Y %H:%M:%S GMT')
+        return FileMetadata(relative_path, int(headers['content-length']), mtime, headers['etag'].strip('"'))
+
+    def upload_file(self, relative_path, file_obj, size):
+        """ Upload size bytes read from file_obj to swift.
+            The file_obj is read only once so there is no retry, callers should fall back to upload on an error.
+            Returns the size of the file if successful.
+        """
+        log.debug('Upload stream to swift %s' % relative_path)
+        file_obj = self._tracked_reader(file_obj, current_transfer())
+        with self._upload_slot(), self.pool.connection() as conn:
+            conn.put_object(self.container, relative_path, file_obj, content_length=size)
+        return size
 
     def upload(self, relative_path, base_dir):
         """ Upload a file from base_dir/relative_path to swift. Returns the size of the file if successful."""
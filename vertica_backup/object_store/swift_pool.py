@@ -0,0 +1,251 @@
+""" Shared swift connections for all SwiftStore operations.
+    A TokenCache keeps keystone tokens in a file shared by all processes on the host and a ConnectionPool keeps
+    keep-alive swift connections built from those tokens.
+
+Copyright 2014 Hewlett-Packard Development Company, L.P.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software 
+and associated documentation files (the "Software"), to deal in the Software without restriction, 
+including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, 
+and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, 
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or 
+substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, 
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR 
+PURPOSE AND NONINFRINGEMENT.
+
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR 
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF 
+OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import Queue
+import stat
+import threading
+import time
+
+import swiftclient
+
+from ..metrics import run_metrics
+
+log = logging.getLogger(__name__)
+
+TOKEN_CACHE_NAME = 'vertica_backup_tokens.json'
+DEFAULT_TOKEN_CACHE = os.path.join(os.path.expanduser('~'), '.' + TOKEN_CACHE_NAME)
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class TokenCache(object):
+    """ Keystone tokens cached in a json file readable only by the owner, locked with flock so processes on the host
+        authenticate one at a time and reuse each others tokens. Tokens are considered expired ttl seconds after
+        they were issued, which should be less than the keystone token lifetime.
+        A cache file which is a symlink, not owned by this user or readable by others is not used, tokens are then
+        obtained for each pool without being shared.
+    """
+    def __init__(self, path=DEFAULT_TOKEN_CACHE, ttl=3600):
+        self.path = path
+        self.ttl = ttl
+
+    def _open(self):
+        """ Return the cache file descriptor, None if the file is unsafe to use. """
+        try:
+            cache_fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0600)
+        except OSError, ex:
+            log.error('Not using the token cache %s, it could not be opened: %s' % (self.path, ex))
+            return None
+        cache_stat = os.fstat(cache_fd)
+        if not stat.S_ISREG(cache_stat.st_mode) or cache_stat.st_uid != os.getuid() or \
+                stat.S_IMODE(cache_stat.st_mode) != 0600:
+            os.close(cache_fd)
+            log.error('Not using the token cache %s, it must be a regular file owned by uid %d with mode 0600' %
+                      (self.path, os.getuid()))
+            return None
+        return cache_fd
+
+    @contextmanager
+    def _locked(self):
+        """ Yield the cache contents and file, holding an exclusive lock. The file is None if the cache is unusable.
+        """
+        cache_fd = self._open()
+        if cache_fd is None:
+            yield {}, None
+            return
+        with os.fdopen(cache_fd, 'r+') as cache_file:
+            fcntl.flock(cache_file, fcntl.LOCK_EX)
+            try:
+                try:
+                    cache = json.loads(cache_file.read() or '{}')
+                except ValueError:
+                    log.warning('Ignoring corrupt token cache %s' % self.path)
+                    cache = {}
+                yield cache, cache_file
+            finally:
+                fcntl.flock(cache_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _write(cache, cache_file):
+        if cache_file is None:
+            return
+        cache_file.seek(0)
+        cache_file.truncate()
+        cache_file.write(json.dumps(cache))
+        cache_file.flush()
+
+    def get(self, key, auth):
+        """ Return the (storage url, token) cached for key, calling auth to get a new pair if there is no valid one.
+            The second return value is True if auth was called.
+        """
+        now = time.time()
+        with self._locked() as (cache, cache_file):
+            entry = cache.get(key)
+            if entry is not None and entry['expires'] > now:
+                return (entry['url'], entry['token']), False
+
+            url, token = auth()
+            cache[key] = {'url': url, 'token': token, 'expires': now + self.ttl}
+            # Drop expired tokens so the file does not grow
+            cache = dict((name, value) for name, value in cache.iteritems() if value['expires'] > now)
+            self._write(cache, cache_file)
+        return (url, token), True
+
+    def put(self, key, url, token):
+        """ Store a token obtained elsewhere, for example by swiftclient reauthenticating. """
+        with self._locked() as (cache, cache_file):
+            cache[key] = {'url': url, 'token': token, 'expires': time.time() + self.ttl}
+            self._write(cache, cache_file)
+
+    def invalidate(self, key, token):
+        """ Remove the token for key if it is still the given token. """
+        with self._locked() as (cache, cache_file):
+            if key in cache and cache[key]['token'] == token:
+                del cache[key]
+                self._write(cache, cache_file)
+
+
+def get_token_cache(config):
+    """ Return the TokenCache for the token_cache and token_ttl settings in the config, by default kept in log_dir. """
+    return TokenCache(config.get('token_cache', os.path.join(config['log_dir'], TOKEN_CACHE_NAME)),
+                      config.get('token_ttl', 3600))
+
+
+class ConnectionPool(object):
+    """ A pool of keep-alive swift connections for one set of credentials, safe to share between threads.
+        At most size connections are open at once. Time spent authenticating and setting up connections is recorded.
+    """
+    def __init__(self, url, user, key, tenant, region, token_cache=None, size=8):
+        self.url = url
+        self.user = user
+        self.key = key
+        self.tenant = tenant
+        self.region = region
+        if token_cache is None:
+            token_cache = TokenCache()
+        self.token_cache = token_cache
+        self.cache_key = hashlib.sha1('|'.join((url, user, tenant, region))).hexdigest()
+
+        self.idle = Queue.LifoQueue()  # LIFO so the warmest connections are reused first
+        self.slots = threading.Semaphore(size)
+        self.lock = threading.Lock()
+        self.auth_count = 0
+        self.auth_seconds = 0.0
+        self.connect_count = 0
+        self.connect_seconds = 0.0
+
+    def _auth(self):
+        start = time.time()
+        try:
+            return swiftclient.client.get_auth(self.url, self.user, self.key, auth_version=2,
+                                               os_options={'region_name': self.region, 'tenant_name': self.tenant})
+        finally:
+            with self.lock:
+                self.auth_count += 1
+                self.auth_seconds += time.time() - start
+
+    def _new_connection(self):
+        (storage_url, token), authenticated = self.token_cache.get(self.cache_key, self._auth)
+        start = time.time()
+        conn = swiftclient.client.Connection(self.url, self.user, self.key, preauthurl=storage_url,
+                                             preauthtoken=token, os_options={"region_name": self.region},
+                                             tenant_name=self.tenant, auth_version=2, retries=0)
+        conn.http_conn = conn.http_connection()
+        with self.lock:
+            self.connect_count += 1
+            self.connect_seconds += time.time() - start
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """ Yield a connection from the pool, returning it when done.
+            A connection which hit an error that leaves it in an unknown state is closed rather than returned, if the
+            error was an expired token the token is also removed from the cache.
+        """
+        self.slots.acquire()
+        try:
+            try:
+                conn = self.idle.get_nowait()
+            except Queue.Empty:
+                conn = self._new_connection()
+            token = conn.token
+
+            try:
+                yield conn
+            except swiftclient.ClientException, ex:
+                if ex.http_status == 401:
+                    self.token_cache.invalidate(self.cache_key, token)
+                if ex.http_status is None or ex.http_status in (401, 408) or ex.http_status >= 500:
+                    conn.close()
+                else:
+                    self.idle.put(conn)
+                raise
+            except Exception:
+                conn.close()
+                raise
+
+            if conn.token != token:  # swiftclient reauthenticated, share the new token
+                self.token_cache.put(self.cache_key, conn.url, conn.token)
+            self.idle.put(conn)
+        finally:
+            self.slots.release()
+
+
+def get_pool(url, user, key, tenant, region, token_cache=None, size=8):
+    """ Return the ConnectionPool for these credentials, creating it the first time it is requested.
+    """
+    pool_key = (url, user, tenant, region)
+    with _pools_lock:
+        if pool_key not in _pools:
+            _pools[pool_key] = ConnectionPool(url, user, key, tenant, region, token_cache, size)
+        return _pools[pool_key]
+
+
+def reset_pools():
+    """ Forget all pools without closing their connections, for use in a forked child which must not share the
+        parent's sockets.
+    """
+    with _pools_lock:
+        _pools.clear()
+
+
+def record_pool_stats():
+    """ Log and record in the run metrics the auth and connection setup counts and times summed over all pools.
+    """
+    with _pools_lock:
+        pools = _pools.values()
+    stats = (('auth_count', sum(pool.auth_count for pool in pools)),
+             ('auth_seconds', sum(pool.auth_seconds for pool in pools)),
+             ('connect_count', sum(pool.connect_count for pool in pools)),
+             ('connect_seconds', sum(pool.connect_seconds for pool in pools)))
+    for name, value in stats:
+        run_metrics.set(name, value)
+    log.info("Swift auth took %.1f seconds for %d auths, connection setup %.1f seconds for %d connections" %
+             (stats[1][1], stats[0][1], stats[3][1], stats[2][1]))
@@ -0,0 +1,128 @@
+""" Dry-run planning, estimating what a backup or restore would transfer and how long it would take without moving data.
+    Local metadata comes from the previous pickle with unhashed new files compared by size, store metadata from its
+    listing and durations are estimated from the throughput in the store's recent run statistics.
+
+Copyright 2014 Hewlett-Packard Development Company, L.P.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software 
+and associated documentation files (the "Software"), to deal in the Software without restriction, 
+including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, 
+and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, 
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or 
+substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, 
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR 
+PURPOSE AND NONINFRINGEMENT.
+
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR 
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF 
+OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+import json
+import logging
+import os
+
+from directory_metadata import DirectoryMetadata
+from history import list_stats, load_stats
+from utils import sizeof_fmt
+
+log = logging.getLogger(__name__)
+
+HISTORY_RUNS = 7  # Recent runs used for the throughput estimates
+
+
+def estimate_diff(source, dest):
+    """ Like DirectoryMetadata.diff but a file without a hash, one which was not hashed for the plan, is taken to be
+        unchanged if the size matches. Returns the paths to transfer and those only in dest.
+    """
+    to_transfer = set()
+    for path, file_metadata in source.metadata.iteritems():
+        other = dest.metadata.get(path)
+        if other is None or other.bytes != file_metadata.bytes:
+            to_transfer.add(path)
+        elif file_metadata.hash is not None and other.hash is not None and file_metadata.hash != other.hash:
+            to_transfer.add(path)
+    return to_transfer, set(dest.metadata.iterkeys()) - set(source.metadata.iterkeys())
+
+
+def estimate_retention(store, store_metadata, retain):
+    """ Return the paths retention would delete from the store, as apply_retention does it. """
+    combined = DirectoryMetadata()
+    for pickle in store.list_pickles()[:retain]:
+        combined.metadata.update(DirectoryMetadata.load_pickle(store, pickle).metadata)
+    return set(store_metadata.metadata.iterkeys()) - set(combined.metadata.iterkeys())
+
+
+def _median(values):
+    values = sorted(values)
+    if len(values) == 0:
+        return None
+    return values[len(values) // 2]
+
+
+def history_rates(store, runs=HISTORY_RUNS):
+    """ Return the median upload bytes per second and delete objects per second over the store's recent runs,
+        either is None without history.
+    """
+    transfer = []
+    delete = []
+    for name in list_stats(store)[:runs]:
+        try:
+            record = load_stats(store, name)
+        except Exception:
+            log.exception('Error reading stats record %s from %s' % (name, store))
+            continue
+        if 'upload' in record['throughput']:
+            transfer.append(record['throughput']['upload'])
+        deleted = record['counters'].get('objects_deleted', 0)
+        if deleted > 0 and record['phases'].get('delete', 0) > 0:
+            delete.append(deleted / record['phases']['delete'])
+    return _median(transfer), _median(delete)
+
+
+def metrics_rate(json_path, phase):
+    """ Return the throughput of phase from a run metrics json file, None if the file or phase is missing. """
+    if not os.path.exists(json_path):
+        return None
+    with open(json_path) as metrics_file:
+        metrics = json.load(metrics_file)
+    rates = [entry['value'] for entry in metrics.get('throughput', []) if entry['name'] == phase]
+    return _median(rates)
+
+
+def plan_entry(target, operation, paths, metadata, rate, unit='bytes'):
+    """ Build one row of a plan, rate is bytes or objects per second according to unit. """
+    size = sum(metadata.metadata[path].bytes for path in paths)
+    if len(paths) == 0:
+        seconds = 0
+    elif rate is None:
+        seconds = None
+    elif unit == 'bytes':
+        seconds = size / rate
+    else:
+        seconds = len(paths) / rate
+    return {'target': str(target), 'operation': operation, 'objects': len(paths), 'bytes': size, 'seconds': seconds}
+
+
+def print_plan(entries):
+    """ Print the plan rows with a total, returning the estimated seconds or None if any row has no estimate. """
+    print '%-45s %-10s %10s %12s %12s' % ('Target', 'Operation', 'Objects', 'Size', 'Estimate')
+    total = 0
+    for entry in entries:
+        if entry['seconds'] is None:
+            estimate = 'unknown'
+            total = None
+        else:
+            estimate = '%.1fm' % (entry['seconds'] / 60)
+            if total is not None:
+                total += entry['seconds']
+        print '%-45s %-10s %10d %12s %12s' % (entry['target'], entry['operation'], entry['objects'],
+                                             sizeof_fmt(entry['bytes']), estimate)
+    if total is None:
+        print 'No throughput history for some targets, the total duration can not be estimated.'
+    else:
+        print 'Estimated total duration %d minutes.' % (total / 60)
+    return total
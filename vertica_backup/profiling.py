@@ -0,0 +1,260 @@
+""" Opt-in profiling of backup and restore runs.
+    When enabled each LogTime phase is run under cProfile and gets a memory snapshot when it ends, while a sampler
+    thread records memory use and what each thread is running at a fixed interval. Everything is written to a
+    directory under the log dir and can be summarized with vertica_profile_report.
+
+Copyright 2014 Hewlett-Packard Development Company, L.P.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software 
+and associated documentation files (the "Software"), to deal in the Software without restriction, 
+including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, 
+and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, 
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or 
+substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, 
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR 
+PURPOSE AND NONINFRINGEMENT.
+
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR 
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF 
+OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+import cProfile
+from collections import Counter
+from datetime import datetime
+import gc
+import json
+import logging
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+
+try:
+    import tracemalloc
+except ImportError:  # Only available in python 3 or with pytracemalloc
+    tracemalloc = None
+
+log = logging.getLogger(__name__)
+
+
+def _rss_bytes():
+    """ The resident set size of this process, from /proc where available. """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        return 0
+
+
+class Profiler(object):
+    """ Profiles LogTime phases and samples the process at an interval while enabled.
+        Nested phases in one thread are profiled exclusively, the outer phase is paused while the inner runs.
+        Threads started while enabled, such as the upload threads, are each profiled outside their own phases and
+        written together as threads.prof when profiling stops.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.out_dir = None
+        self.interval = None
+        self.sequence = 0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.active = {}  # thread ident to the name of the phase being profiled
+        self.thread_profiles = []
+        self.sampler = None
+        self.stop_event = threading.Event()
+
+    def start(self, log_dir, name, interval=10):
+        """ Enable profiling, writing to a new directory in log_dir named for this run. """
+        self.out_dir = os.path.join(log_dir, 'profile_%s_%s' % (name, datetime.today().strftime('%Y_%m_%d_%H%M%S')))
+        os.makedirs(self.out_dir)
+        self.interval = interval
+        self.enabled = True
+        if tracemalloc is not None:
+            tracemalloc.start(25)
+        else:
+            log.warning('tracemalloc is not available, memory snapshots are limited to counts of live objects by type')
+        self.stop_event.clear()
+        self.sampler = threading.Thread(target=self._sample, name='profile-sampler')
+        self.sampler.daemon = True
+        self.sampler.start()
+        threading.setprofile(self._profile_thread)
+        log.info('Profiling enabled, writing to %s' % self.out_dir)
+
+    def stop(self):
+        if not self.enabled:
+            return
+        self.enabled = False
+        threading.setprofile(None)
+        self.stop_event.set()
+        self.sampler.join()
+        if tracemalloc is not None:
+            tracemalloc.stop()
+
+        with self.lock:
+            profiles = self.thread_profiles
+            self.thread_profiles = []
+        if len(profiles) > 0:
+            try:
+                stats = pstats.Stats(profiles[0])
+                for profile in profiles[1:]:
+                    stats.add(profile)
+                stats.dump_stats(os.path.join(self.out_dir, 'threads.prof'))
+            except Exception:
+                log.exception('Error writing the thread profile data')
+            # Collecting the stats disables profiling in this thread
+            stack = self._stack()
+            if len(stack) > 0:
+                stack[-1][1].enable()
+
+    def _profile_thread(self, frame, event, arg):
+        """ Set by threading.setprofile to run first in each new thread, replacing itself with a profiler for the
+            thread. The profile sits at the bottom of the thread's phase stack so its own phases pause it.
+        """
+        sys.setprofile(None)
+        if not self.enabled:
+            return
+        name = 'thread_%s' % threading.current_thread().name
+        profile = cProfile.Profile()
+        with self.lock:
+            self.thread_profiles.append(profile)
+            self.active[threading.current_thread().ident] = name
+        self._stack().append((name, profile))
+        profile.enable()
+
+    def _stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def phase_start(self, phase, labels=None):
+        if not self.enabled:
+            return
+        name = phase
+        if labels:
+            name += '_' + '_'.join(str(value) for key, value in sorted(labels.iteritems()))
+        name = re.sub(r'[^A-Za-z0-9_.-]+', '_', name)
+        with self.lock:
+            self.sequence += 1
+            name = '%03d_%s' % (self.sequence, name)
+            self.active[threading.current_thread().ident] = name
+
+        stack = self._stack()
+        if len(stack) > 0:
+            stack[-1][1].disable()
+        profile = cProfile.Profile()
+        stack.append((name, profile))
+        profile.enable()
+
+    def phase_end(self):
+        if not self.enabled:
+            return
+        stack = self._stack()
+        if len(stack) == 0:
+            return
+        name, profile = stack.pop()
+        profile.disable()
+        try:
+            profile.dump_stats(os.path.join(self.out_dir, name + '.prof'))
+            self._memory_snapshot(name)
+        except Exception:
+            log.exception('Error writing profile data for %s' % name)
+
+        with self.lock:
+            if len(stack) > 0:
+                self.active[threading.current_thread().ident] = stack[-1][0]
+            else:
+                self.active.pop(threading.current_thread().ident, None)
+        if len(stack) > 0:
+            stack[-1][1].enable()
+
+    def _memory_snapshot(self, name):
+        """ Save a tracemalloc snapshot, or without tracemalloc a count of live objects by type. """
+        if tracemalloc is not None:
+            tracemalloc.take_snapshot().dump(os.path.join(self.out_dir, name + '.tracemalloc'))
+        else:
+            counts = Counter(type(obj).__name__ for obj in gc.get_objects())
+            with open(os.path.join(self.out_dir, name + '.objects.json'), 'w') as objects_file:
+                json.dump({'rss_bytes': _rss_bytes(), 'objects': counts.most_common(50)}, objects_file)
+
+    def _sample(self):
+        """ Append a sample of memory use and the innermost function of each thread to samples.jsonl. """
+        with open(os.path.join(self.out_dir, 'samples.jsonl'), 'a') as samples:
+            while not self.stop_event.wait(self.interval):
+                with self.lock:
+                    active = dict(self.active)
+                threads = {}
+                for ident, frame in sys._current_frames().iteritems():
+                    if ident == threading.current_thread().ident:
+                        continue
+                    code = frame.f_code
+                    threads[str(ident)] = {'phase': active.get(ident), 'function': '%s:%d(%s)' % (
+                        code.co_filename, frame.f_lineno, code.co_name)}
+                sample = {'time': time.time(), 'rss_bytes': _rss_bytes(), 'threads': threads}
+                if tracemalloc is not None:
+                    sample['traced_bytes'], sample['traced_peak_bytes'] = tracemalloc.get_traced_memory()
+                samples.write(json.dumps(sample) + '\n')
+                samples.flush()
+
+
+def report(profile_dir, top=15):
+    """ Print the hottest functions and largest allocations for each phase in a profile directory. """
+    names = sorted(set(os.path.splitext(fname)[0] for fname in os.listdir(profile_dir) if fname.endswith('.prof')))
+    for name in names:
+        print '=== Phase %s ===' % name
+        stats = pstats.Stats(os.path.join(profile_dir, name + '.prof'))
+        print 'Hottest functions by internal time:'
+        stats.sort_stats('time').print_stats(top)
+
+        tracemalloc_path = os.path.join(profile_dir, name + '.tracemalloc')
+        objects_path = os.path.join(profile_dir, name + '.objects.json')
+        if os.path.exists(tracemalloc_path) and tracemalloc is not None:
+            print 'Largest allocations at the end of the phase:'
+            for stat in tracemalloc.Snapshot.load(tracemalloc_path).statistics('lineno')[:top]:
+                print '\t%s' % stat
+        elif os.path.exists(objects_path):
+            with open(objects_path) as objects_file:
+                objects = json.load(objects_file)
+            print 'Most common objects at the end of the phase, rss %d bytes:' % objects['rss_bytes']
+            for type_name, count in objects['objects'][:top]:
+                print '\t%10d %s' % (count, type_name)
+        print
+
+    samples_path = os.path.join(profile_dir, 'samples.jsonl')
+    if os.path.exists(samples_path):
+        functions = Counter()
+        peak_rss = 0
+        with open(samples_path) as samples:
+            for line in samples:
+                sample = json.loads(line)
+                peak_rss = max(peak_rss, sample['rss_bytes'])
+                for thread in sample['threads'].itervalues():
+                    functions[(thread['phase'], thread['function'])] += 1
+        print '=== Samples, peak rss %d bytes ===' % peak_rss
+        for (phase, function), count in functions.most_common(top):
+            print '\t%6d %s %s' % (count, phase, function)
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    if len(argv) not in (2, 3):
+        print "Usage: " + argv[0] + " <profile dir> [top count]"
+        print "The profile dir is one of the profile_* directories written to the log dir by a profiled run"
+        return 1
+    if len(argv) == 3:
+        report(argv[1], int(argv[2]))
+    else:
+        report(argv[1])
+
+
+run_profiler = Profiler()
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,188 @@
+""" Live progress of long running transfers.
+    Each upload, download or delete loop registers a tracker with run_progress, which rewrites a small json status
+    file with bytes and objects done, throughput and ETA every few seconds.
+
+Copyright 2014 Hewlett-Packard Development Company, L.P.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software 
+and associated documentation files (the "Software"), to deal in the Software without restriction, 
+including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, 
+and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, 
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or 
+substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, 
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR 
+PURPOSE AND NONINFRINGEMENT.
+
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR 
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF 
+OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+from contextlib import contextmanager
+import json
+import logging
+import threading
+import time
+
+from metrics import write_atomic
+
+log = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class Transfer(object):
+    """ The bytes moved so far of one object being transferred, counted by its tracker until the object is done. """
+    def __init__(self, tracker):
+        self.tracker = tracker
+
+    def advance(self, size):
+        with self.tracker.reporter.lock:
+            self.tracker.partial[self] = self.tracker.partial.get(self, 0) + size
+        self.tracker.reporter.maybe_write()
+
+
+class ProgressReader(object):
+    """ A file like object counting reads from file_obj as progress of the transfer. """
+    def __init__(self, file_obj, transfer):
+        self.file_obj = file_obj
+        self.transfer = transfer
+
+    def read(self, size=-1):
+        data = self.file_obj.read(size)
+        self.transfer.advance(len(data))
+        return data
+
+
+def current_transfer():
+    """ Return the Transfer this thread is running, None outside of Tracker.transfer. Stores report the bytes they
+        move through it so the status stays current during large objects.
+    """
+    return getattr(_local, 'transfer', None)
+
+
+class Tracker(object):
+    """ The progress of a single transfer loop. """
+    def __init__(self, reporter, operation, store, total_bytes, total_objects):
+        self.reporter = reporter
+        self.operation = operation
+        self.store = store
+        self.total_bytes = total_bytes
+        self.total_objects = total_objects
+        self.bytes_done = 0
+        self.objects_done = 0
+        self.partial = {}  # Bytes of objects still being transferred, by Transfer
+        self.started = time.time()
+        self.finished = None
+        # The bytes done at the previous write, for the current throughput
+        self.window_start = self.started
+        self.window_bytes = 0
+        self.throughput = 0.0
+
+    def update(self, size, objects=1):
+        with self.reporter.lock:
+            self.partial.pop(current_transfer(), None)
+            self.bytes_done += size
+            self.objects_done += objects
+        self.reporter.maybe_write()
+
+    @contextmanager
+    def transfer(self):
+        """ A context in which this thread transfers one object, its bytes are counted as they move until update is
+            called for the finished object or the transfer fails.
+        """
+        transfer = Transfer(self)
+        previous = current_transfer()
+        _local.transfer = transfer
+        try:
+            yield transfer
+        finally:
+            _local.transfer = previous
+            with self.reporter.lock:
+                self.partial.pop(transfer, None)
+
+    def finish(self):
+        with self.reporter.lock:
+            self.finished = time.time()
+        self.reporter.write()
+
+    def status(self, now):
+        """ Return the status as a dictionary, moving the throughput window along. Called with the lock held.
+            Bytes of objects part way through are included, up to the total.
+        """
+        bytes_done = min(self.bytes_done + sum(self.partial.itervalues()), max(self.total_bytes, self.bytes_done))
+        if now > self.window_start:
+            self.throughput = max(bytes_done - self.window_bytes, 0) / (now - self.window_start)
+            self.window_start = now
+            self.window_bytes = bytes_done
+
+        end = self.finished or now
+        average = bytes_done / (end - self.started) if end > self.started else 0.0
+        rate = self.throughput or average
+        remaining = self.total_bytes - bytes_done
+        if self.finished is not None or remaining <= 0:
+            eta = 0
+        elif rate > 0:
+            eta = int(remaining / rate)
+        else:
+            eta = None
+        return {
+            'operation': self.operation,
+            'store': self.store,
+            'bytes_done': bytes_done,
+            'bytes_total': self.total_bytes,
+            'objects_done': self.objects_done,
+            'objects_total': self.total_objects,
+            'throughput_bytes_per_second': self.throughput,
+            'average_bytes_per_second': average,
+            'eta_seconds': eta,
+            'started': self.started,
+            'finished': self.finished,
+        }
+
+
+class ProgressReporter(object):
+    """ Writes the status of all trackers to a json file, at most once per interval while transfers are running.
+        Until started with a path no file is written and the trackers only count.
+    """
+    def __init__(self):
+        self.path = None
+        self.interval = 5
+        self.lock = threading.Lock()
+        self.trackers = []
+        self.last_write = 0
+
+    def start(self, path, interval=5):
+        self.path = path
+        self.interval = interval
+        self.trackers = []
+        self.write()
+
+    def track(self, operation, store, total_bytes, total_objects):
+        tracker = Tracker(self, operation, store, total_bytes, total_objects)
+        with self.lock:
+            self.trackers.append(tracker)
+        self.write()
+        return tracker
+
+    def maybe_write(self):
+        if self.path is not None and time.time() - self.last_write >= self.interval:
+            self.write()
+
+    def write(self):
+        if self.path is None:
+            return
+        with self.lock:
+            now = time.time()
+            self.last_write = now
+            status = {'updated': now, 'transfers': [tracker.status(now) for tracker in self.trackers]}
+            try:
+                write_atomic(self.path, json.dumps(status, indent=2, sort_keys=True))
+            except (IOError, OSError):
+                log.exception('Error writing the progress file %s' % self.path)
+
+
+run_progress = ProgressReporter()
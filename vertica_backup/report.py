@@ -0,0 +1,168 @@
+""" Report trends in the run statistics kept in the stores across nodes and days.
+    Nodes whose latest upload throughput has fallen well below their own recent history are flagged as regressed,
+    useful for spotting problems and for capacity planning as the database grows.
+
+Copyright 2014 Hewlett-Packard Development Company, L.P.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software 
+and associated documentation files (the "Software"), to deal in the Software without restriction, 
+including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, 
+and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, 
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or 
+substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, 
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR 
+PURPOSE AND NONINFRINGEMENT.
+
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR 
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF 
+OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+from datetime import datetime, timedelta
+import logging
+import sys
+import yaml
+
+from backup import get_stores
+from history import list_stats, load_stats, record_date
+from object_store.swift import SwiftStore
+from utils import calculate_paths, sizeof_fmt
+
+log = logging.getLogger(__name__)
+
+REGRESSION_THRESHOLD = 0.3  # Flag a drop in throughput of more than this fraction of the recent median
+MIN_HISTORY = 3  # Runs needed before regressions are flagged
+MIN_BYTES = 100 * 1024 * 1024  # Smaller uploads are dominated by per object overhead so their throughput is ignored
+
+
+def node_stores(config, prefix_dir):
+    """ Yield each store the backups are written to, for swift stores also the stores of the other nodes in the domain.
+    """
+    for store, retain in get_stores(config, prefix_dir):
+        yield store
+        if isinstance(store, SwiftStore):
+            for hostname in store.domain_hostnames():
+                if hostname != store.hostname:
+                    yield SwiftStore(store.key, store.region, store.tenant, store.url, store.user, prefix_dir,
+                                     domain=store.domain, hostname=hostname, retry_policy=store.retry_policy,
+                                     pool=store.pool)
+
+
+def collect(stores, since):
+    """ Return the stats records newer than since from all stores grouped by (hostname, store), oldest first.
+    """
+    history = {}
+    for store in stores:
+        for name in list_stats(store):
+            if name[:10] < since.strftime('%Y_%m_%d'):
+                break  # Newest first so the rest are older
+            try:
+                record = load_stats(store, name)
+            except Exception:
+                log.exception('Error reading stats record %s from %s' % (name, store))
+                continue
+            history.setdefault((record['hostname'], record['store']), []).append(record)
+    for records in history.itervalues():
+        records.sort(key=record_date)
+    return history
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2 == 1:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def upload_rate(record):
+    """ The upload throughput of a run in bytes per second or None if it moved too little data to be meaningful. """
+    if record['counters'].get('bytes_uploaded', 0) < MIN_BYTES:
+        return None
+    return record['throughput'].get('upload')
+
+
+def regressed(records, threshold=REGRESSION_THRESHOLD):
+    """ Return the fractional drop of the latest upload throughput relative to the median of the earlier runs, or
+        None if it has not dropped by more than threshold or there is too little history to say.
+    """
+    rates = [rate for rate in (upload_rate(record) for record in records) if rate is not None]
+    if len(rates) <= MIN_HISTORY:
+        return None
+    baseline = median(rates[:-1])
+    drop = 1 - float(rates[-1]) / baseline
+    if drop > threshold:
+        return drop
+    return None
+
+
+def report(history, threshold=REGRESSION_THRESHOLD):
+    """ Print per node trends and cluster wide daily totals. Returns the number of nodes flagged as regressed.
+    """
+    flagged = 0
+    print '=== Nodes ==='
+    print '%-20s %-40s %5s %10s %10s %10s %12s %12s' % ('Host', 'Store', 'Runs', 'Size', 'Growth', 'Uploaded',
+                                                       'Rate/s', 'Median/s')
+    for (hostname, store), records in sorted(history.iteritems()):
+        latest = records[-1]
+        rates = [rate for rate in (upload_rate(record) for record in records) if rate is not None]
+        rate = upload_rate(latest)
+        print '%-20s %-40s %5d %10s %10s %10s %12s %12s' % (
+            hostname, store, len(records), sizeof_fmt(latest['snapshot_bytes']),
+            sizeof_fmt(latest['snapshot_bytes'] - records[0]['snapshot_bytes']),
+            sizeof_fmt(latest['counters'].get('bytes_uploaded', 0)),
+            '-' if rate is None else sizeof_fmt(rate), '-' if len(rates) == 0 else sizeof_fmt(median(rates)))
+        drop = regressed(records, threshold)
+        if drop is not None:
+            flagged += 1
+            print '\tREGRESSED: upload throughput %d%% below the median of the previous %d runs' % \
+                  (drop * 100, len(rates) - 1)
+
+    print
+    print '=== Days ==='
+    print '%-10s %5s %12s %12s %12s %10s' % ('Day', 'Nodes', 'Size', 'Uploaded', 'Deleted', 'Longest')
+    days = {}
+    for records in history.itervalues():
+        for record in records:
+            days.setdefault(record['date'][:10], []).append(record)
+    for day, records in sorted(days.iteritems()):
+        print '%-10s %5d %12s %12s %12s %9dm' % (
+            day, len(set(record['hostname'] for record in records)),
+            sizeof_fmt(sum(record['snapshot_bytes'] for record in records)),
+            sizeof_fmt(sum(record['counters'].get('bytes_uploaded', 0) for record in records)),
+            sizeof_fmt(sum(record['counters'].get('bytes_deleted', 0) for record in records)),
+            max(record['duration'] for record in records) / 60)
+    return flagged
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    if len(argv) not in (2, 3):
+        print "Usage: " + argv[0] + " <config file> [days]"
+        print "The config file is the same format as used for backups, the stores it lists are read for run statistics"
+        print "Statistics from the last 30 days are reported unless the number of days is specified"
+        print "Exits with status 1 if any node's upload throughput has regressed"
+        return 1
+
+    config = yaml.load(open(argv[1], 'r'))
+    days = 30
+    if len(argv) == 3:
+        days = int(argv[2])
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.WARNING)
+
+    base_dir, prefix_dir = calculate_paths(config)
+    history = collect(node_stores(config, prefix_dir), datetime.today() - timedelta(days=days))
+    if len(history) == 0:
+        print 'No run statistics found in the last %d days.' % days
+        return 0
+    if report(history, config.get('report_regression_threshold', REGRESSION_THRESHOLD)) > 0:
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,319 @@
+""" Restore a whole cluster, running vertica_restore_download on every node in parallel over ssh.
+    The nodes share one bandwidth budget, their progress files are polled to show combined progress with a single ETA
+    and a node whose download fails is restarted without disturbing the others. The download being incremental a
+    restarted node picks up where it left off. The vbr restore itself is still run separately, see restore/README.md.
+
+Copyright 2014 Hewlett-Packard Development Company, L.P.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software 
+and associated documentation files (the "Software"), to deal in the Software without restriction, 
+including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, 
+and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, 
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or 
+substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, 
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR 
+PURPOSE AND NONINFRINGEMENT.
+
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR 
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF 
+OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+import argparse
+import json
+import logging
+import os
+import pipes
+import re
+import subprocess
+import sys
+import time
+
+from metrics import write_atomic
+from utils import sizeof_fmt
+
+log = logging.getLogger(__name__)
+
+DAY = re.compile(r'^\d{4}_\d{2}_\d{2}$')
+
+
+class NodeDownload(object):
+    """ The download to one node, run as a remote vertica_restore_download process over ssh. Unless a progress path
+        is given the progress file goes in a private directory made on the node by the user the download runs as.
+    """
+    def __init__(self, host, vnode, log_dir, ssh=None, sudo=False, progress_path=None):
+        self.host = host
+        self.vnode = vnode
+        self.log_path = os.path.join(log_dir, 'restore_%s.log' % host)
+        self.ssh = ssh
+        self.sudo = sudo
+        self.progress_path = progress_path
+        self.work_dir = None
+        self.process = None
+        self.attempts = 0
+        self.state = 'pending'
+        self.progress = {}
+        self.share = None
+
+    def command_line(self, command):
+        """ Return the shell command line run on the node for the command argument list. """
+        if self.sudo:
+            command = ['sudo', '-i'] + command
+        return ' '.join(pipes.quote(arg) for arg in command)
+
+    def remote(self, command, **kwargs):
+        return subprocess.Popen(self.ssh + [self.host, self.command_line(command)], stdin=open(os.devnull), **kwargs)
+
+    def prepare(self):
+        """ Make the private directory for the progress file if no progress path was given. """
+        if self.progress_path is not None:
+            return
+        mktemp = self.remote(['mktemp', '-d', '-t', 'vertica_restore.XXXXXX'], stdout=subprocess.PIPE)
+        work_dir = mktemp.communicate()[0].strip()
+        if mktemp.returncode != 0 or work_dir == '':
+            raise RuntimeError('Unable to make a directory for the download progress on %s' % self.host)
+        self.work_dir = work_dir
+        self.progress_path = os.path.join(work_dir, 'restore_progress.json')
+
+    @property
+    def bandwidth_path(self):
+        """ The file on the node the download follows for changes to its bandwidth share. """
+        return os.path.join(os.path.dirname(self.progress_path), 'restore_bandwidth')
+
+    def set_bandwidth(self, share):
+        """ Write the bandwidth share to the node, replacing the file so a partial write is never read. """
+        script = 'echo %d > %s.new && mv %s.new %s' % ((share,) + (pipes.quote(self.bandwidth_path),) * 3)
+        writer = self.remote(['sh', '-c', script], stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+        if writer.wait() != 0:
+            raise RuntimeError('Unable to set the bandwidth of the download on %s' % self.host)
+        self.share = share
+
+    def start(self, command):
+        self.attempts += 1
+        self.state = 'running'
+        self.progress = {}
+        with open(self.log_path, 'a') as log_file:
+            self.process = self.remote(command, stdout=log_file, stderr=subprocess.STDOUT)
+        log.info('Started download to %s (%s), attempt %d' % (self.host, self.vnode, self.attempts))
+
+    def poll(self):
+        """ Update the state from the remote process, returning its exit code once it has finished. """
+        if self.process is None:
+            return None
+        returncode = self.process.poll()
+        if returncode is not None:
+            self.process = None
+            self.state = 'done' if returncode == 0 else 'failed'
+        return returncode
+
+    def fetch_progress(self):
+        """ Read the progress file of the remote download, keeping the last good copy on errors. """
+        reader = self.remote(['cat', self.progress_path], stdout=subprocess.PIPE, stderr=open(os.devnull, 'w'))
+        output = reader.communicate()[0]
+        if reader.returncode == 0:
+            try:
+                self.progress = json.loads(output)
+            except ValueError:
+                pass
+
+    def cleanup(self):
+        """ Remove the directory made by prepare. """
+        if self.work_dir is not None:
+            self.remote(['rm', '-rf', self.work_dir], stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT).wait()
+            self.work_dir = None
+
+    def summary(self):
+        """ Return bytes done, bytes total, current throughput and eta in seconds of the download transfer. """
+        for transfer in self.progress.get('transfers', []):
+            if transfer['operation'] == 'download':
+                return (transfer['bytes_done'], transfer['bytes_total'], transfer['throughput_bytes_per_second'],
+                        transfer['eta_seconds'])
+        return 0, 0, 0.0, None
+
+
+class ClusterRestore(object):
+    """ Runs and watches the downloads to all nodes. The bandwidth budget in bytes per second is split evenly between
+        the nodes downloading, as nodes finish or fail their share is passed to those still running.
+        Subclasses override make_node to run the node downloads another way, the fabfile uses fabric's sudo.
+    """
+    def __init__(self, nodes, config, domain, day, snapshot_name=None, bandwidth=None, retries=2, ssh=None,
+                 sudo=False, progress_path=None, log_dir='.', interval=10):
+        self.config = config
+        self.domain = domain
+        self.day = day
+        self.snapshot_name = snapshot_name
+        self.bandwidth = bandwidth
+        self.retries = retries
+        self.ssh = ssh or ['ssh', '-o', 'BatchMode=yes', '-o', 'ConnectTimeout=30']
+        self.sudo = sudo
+        self.progress_path = progress_path
+        self.status_path = os.path.join(log_dir, 'restore_cluster.json')
+        self.interval = interval
+        self.nodes = [self.make_node(host, vnode, log_dir) for host, vnode in nodes]
+
+    def make_node(self, host, vnode, log_dir):
+        return NodeDownload(host, vnode, log_dir, self.ssh, self.sudo, self.progress_path)
+
+    def remote_command(self, node, share):
+        """ Return the vertica_restore_download argument list for the node. """
+        settings = ['restore_progress_file=%s' % node.progress_path]
+        if self.snapshot_name is not None:
+            settings.append('snapshot_name=%s' % self.snapshot_name)
+        if share is not None:
+            settings.append('restore_bandwidth=%d' % share)
+            settings.append('restore_bandwidth_file=%s' % node.bandwidth_path)
+        command = ['vertica_restore_download']
+        for setting in settings:
+            command.extend(['--set', setting])
+        command.extend([self.config, self.domain, node.vnode, self.day])
+        return command
+
+    def start(self, node, active):
+        share = None
+        if self.bandwidth is not None:
+            share = self.bandwidth / max(active, 1)
+        node.prepare()
+        if share is not None:  # Replaces any share left from an earlier attempt
+            node.set_bandwidth(share)
+        node.start(self.remote_command(node, share))
+
+    def rebalance(self):
+        """ Split the bandwidth between the nodes still running, updating those whose share changed. """
+        running = [node for node in self.nodes if node.state == 'running']
+        if self.bandwidth is None or len(running) == 0:
+            return
+        share = self.bandwidth / len(running)
+        for node in running:
+            if node.share != share:
+                try:
+                    node.set_bandwidth(share)
+                    log.info('Download to %s now has %s/s' % (node.host, sizeof_fmt(share)))
+                except Exception:
+                    log.exception('Error rebalancing the bandwidth of %s' % node.host)
+
+    def status(self):
+        """ Return the combined status, the cluster ETA is that of the slowest node. """
+        nodes = {}
+        done = total = 0
+        throughput = 0.0
+        eta = 0
+        for node in self.nodes:
+            node_done, node_total, node_throughput, node_eta = node.summary()
+            done += node_done
+            total += node_total
+            if node.state == 'running':
+                throughput += node_throughput
+                if node_eta is None or eta is None:
+                    eta = None
+                else:
+                    eta = max(eta, node_eta)
+            nodes[node.host] = {'vnode': node.vnode, 'state': node.state, 'attempts': node.attempts,
+                                'bytes_done': node_done, 'bytes_total': node_total, 'eta_seconds': node_eta}
+        return {'updated': time.time(), 'bytes_done': done, 'bytes_total': total,
+                'throughput_bytes_per_second': throughput, 'eta_seconds': eta, 'nodes': nodes}
+
+    def report(self):
+        status = self.status()
+        write_atomic(self.status_path, json.dumps(status, indent=2, sort_keys=True))
+        states = [node.state for node in self.nodes]
+        eta = 'unknown' if status['eta_seconds'] is None else '%dm' % (status['eta_seconds'] / 60)
+        print '%s of %s downloaded at %s/s, ETA %s. Nodes running %d, done %d, failed %d' % (
+            sizeof_fmt(status['bytes_done']), sizeof_fmt(status['bytes_total']),
+            sizeof_fmt(status['throughput_bytes_per_second']), eta,
+            states.count('running'), states.count('done'), states.count('failed'))
+        sys.stdout.flush()
+
+    def run(self):
+        """ Run the downloads until every node is done or out of retries. Returns an exit status. """
+        try:
+            return self.run_nodes()
+        finally:
+            for node in self.nodes:
+                node.cleanup()
+
+    def run_nodes(self):
+        for node in self.nodes:
+            self.start(node, len(self.nodes))
+
+        while True:
+            for node in self.nodes:
+                returncode = node.poll()
+                if returncode is not None and returncode != 0:
+                    log.error('Download to %s failed with exit status %d, see %s' %
+                              (node.host, returncode, node.log_path))
+                    if node.attempts <= self.retries:
+                        active = len([other for other in self.nodes if other.state in ('running', 'failed')])
+                        self.start(node, active)
+                elif node.state == 'running':
+                    node.fetch_progress()
+
+            self.rebalance()
+            self.report()
+            if not any(node.state == 'running' for node in self.nodes):
+                break
+            time.sleep(self.interval)
+
+        failed = [node.host for node in self.nodes if node.state != 'done']
+        if len(failed) > 0:
+            print 'Downloads failed for %s after %d retries' % (', '.join(failed), self.retries)
+            return 1
+        print 'Downloads complete on all %d nodes' % len(self.nodes)
+        return 0
+
+
+def discover_nodes(ssh, host, dbname):
+    """ Return (address, vnode) for each node of dbname listed in the admintools.conf on host. """
+    output = subprocess.check_output(ssh + [host, 'grep ^v_%s_node /opt/vertica/config/admintools.conf' % dbname])
+    nodes = []
+    for line in output.splitlines():
+        name, address = line.split(',')[0].split('=')
+        nodes.append((address.strip(), name.strip()))
+    return sorted(nodes, key=lambda node: node[1])
+
+
+def valid_day(day):
+    """ argparse type for the day, an empty or malformed day would otherwise match any backup. """
+    if DAY.match(day) is None:
+        raise argparse.ArgumentTypeError('%r is not a day in the form YYYY_MM_DD' % day)
+    return day
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Download a backup to every node of a cluster in parallel.')
+    parser.add_argument('config', help='Path of the backup config on the nodes')
+    parser.add_argument('domain', help='The domain to restore from swift')
+    parser.add_argument('day', type=valid_day, help='YYYY_MM_DD, the newest backup of this day is restored')
+    parser.add_argument('--node', action='append', default=[], metavar='HOST:VNODE',
+                        help='A node to restore to and the vertica node name it restores, may be repeated')
+    parser.add_argument('--discover', metavar='HOST', help='Find the nodes from the admintools.conf on this host')
+    parser.add_argument('--dbname', help='The database name, needed with --discover')
+    parser.add_argument('--snapshot-name', help='Override snapshot_name in the config on each node')
+    parser.add_argument('--bandwidth', type=int, help='Total bytes per second for all nodes together')
+    parser.add_argument('--retries', type=int, default=2, help='Times to restart a failed node download')
+    parser.add_argument('--sudo', action='store_true', help='Run the remote downloads with sudo -i')
+    parser.add_argument('--progress-path',
+                        help='Progress file path on the nodes, by default it goes in a private temporary directory')
+    parser.add_argument('--log-dir', default='.', help='Where node logs and the combined status are written')
+    parser.add_argument('--interval', type=int, default=10, help='Seconds between progress updates')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+    ssh = ['ssh', '-o', 'BatchMode=yes', '-o', 'ConnectTimeout=30']
+    nodes = [tuple(node.split(':', 1)) for node in args.node]
+    if args.discover is not None:
+        if args.dbname is None:
+            parser.error('--dbname is required with --discover')
+        nodes.extend(discover_nodes(ssh, args.discover, args.dbname))
+    if len(nodes) == 0:
+        parser.error('No nodes given, use --node or --discover')
+
+    restore = ClusterRestore(nodes, args.config, args.domain, args.day, args.snapshot_name, args.bandwidth,
+                             args.retries, ssh, args.sudo, args.progress_path, args.log_dir, args.interval)
+    return restore.run()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
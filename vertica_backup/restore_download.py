@@ -4,6 +4,8 @@
 Download a restore from Vertica to the local disk. This script does not run the vbr restore process.
 The script will always grab the latest DirectoryMetadata in swift and compare that with a new DirectoryMetadata
 of the local disk, in this way only doing incremental downloads as needed.
+In watch mode it keeps a warm standby in a separate dir, polling swift and downloading each new backup as it appears,
+which later restores take unchanged files from.
 
 Copyright 2014 Hewlett-Packard Development Company, L.P.
 
@@ -25,54 +27,363 @@ OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FR
 OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
+import fcntl
+import fnmatch
 import logging
 import os
+import shutil
 import sys
+import threading
+import time
 import yaml
 
 from directory_metadata import DirectoryMetadata
 from epoch import EpochFiles
-from object_store.swift import SwiftStore
+from object_store.swift import RangePolicy, SwiftStore
 from object_store.fs import FSStore
-from utils import calculate_paths, choose_one, delete_pickles, LogTime, sizeof_fmt
+from metrics import run_metrics, write_run_metrics
+from object_store.swift_pool import get_pool, get_token_cache, record_pool_stats
+import plan
+from profiling import run_profiler
+from progress import run_progress
+from retry import FailureQueue, RetryPolicy
+from utils import calculate_paths, choose_one, delete_pickles, LogTime, sizeof_fmt, Throttle
+
+log = logging.getLogger(__name__)
+
+PARTIAL_SUFFIX = '.partial'
+
+
+class PathFilter(object):
+    """ Selects the files of a partial restore by fnmatch patterns matched against paths relative to the snapshot dir.
+        A file is selected if it matches any include pattern, or there are none, and no exclude pattern. The epoch
+        files at the top of the snapshot and everything in the catalog are always selected as vertica needs them.
+    """
+    def __init__(self, prefix_dir, catalog_dir, include=None, exclude=None):
+        self.prefix = prefix_dir.rstrip('/') + '/'
+        self.catalog = catalog_dir.strip('/') + '/'
+        self.include = include or []
+        self.exclude = exclude or []
+
+    def __call__(self, relative_path):
+        path = relative_path[len(self.prefix):] if relative_path.startswith(self.prefix) else relative_path
+        if '/' not in path or path.startswith(self.catalog):
+            return True
+        if len(self.include) > 0 and not any(fnmatch.fnmatch(path, pattern) for pattern in self.include):
+            return False
+        return not any(fnmatch.fnmatch(path, pattern) for pattern in self.exclude)
+
+    def apply(self, directory_metadata):
+        """ Return a DirectoryMetadata with only the selected files of directory_metadata. """
+        subset = DirectoryMetadata(date=directory_metadata.date)
+        subset.metadata = dict((path, file_metadata) for path, file_metadata in directory_metadata.metadata.iteritems()
+                               if self(path))
+        return subset
+
+
+def get_path_filter(config, prefix_dir):
+    """ Return a PathFilter from the restore_include and restore_exclude lists in the config, None if neither is set.
+    """
+    if not config.get('restore_include') and not config.get('restore_exclude'):
+        return None
+    return PathFilter(prefix_dir, config['catalog_dir'], config.get('restore_include'), config.get('restore_exclude'))
+
+
+def get_swift_store(config, domain, v_node_name, prefix_dir, bandwidth=None, read_only=False):
+    """ Return the SwiftStore holding the backups of v_node_name in domain, downloads limited to bandwidth bytes per
+        second if set. Objects of at least download_range_threshold bytes are downloaded in download_range_size
+        ranges, download_streams at once. A read_only store does not create a missing container.
+    """
+    token_cache = get_token_cache(config)
+    pool = get_pool(config['swift_url'], config['swift_user'], config['swift_key'], config['swift_tenant'],
+                    config['swift_region'], token_cache, config.get('pool_size', 8))
+    throttle = None
+    if bandwidth is not None:
+        throttle = Throttle(bandwidth)
+    return SwiftStore(config['swift_key'], config['swift_region'], config['swift_tenant'],
+                      config['swift_url'], config['swift_user'], prefix_dir, domain=domain, vnode=v_node_name,
+                      retry_policy=RetryPolicy(config.get('retry_attempts', 5),
+                                               max_delay=config.get('retry_max_delay', 120)),
+                      pool=pool, throttle=throttle, read_only=read_only,
+                      ranges=RangePolicy(config.get('download_range_threshold', 268435456),
+                                         config.get('download_range_size', 67108864),
+                                         config.get('download_streams', 4)))
+
+
+def follow_bandwidth(path, throttle, interval, stop_event):
+    """ Start a thread setting the rate of throttle to the bytes per second in the file at path whenever it changes,
+        checking every interval seconds until stop_event is set. vertica_restore_cluster writes the file to give each
+        node a share of the bandwidth left by the nodes which finished.
+    """
+    def follow():
+        while not stop_event.wait(interval):
+            try:
+                with open(path) as bandwidth_file:
+                    rate = float(bandwidth_file.read())
+            except (IOError, ValueError):
+                continue
+            if rate > 0 and rate != throttle.rate:
+                log.info('Restore bandwidth changed to %s/s' % sizeof_fmt(rate))
+                throttle.rate = rate
+
+    thread = threading.Thread(target=follow, name='restore bandwidth')
+    thread.daemon = True
+    thread.start()
+
+
+def restore_lock(config):
+    """ Return an open lock file, once locked only one download runs into the backup dir at a time. """
+    return open(os.path.join(config['log_dir'], 'restore_download.lock'), 'w')
+
+
+def standby_dir(config):
+    """ Return the dir a warm standby is kept in, standby_dir or by default beside the backup dir. """
+    return config.get('standby_dir', config['backup_dir'].rstrip('/') + '_standby')
+
+
+def get_standby_store(config, prefix_dir):
+    """ Return an FSStore of the warm standby kept for prefix_dir, None if there is no standby on this node. """
+    standby_store = FSStore(standby_dir(config), prefix_dir)
+    if not os.path.isdir(standby_store.prefix_dir):
+        return None
+    return standby_store
+
+
+def seed(standby_store, fs_store, swift_metadata, to_download):
+    """ Hard link, or copy if that is not possible, the files in to_download the standby already has with the expected
+        content into the fs store. Downloads and deletes replace files rather than rewrite them so the linked files
+        are not changed by later standby syncs. Returns the paths still to be downloaded.
+    """
+    standby_metadata = DirectoryMetadata(standby_store).metadata
+    remaining = set()
+    seeded = 0
+    for relative_path in to_download:
+        expected = swift_metadata.metadata[relative_path]
+        available = standby_metadata.get(relative_path)
+        if available is None or available.bytes != expected.bytes or available.hash != expected.hash:
+            remaining.add(relative_path)
+            continue
+        source_path = os.path.join(standby_store.base_dir, relative_path)
+        file_path = os.path.join(fs_store.base_dir, relative_path)
+        if not os.path.exists(os.path.dirname(file_path)):
+            os.makedirs(os.path.dirname(file_path))
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        try:
+            os.link(source_path, file_path)
+        except OSError:
+            shutil.copy2(source_path, file_path)
+        seeded += 1
+    run_metrics.add('objects_seeded', seeded)
+    log.info('Took %d of %d files from the standby in %s' % (seeded, len(to_download), standby_store))
+    return remaining
+
+
+def download(config, swift_store, fs_store, pickle, path_filter=None, standby_store=None):
+    """ Make the local backup dir match the backup described by pickle in swift, downloading what differs and
+        removing anything else then saving the pickle locally to indicate the restore is done.
+        With a path_filter only the selected files are downloaded or removed, the selected subset is saved as a
+        .partial pickle and any complete pickle removed as the dir no longer matches it.
+        Files a warm standby_store already has are taken from it rather than downloaded, the restore lock keeps the
+        standby from syncing meanwhile.
+        Returns an exit status, 0 for success.
+    """
+    base_dir = fs_store.base_dir
+    lock_file = restore_lock(config)
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    try:
+        # Get the metadata from the last restore (if any)
+        current_metadata = DirectoryMetadata(fs_store)
+        swift_metadata = DirectoryMetadata.load_pickle(swift_store, pickle)
+        if path_filter is not None:
+            current_metadata = path_filter.apply(current_metadata)
+            swift_metadata = path_filter.apply(swift_metadata)
+            log.info('Partial restore of %d files' % len(swift_metadata.metadata))
+
+        # Compare the files in the current restore and swift and download/delete as necessary
+        with LogTime(log.debug, "Diff completed", seconds=True, phase='diff'):
+            to_download, to_del = swift_metadata.diff(current_metadata)
+        if standby_store is not None and len(to_download) > 0:
+            with LogTime(log.info, "Seeding from the standby completed", phase='seed'):
+                to_download = seed(standby_store, fs_store, swift_metadata, to_download)
+
+        size_downloaded = 0
+        failures = FailureQueue()
+        progress = run_progress.track('download', str(swift_store),
+                                      sum(swift_metadata.metadata[path].bytes for path in to_download),
+                                      len(to_download))
+        with LogTime(log.info, "Download Completed", phase='download'):
+            for relative_path in to_download:
+                try:
+                    start = time.time()
+                    with progress.transfer():
+                        size = swift_store.download(relative_path, base_dir, swift_metadata.metadata[relative_path])
+                        progress.update(size)
+                    run_metrics.observe('download_seconds', time.time() - start)
+                    run_metrics.add('objects_downloaded')
+                    size_downloaded += size
+                except Exception:
+                    log.exception('Error downloading %s' % relative_path)
+                    failures.add('download of %s' % relative_path, swift_store.download, relative_path, base_dir,
+                                 swift_metadata.metadata[relative_path])
+            retried = failures.retry()
+            run_metrics.add('objects_downloaded', len(retried))
+            size_downloaded += sum(retried)
+            progress.update(sum(retried), len(retried))
+        progress.finish()
+        run_metrics.add('bytes_downloaded', size_downloaded)
+        run_metrics.add('objects_failed', len(failures))
+        log.info("\tDownloaded %s in %d items" % (sizeof_fmt(size_downloaded), len(to_download)))
+        if len(failures) > 0:
+            log.error('%d downloads failed after retries, the restore is incomplete:\n%s' %
+                      (len(failures), '\n'.join(failures.descriptions())))
+            return 1
+
+        progress = run_progress.track('delete', str(fs_store),
+                                      sum(current_metadata.metadata[path].bytes for path in to_del), len(to_del))
+        with LogTime(log.info, "Deleted %d items" % len(to_del), phase='delete'):
+            for relative_path in to_del:
+                fs_store.delete(relative_path)
+                progress.update(current_metadata.metadata[relative_path].bytes)
+        progress.finish()
+
+        EpochFiles(fs_store.prefix_dir, config['catalog_dir'], config['snapshot_name'], swift_metadata.date).restore()
+
+        if path_filter is not None:
+            # The complete pickles no longer describe the dir, nor can their hashes be trusted for the next restore
+            delete_pickles(fs_store, 0)
+            partial_name = swift_metadata.date.strftime("%Y_%m_%d_%H%M") + PARTIAL_SUFFIX
+            for name in fs_store.list_dir():
+                if name.endswith(PARTIAL_SUFFIX) and name != partial_name:
+                    fs_store.delete(name)
+            swift_metadata.save(fs_store, PARTIAL_SUFFIX)
+            return 0
+
+        # Save the swift metadata to the local fs, to indicate the restore is done
+        swift_metadata.save(fs_store)
+        delete_pickles(fs_store)
+        return 0
+    finally:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
+
+
+def sync_standby(config, swift_store, standby_store):
+    """ Download the newest backup in swift into the standby if it does not have it yet.
+        Returns an exit status, 0 if the standby is up to date.
+    """
+    if not os.path.exists(standby_store.prefix_dir):
+        os.makedirs(standby_store.prefix_dir)
+    pickles = swift_store.list_pickles()
+    local_pickles = standby_store.list_pickles()
+    if len(pickles) == 0 or (len(local_pickles) > 0 and local_pickles[0] == pickles[0]):
+        return 0
+
+    log.info('New backup %s found, syncing the standby' % pickles[0])
+    run_metrics.reset()
+    with LogTime(log.info, "Standby sync of %s completed" % pickles[0], phase='total'):
+        exit_status = download(config, swift_store, standby_store, pickles[0])
+    if exit_status != 0:
+        log.error('Standby sync of %s failed, it will be retried next poll' % pickles[0])
+    record_pool_stats()
+    write_run_metrics(os.path.join(config['log_dir'], 'restore_standby.json'), config.get('prometheus_textfile_dir'),
+                      'vertica_restore_standby')
+    return exit_status
+
+
+def watch(config, domain, v_node_name):
+    """ Keep a warm standby in the standby dir, polling swift every standby_poll_interval seconds and downloading
+        each new backup as it appears, limited to standby_bandwidth bytes per second. The backup dir is left alone,
+        a restore into it takes what it can from the standby so it only has to download what changed since the last
+        poll. Runs until killed.
+    """
+    prefix_dir = calculate_paths(config, v_node_name)[1]
+    swift_store = get_swift_store(config, domain, v_node_name, prefix_dir, config.get('standby_bandwidth'))
+    standby_store = FSStore(standby_dir(config), prefix_dir)
+    interval = config.get('standby_poll_interval', 300)
+    log.info('Watching %s for new backups every %d seconds, keeping the standby in %s' %
+             (swift_store, interval, standby_store))
+
+    while True:
+        try:
+            sync_standby(config, swift_store, standby_store)
+        except Exception:
+            log.exception('Error syncing the standby, it will be retried next poll')
+        time.sleep(interval)
 
 
 def main(argv=None):
     if argv is None:
         argv = sys.argv
-    if (len(argv) > 5) or (len(argv) < 4):
-        print "Usage: " + argv[0] + " <config file> <domain> <v_node> [YYYY_MM_DD]"
+    flags = []
+    overrides = {}
+    args = []
+    remaining = list(argv[1:])
+    while len(remaining) > 0:
+        arg = remaining.pop(0)
+        if arg in ('--plan', '--watch'):
+            flags.append(arg)
+        elif arg == '--set' and len(remaining) > 0 and '=' in remaining[0]:
+            key, value = remaining.pop(0).split('=', 1)
+            overrides[key] = yaml.safe_load(value)
+        elif arg in ('--include', '--exclude') and len(remaining) > 0:
+            overrides.setdefault('restore_' + arg[2:], []).append(remaining.pop(0))
+        else:
+            args.append(arg)
+    if (len(args) > 4) or (len(args) < 3) or len(flags) > 1 or ('--watch' in flags and len(args) != 3):
+        print "Usage: " + argv[0] + " [--plan|--watch] [--set key=value ...] [--include pattern ...] " \
+                                    "[--exclude pattern ...] <config file> <domain> <v_node> [YYYY_MM_DD]"
         print "The config file is the same format as used for backups, backup dir, snapshot name and swift credentials are used"
         print 'The domain is the domain to be restored from swift and the v_node is the vertica node name to restore data for'
         print 'If the year/month/day is specified the most recent backup on that day will be downloaded rather than prompting'
+        print 'With --plan the download and delete volume and duration are estimated without transferring anything'
+        print 'With --watch a warm standby is kept in the standby dir, each new backup is downloaded as it appears'
+        print 'Each --set overrides a config setting for this run, for example --set snapshot_name=restored_db'
+        print 'With --include or --exclude only files matching the patterns, relative to the snapshot dir, are restored'
+        print 'along with the epoch and catalog files. Other local files are left alone and a .partial pickle written'
         return 1
 
-    config_file = argv[1]
-    domain = argv[2]
-    v_node_name = argv[3]
-    if len(argv) == 5:
-        day = argv[4]
+    config_file = args[0]
+    domain = args[1]
+    v_node_name = args[2]
+    if len(args) == 4:
+        day = args[3]
     else:
         day = None
     config = yaml.load(open(config_file, 'r'))
+    config.update(overrides)
+    if '--watch' in flags and (config.get('restore_include') or config.get('restore_exclude')):
+        print 'A warm standby keeps the complete backup, --include and --exclude can not be used with --watch'
+        return 1
 
     # Setup logging
     logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
-    log = logging.getLogger(__name__)
+    if '--watch' in flags:
+        run_progress.start(config.get('restore_progress_file', os.path.join(config['log_dir'], 'restore_progress.json')),
+                           config.get('progress_interval', 5))
+        watch(config, domain, v_node_name)
+        return 0
 
-    with LogTime(log.info, "Restore download completed"):
+    if config.get('profile', False):
+        run_profiler.start(config['log_dir'], 'restore_download', config.get('profile_interval', 10))
+    run_progress.start(config.get('restore_progress_file', os.path.join(config['log_dir'], 'restore_progress.json')),
+                       config.get('progress_interval', 5))
+
+    exit_status = 0
+    with LogTime(log.info, "Restore download completed", phase='total'):
 
         # Setup swift/paths
         base_dir, prefix_dir = calculate_paths(config, v_node_name)
-        swift_store = SwiftStore(config['swift_key'], config['swift_region'], config['swift_tenant'],
-                                 config['swift_url'], config['swift_user'], prefix_dir, domain=domain, vnode=v_node_name)
-        fs_store = FSStore(base_dir, prefix_dir)
-
-        # Get the metadata from the last restore (if any)
-        current_metadata = DirectoryMetadata(fs_store)
+        swift_store = get_swift_store(config, domain, v_node_name, prefix_dir, config.get('restore_bandwidth'),
+                                      '--plan' in flags)
+        fs_store = FSStore(base_dir, prefix_dir, hash_files='--plan' not in flags,
+                           walk_threads=config.get('walk_threads', 1))
+        path_filter = get_path_filter(config, prefix_dir)
 
         # Grab the swift metadata we want to restore
-        if day is None:
+        if not swift_store.exists():
+            pickle = None
+        elif day is None:
             pickle = choose_one(swift_store.list_pickles(), "Please choose a pickle to restore from")
         else:
             # Since the list is sorted this will find the newest that matches the given day, or None otherwise
@@ -84,28 +395,36 @@ def main(argv=None):
         if pickle is None:
             log.error('No backups found in swift.')
             sys.exit(1)
-        swift_metadata = DirectoryMetadata.load_pickle(swift_store, pickle)
-
-        # Compare the files in the current restore and swift and download/delete as necessary
-        with LogTime(log.debug, "Diff completed", seconds=True):
-            to_download, to_del = swift_metadata.diff(current_metadata)
-
-        size_downloaded = 0
-        with LogTime(log.info, "Download Completed"):
-            for relative_path in to_download:
-                size_downloaded += swift_store.download(relative_path, base_dir)
-        log.info("\tDownloaded %s in %d items" % (sizeof_fmt(size_downloaded), len(to_download)))
-
-        with LogTime(log.info, "Deleted %d items" % len(to_del)):
-            for relative_path in to_del:
-                fs_store.delete(relative_path)
 
-        EpochFiles(os.path.join(base_dir, prefix_dir), config['snapshot_name'], swift_metadata.date).restore()
+        if '--plan' in flags:
+            current_metadata = DirectoryMetadata(fs_store)
+            swift_metadata = DirectoryMetadata.load_pickle(swift_store, pickle)
+            if path_filter is not None:
+                current_metadata = path_filter.apply(current_metadata)
+                swift_metadata = path_filter.apply(swift_metadata)
+            to_download, to_del = plan.estimate_diff(swift_metadata, current_metadata)
+            download_rate = plan.metrics_rate(os.path.join(config['log_dir'], 'restore_download.json'), 'download')
+            if download_rate is None:  # No previous restore, the backup upload rate is the best guess
+                download_rate = plan.history_rates(swift_store)[0]
+            plan.print_plan([plan.plan_entry(swift_store, 'download', to_download, swift_metadata, download_rate),
+                             # Local deletes are quick enough to ignore
+                             plan.plan_entry(fs_store, 'delete', to_del, current_metadata, float('inf'))])
+            run_profiler.stop()
+            return 0
 
-        # Save the swift metadata to the local fs, to indicate the restore is done
-        swift_metadata.save(fs_store)
+        stop_following = threading.Event()
+        if swift_store.throttle is not None and config.get('restore_bandwidth_file') is not None:
+            follow_bandwidth(config['restore_bandwidth_file'], swift_store.throttle, config.get('progress_interval', 5),
+                             stop_following)
+        exit_status = download(config, swift_store, fs_store, pickle, path_filter,
+                               get_standby_store(config, prefix_dir))
+        stop_following.set()
+        record_pool_stats()
 
-    delete_pickles(fs_store)
+    write_run_metrics(os.path.join(config['log_dir'], 'restore_download.json'), config.get('prometheus_textfile_dir'),
+                      'vertica_restore_download')
+    run_profiler.stop()
+    return exit_status
 
 if __name__ == "__main__":
     sys.exit(main())
@@ -0,0 +1,115 @@
+""" Retry handling shared by the object store operations.
+    A RetryPolicy retries a single operation with exponential backoff and jitter, a FailureQueue collects operations
+    which still failed so they can be tried again at the end of the run.
+
+Copyright 2014 Hewlett-Packard Development Company, L.P.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software 
+and associated documentation files (the "Software"), to deal in the Software without restriction, 
+including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, 
+and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, 
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or 
+substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, 
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR 
+PURPOSE AND NONINFRINGEMENT.
+
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR 
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF 
+OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+import logging
+import random
+import time
+
+from metrics import run_metrics
+
+log = logging.getLogger(__name__)
+
+# Return values from a RetryPolicy classifier
+FAIL = 0  # Give up immediately
+RETRY = 1  # Retry after a backoff
+RECONNECT = 2  # Rebuild the connection then retry after a backoff
+
+
+class RetryPolicy(object):
+    """ Retry an operation with exponential backoff and jitter.
+        The classifier is a function taking an exception and returning FAIL, RETRY or RECONNECT.
+    """
+    def __init__(self, attempts=5, base_delay=1.0, max_delay=120.0, classifier=None):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.classifier = classifier
+        self.retries = 0  # Total retries made, across all operations using this policy
+
+    def delay(self, attempt):
+        """ The seconds to wait before the given retry attempt, full jitter over an exponentially growing window.
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def call(self, description, func, reconnect=None):
+        """ Call func until it succeeds or the attempts are exhausted, returning what func returns.
+            reconnect is called before retrying when the classifier asks for a new connection.
+            The last exception is raised if all attempts fail.
+        """
+        attempt = 0
+        while True:
+            try:
+                return func()
+            except Exception, ex:
+                attempt += 1
+                if self.classifier is None:
+                    action = RETRY
+                else:
+                    action = self.classifier(ex)
+                if action == FAIL or attempt >= self.attempts:
+                    raise
+
+                delay = self.delay(attempt)
+                log.warning('Error in %s, attempt %d of %d, retrying in %.1f seconds. Details:\n%s' %
+                            (description, attempt, self.attempts, delay, ex))
+                self.retries += 1
+                run_metrics.add('retries')
+                time.sleep(delay)
+                if action == RECONNECT and reconnect is not None:
+                    try:
+                        reconnect()
+                    except Exception:
+                        log.exception('Error reconnecting for %s' % description)
+
+
+class FailureQueue(object):
+    """ Operations which failed after all retries, to be tried again at the end of the run.
+    """
+    def __init__(self):
+        self.items = []
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, description, func, *args):
+        self.items.append((description, func, args))
+
+    def descriptions(self):
+        return [description for description, func, args in self.items]
+
+    def retry(self):
+        """ Try each queued operation once more, keeping those which fail again.
+            Returns a list of the return values of the operations which succeeded.
+        """
+        results = []
+        remaining = []
+        for description, func, args in self.items:
+            try:
+                results.append(func(*args))
+            except Exception:
+                log.exception('Retry of %s failed' % description)
+                remaining.append((description, func, args))
+        if len(self.items) > 0:
+            log.info('Retried %d failed operations, %d still failing' % (len(self.items), len(remaining)))
+        self.items = remaining
+        return results
@@ -0,0 +1,110 @@
+""" Ordering of the uploads in a backup so the threads uploading to a store finish together.
+    Files are uploaded largest first so a huge file is never started near the end leaving one thread busy while the
+    others are idle. Each thread takes the next file from a shared queue when it is free, so the small files at the end
+    fill in around the large ones still uploading. Optional priority classes put files matching patterns first or last.
+
+Copyright 2014 Hewlett-Packard Development Company, L.P.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software 
+and associated documentation files (the "Software"), to deal in the Software without restriction, 
+including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, 
+and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, 
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or 
+substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, 
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR 
+PURPOSE AND NONINFRINGEMENT.
+
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR 
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF 
+OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+import fnmatch
+import heapq
+import logging
+
+from metrics import run_metrics
+from utils import sizeof_fmt
+
+log = logging.getLogger(__name__)
+
+# Priority classes in upload order
+FIRST = 0
+NORMAL = 1
+LAST = 2
+CLASS_NAMES = ('first', 'normal', 'last')
+
+SMALL_BYTES = 1048576  # Files smaller than this are bound by request latency rather than bandwidth
+
+
+def priority_class(path, first=(), last=()):
+    """ The priority class of path, FIRST if it matches one of the first glob patterns, LAST if one of the last. """
+    for pattern in first:
+        if fnmatch.fnmatch(path, pattern):
+            return FIRST
+    for pattern in last:
+        if fnmatch.fnmatch(path, pattern):
+            return LAST
+    return NORMAL
+
+
+def estimate_makespan(sizes, threads):
+    """ Return the bytes uploaded by the busiest of threads taking files of the given sizes in order, each taking the
+        next when it is free, assuming all upload at the same rate.
+    """
+    loads = [0] * max(threads, 1)
+    for size in sizes:
+        heapq.heapreplace(loads, loads[0] + size)
+    return max(loads)
+
+
+def interleave(ordered, metadata, small_bytes=SMALL_BYTES):
+    """ Spread the files smaller than small_bytes evenly between the larger ones, keeping the order within each.
+        The threads taking small files then overlap their request latency with those streaming large files rather
+        than all the small files coming at the end.
+    """
+    large = [path for path in ordered if metadata[path].bytes >= small_bytes]
+    small = [path for path in ordered if metadata[path].bytes < small_bytes]
+    if len(large) == 0 or len(small) == 0:
+        return ordered
+    interleaved = []
+    for index, path in enumerate(large):
+        interleaved.append(path)
+        interleaved.extend(small[len(small) * index / len(large):len(small) * (index + 1) / len(large)])
+    return interleaved
+
+
+def schedule(paths, metadata, threads=1, first=(), last=(), small_bytes=SMALL_BYTES):
+    """ Return the paths in upload order, by priority class then largest first with the files smaller than
+        small_bytes interleaved, recording the decisions in the run metrics. The makespan metrics are the bytes the
+        busiest thread uploads in this order and in the unsorted order, the ideal being the larger of the biggest file
+        and an even split between the threads.
+        metadata is a dictionary of path to FileMetadata.
+    """
+    classes = dict((path, priority_class(path, first, last)) for path in paths)
+    ordered = []
+    for priority in range(len(CLASS_NAMES)):
+        members = sorted([path for path in paths if classes[path] == priority],
+                         key=lambda path: (-metadata[path].bytes, path))
+        ordered.extend(interleave(members, metadata, small_bytes))
+
+    sizes = [metadata[path].bytes for path in ordered]
+    makespan = estimate_makespan(sizes, threads)
+    unordered = estimate_makespan([metadata[path].bytes for path in paths], threads)
+    ideal = max(max(sizes or [0]), sum(sizes) / max(threads, 1))
+    for priority, name in enumerate(CLASS_NAMES):
+        run_metrics.set('scheduled_objects', len([path for path in ordered if classes[path] == priority]),
+                        {'class': name})
+    run_metrics.set('scheduled_small_objects', len([size for size in sizes if size < small_bytes]))
+    run_metrics.set('schedule_threads', threads)
+    run_metrics.set('schedule_makespan_bytes', makespan)
+    run_metrics.set('schedule_unordered_makespan_bytes', unordered)
+    run_metrics.set('schedule_ideal_bytes', ideal)
+    if len(ordered) > 0:
+        log.info('Scheduled %d uploads on %d threads largest first with small files interleaved, the busiest thread '
+                 'uploads %s against %s unsorted and %s ideally' % (len(ordered), threads, sizeof_fmt(makespan),
+                                                                    sizeof_fmt(unordered), sizeof_fmt(ideal)))
+    return ordered
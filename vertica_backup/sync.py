@@ -0,0 +1,427 @@
+""" Synchronize a DirectoryMetadata snapshot to one or more object stores.
+    Each file to upload is read once and teed to every store which needs it, while diff, retention and the
+    pickle sentinel are tracked separately for each store.
+
+Copyright 2014 Hewlett-Packard Development Company, L.P.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software 
+and associated documentation files (the "Software"), to deal in the Software without restriction, 
+including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, 
+and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, 
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or 
+substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, 
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR 
+PURPOSE AND NONINFRINGEMENT.
+
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR 
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF 
+OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+import logging
+import os
+import Queue
+import threading
+import time
+
+from directory_metadata import DirectoryMetadata
+from history import save_stats
+from metrics import run_metrics
+from progress import run_progress
+from retry import FailureQueue
+from schedule import schedule
+from utils import delete_pickles, LogTime, sizeof_fmt
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 65536
+TEE_POLL = 0.005  # Seconds between checks for room while every teed pipe is full
+DIFF_POLL = 0.01  # Seconds between checks for a finished diff while waiting on the stores
+DIFF_GRACE = 0.2  # Seconds the stores still diffing have to join the first before uploads start without them
+
+
+class TeeDetached(Exception):
+    """ Raised when reading from a StorePipe the tee reader has given up on. """
+    pass
+
+
+class StorePipe(object):
+    """ A file like object fed chunks by the tee reader and read by a single store upload.
+        A chunk of None marks the end of the file.
+    """
+    def __init__(self, max_chunks):
+        self.max_chunks = max_chunks
+        self.queue = Queue.Queue(max_chunks)
+        self.buffer = ''
+        self.detached = False
+        self.done = False
+
+    def detach(self):
+        """ Stop feeding this pipe, any reader of it will get a TeeDetached exception. """
+        self.detached = True
+        try:
+            self.queue.put_nowait(TeeDetached())
+        except Queue.Full:
+            pass  # The reader will find detached set when it drains the queue
+
+    def offer(self, chunk):
+        """ Feed a chunk into the pipe if there is room, returning whether it was accepted. """
+        try:
+            self.queue.put_nowait(chunk)
+        except Queue.Full:
+            return False
+        return True
+
+    def lagging(self, lead):
+        """ Return True if the buffer is full while the reader of the lead pipe has emptied at least half of its own.
+        """
+        return self.queue.full() and lead.queue.qsize() <= self.max_chunks // 2
+
+    def read(self, size=-1):
+        while not self.done and (size < 0 or len(self.buffer) < size):
+            chunk = self.queue.get()
+            if isinstance(chunk, TeeDetached) or self.detached:
+                raise TeeDetached()
+            if chunk is None:
+                self.done = True
+            else:
+                self.buffer += chunk
+
+        if size < 0:
+            data, self.buffer = self.buffer, ''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+class StoreWorker(threading.Thread):
+    """ Runs the backup of a snapshot to a single store.
+        The worker diffs the snapshot with the store then takes upload jobs from its queue, either a StorePipe to read
+        from or None meaning it should read the file itself. Failed uploads and deletes are queued and retried once
+        the other jobs are done. Retention is then applied and the pickle uploaded, unless some uploads still failed
+        in which case the store is left without today's sentinel.
+        With an expiry policy, objects past or near their delete time are left out of the diff so they are uploaded
+        again and the delete time of the others the snapshot references is cleared before any upload starts.
+        The jobs are taken by upload_threads threads in the order they are added.
+    """
+    def __init__(self, current_metadata, store, base_dir, retain, expiry=None, upload_threads=1):
+        threading.Thread.__init__(self, name=str(store))
+        self.daemon = True
+        self.current_metadata = current_metadata
+        self.store = store
+        self.base_dir = base_dir
+        self.retain = retain
+        self.expiry = expiry if store.supports_expiry else None
+        self.expiring = None
+        self.labels = {'store': str(store)}
+        self.upload_threads = upload_threads
+
+        self.diffed = threading.Event()
+        self.jobs = Queue.Queue()
+        self.store_metadata = None
+        self.to_add = set()
+        self.failures = FailureQueue()
+        self.size_uploaded = 0
+        self.size_lock = threading.Lock()
+        self.exit_status = 1
+
+    def add_job(self, relative_path, pipe=None):
+        self.jobs.put((relative_path, pipe))
+
+    def finish(self):
+        """ Signal no more upload jobs are coming, each upload thread passes the signal on to the next. """
+        self.jobs.put(None)
+
+    def _upload(self, relative_path, pipe):
+        """ Upload a single file, from the pipe if given, falling back to reading the file directly.
+        """
+        if pipe is not None:
+            try:
+                return self.store.upload_file(relative_path, pipe, self.current_metadata.metadata[relative_path].bytes)
+            except TeeDetached:
+                log.info('%s fell behind the tee reading %s, reading it directly' % (self.store, relative_path))
+            except Exception, ex:
+                pipe.detach()
+                log.error('Error uploading %s from the tee to %s, reading it directly. Details:\n%s' %
+                          (relative_path, self.store, ex))
+        return self.store.upload(relative_path, self.base_dir)
+
+    def _upload_jobs(self, progress):
+        """ Upload jobs from the queue until the end of the jobs is signalled. """
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                self.jobs.put(None)
+                break
+            relative_path, pipe = job
+            try:
+                start = time.time()
+                with progress.transfer():
+                    size = self._upload(relative_path, pipe)
+                    progress.update(size)
+                run_metrics.observe('upload_seconds', time.time() - start, self.labels)
+                run_metrics.add('bytes_uploaded', size, self.labels)
+                run_metrics.add('objects_uploaded', 1, self.labels)
+                with self.size_lock:
+                    self.size_uploaded += size
+            except Exception:
+                log.exception('Error uploading %s to %s' % (relative_path, self.store))
+                self.failures.add('upload of %s' % relative_path, self.store.upload, relative_path, self.base_dir)
+
+    def run(self):
+        try:
+            self.store_metadata = DirectoryMetadata(self.store)
+            if self.expiry is not None:
+                self.expiring = self.expiry.load(self.store)
+                expired = self.expiry.remove_expired(self.expiring, self.store_metadata)
+                if len(expired) > 0:
+                    log.warning('%d objects in %s are past their expiry, any still needed will be uploaded again' %
+                                (len(expired), self.store))
+                self.expiry.clear(self.store, self.expiring, self.current_metadata)
+            with LogTime(log.debug, "Diff operation for %s completed" % self.store, seconds=True, phase='diff',
+                         labels=self.labels):
+                self.to_add, do_not_del = self.current_metadata.diff(self.store_metadata)
+            run_metrics.add('objects_skipped', len(self.current_metadata.metadata) - len(self.to_add), self.labels)
+        except Exception:
+            log.exception('Error collecting metadata from %s, it will be skipped' % self.store)
+            return
+        finally:
+            self.diffed.set()
+
+        progress = run_progress.track('upload', str(self.store),
+                                      sum(self.current_metadata.metadata[path].bytes for path in self.to_add),
+                                      len(self.to_add))
+        with LogTime(log.info, "Uploaded to %s Completed" % self.store, phase='upload', labels=self.labels):
+            threads = [threading.Thread(target=self._upload_jobs, args=(progress,), name='%s upload %d' % (self, index))
+                       for index in range(1, self.upload_threads)]
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+            self._upload_jobs(progress)
+            for thread in threads:
+                thread.join()
+            retried = self.failures.retry()
+            run_metrics.add('bytes_uploaded', sum(retried), self.labels)
+            run_metrics.add('objects_uploaded', len(retried), self.labels)
+            self.size_uploaded += sum(retried)
+            progress.update(sum(retried), len(retried))
+        progress.finish()
+        run_metrics.add('objects_failed', len(self.failures), self.labels)
+        log.info("\tUploaded %s in %d items to %s" % (sizeof_fmt(self.size_uploaded), len(self.to_add), self.store))
+
+        if len(self.failures) > 0:
+            log.error('%d uploads to %s failed, skipping retention and the pickle upload' %
+                      (len(self.failures), self.store))
+            return
+
+        try:
+            self.exit_status = apply_retention(self.current_metadata, self.store, self.store_metadata, self.retain,
+                                               self.failures, self.expiry, self.expiring)
+        except Exception:
+            log.exception('Error applying retention to %s' % self.store)
+
+
+def apply_retention(current_metadata, store, store_metadata, retain, failures=None, expiry=None, expiring=None):
+    """ Delete anything in the store not part of the retained backups then upload the metadata pickle.
+        With an expiry policy the store expires objects itself and only those it has missed are deleted, expiring
+        is the tracked delete times if already loaded.
+        The pickle is uploaded last so its presence in the store indicates the backup is done.
+        Deletes which fail are retried before the pickle upload, those still failing are left in the failures queue
+        and will be picked up again by the next run's retention.
+        Returns an exit status, 0 for success.
+    """
+    if failures is None:
+        failures = FailureQueue()
+    exit_status = 0
+    labels = {'store': str(store)}
+    with LogTime(log.info, "Determining items to delete from %s, retaining %d backups" % (store, retain),
+                 phase='retention', labels=labels):
+        # Grab the pickle names I want to combine, relying on these being in order by date, newest first
+        pickles = store.list_pickles()
+        combine_pickles = pickles[:retain]
+
+        # Take metadata in all these pickles combine.
+        # It would be good to check that there is no overlap in filenames with different content.
+        combined_metadata = DirectoryMetadata()
+        previous_metadata = None
+        for pickle in combine_pickles:
+            pickle_metadata = DirectoryMetadata.load_pickle(store, pickle)
+            combined_metadata.metadata.update(pickle_metadata.metadata)
+            if previous_metadata is None:
+                previous_metadata = pickle_metadata
+
+        # Do a diff with all that is in the store, anything in the store but not in the combined set can be deleted.
+        should_be_empty, to_del = combined_metadata.diff(store_metadata)
+        if len(should_be_empty) != 0:
+            exit_status = 1
+            log.error(
+                "ERROR: Found files in the %d combined retained backups that were not in %s.\n%s"
+                % (retain, store, should_be_empty)
+            )
+
+        if expiry is not None and store.supports_expiry:
+            if expiring is None:
+                expiring = expiry.load(store)
+            to_del = expiry.apply(store, expiring, current_metadata, previous_metadata, store_metadata, retain,
+                                  to_del, failures)
+            expiry.save(store, expiring)
+
+    progress = run_progress.track('delete', str(store),
+                                  sum(store_metadata.metadata[path].bytes for path in to_del), len(to_del))
+    with LogTime(log.info, "Deleted %d items from %s" % (len(to_del), store), phase='delete', labels=labels):
+        for relative_path in to_del:
+            try:
+                start = time.time()
+                store.delete(relative_path)
+                run_metrics.observe('delete_seconds', time.time() - start, labels)
+                run_metrics.add('objects_deleted', 1, labels)
+                run_metrics.add('bytes_deleted', store_metadata.metadata[relative_path].bytes, labels)
+                progress.update(store_metadata.metadata[relative_path].bytes)
+            except Exception:
+                log.exception('Error deleting %s from %s' % (relative_path, store))
+                failures.add('delete of %s' % relative_path, store.delete, relative_path)
+        failures.retry()
+    progress.finish()
+
+    # Keep the run statistics next to the pickle for trend reports
+    save_stats(current_metadata, store)
+
+    # Upload today's metadata pickle, this is done last so its presence an indication the backup is done.
+    current_metadata.save(store)
+
+    # Clean up old pickles
+    delete_pickles(store, retain)
+
+    return exit_status
+
+
+def tee_file(path, pipes, timeout):
+    """ Read the file at path once feeding each chunk to all the pipes.
+        A pipe whose buffer is full while another pipe's reader is at least half a buffer ahead is detached, so a slow
+        store reads the file itself rather than holding the others to its pace. While every pipe is full the tee waits
+        for room, detaching those which make none within timeout seconds.
+        If the file can't be read all pipes are detached so the workers read it themselves and report the error.
+    """
+    attached = list(pipes)
+    try:
+        with open(path, 'rb') as source:
+            while len(attached) > 0:
+                chunk = source.read(CHUNK_SIZE)
+                waiting = list(attached)
+                deadline = time.time() + timeout
+                while len(waiting) > 0:
+                    for pipe in list(waiting):
+                        if pipe.detached:  # The worker gave up on the pipe
+                            waiting.remove(pipe)
+                            attached.remove(pipe)
+                        elif pipe.offer(chunk or None):
+                            waiting.remove(pipe)
+                    if len(waiting) == 0:
+                        break
+                    lead = min(attached, key=lambda pipe: pipe.queue.qsize())
+                    expired = time.time() > deadline
+                    for pipe in list(waiting):
+                        if expired or pipe.lagging(lead):
+                            pipe.detach()
+                            waiting.remove(pipe)
+                            attached.remove(pipe)
+                    if len(waiting) > 0:
+                        time.sleep(TEE_POLL)
+                if not chunk:
+                    break
+    except (IOError, OSError):
+        log.exception('Error reading %s for upload' % path)
+        for pipe in attached:
+            pipe.detach()
+
+
+def backup_to_stores(current_metadata, targets, base_dir, tee_buffer=256, tee_timeout=60, expiry=None,
+                     upload_threads=1, first=(), last=()):
+    """ Backup the snapshot described by current_metadata from base_dir to each (store, retain) in targets.
+        Files needed by more than one store are read once and teed to each. A store which is not keeping up, either
+        still busy with earlier files, half a buffer of tee_buffer chunks behind another store or not reading within
+        tee_timeout seconds, is detached and reads the file itself so it does not hold up the others. An expiry policy
+        is applied to the stores which support it.
+        Each store uploads with upload_threads threads, the files are ordered by the scheduler with those matching the
+        first and last patterns at either end. Up to upload_threads files are teed at once, each by its own thread.
+        Uploads start shortly after the first store is diffed, the stores still listing join in as they finish rather
+        than holding up the others.
+        Returns a list of (exit status, failed operations) matching the targets.
+    """
+    workers = [StoreWorker(current_metadata, store, base_dir, retain, expiry, upload_threads)
+               for store, retain in targets]
+    for worker in workers:
+        worker.start()
+
+    tee_slots = threading.Semaphore(upload_threads)
+
+    def tee(path, pipes):
+        try:
+            tee_file(path, pipes, tee_timeout)
+        except Exception:
+            log.exception('Error teeing %s' % path)
+            for pipe in pipes:
+                pipe.detach()
+        finally:
+            tee_slots.release()
+
+    queued = dict((worker, set()) for worker in workers)
+    first_diffed = None
+    while True:
+        outstanding = [worker for worker in workers
+                       if not worker.diffed.is_set() or len(worker.to_add) > len(queued[worker])]
+        if len(outstanding) == 0:
+            break
+        to_add = set()
+        for worker in outstanding:
+            if worker.diffed.is_set():
+                to_add.update(worker.to_add - queued[worker])
+        if len(to_add) > 0 and first_diffed is None:
+            first_diffed = time.time()
+        # Stores listing at about the same pace as the first share its reads
+        diffing = len([worker for worker in outstanding if not worker.diffed.is_set()]) > 0
+        if len(to_add) == 0 or (diffing and time.time() - first_diffed < DIFF_GRACE):
+            time.sleep(DIFF_POLL)
+            continue
+
+        # Upload to the stores diffed so far, those finishing their diff meanwhile join in for the files still to
+        # come and get the rest in the next round
+        for relative_path in schedule(to_add, current_metadata.metadata, upload_threads, first, last):
+            needed_by = [worker for worker in workers if worker.diffed.is_set() and
+                         relative_path in worker.to_add and relative_path not in queued[worker]]
+            for worker in needed_by:
+                queued[worker].add(relative_path)
+            tee_slots.acquire()
+            # Only tee to workers waiting for work, the rest read the file when they get to it
+            teed = [worker for worker in needed_by if worker.jobs.qsize() == 0]
+            if len(teed) < 2:
+                tee_slots.release()
+                for worker in needed_by:
+                    worker.add_job(relative_path)
+                continue
+
+            pipes = {}
+            for worker in needed_by:
+                if worker in teed:
+                    pipes[worker] = StorePipe(tee_buffer)
+                    worker.add_job(relative_path, pipes[worker])
+                else:
+                    worker.add_job(relative_path)
+
+            tee_thread = threading.Thread(target=tee, args=(os.path.join(base_dir, relative_path), pipes.values()),
+                                          name='tee %s' % relative_path)
+            tee_thread.daemon = True
+            tee_thread.start()
+
+    # Holding every slot means the last tees have finished
+    for slot in range(upload_threads):
+        tee_slots.acquire()
+    for worker in workers:
+        worker.finish()
+    for worker in workers:
+        worker.join()
+
+    return [(worker.exit_status, worker.failures.descriptions()) for worker in workers]
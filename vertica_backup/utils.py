@@ -18,37 +18,116 @@ IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMA
 OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF 
 OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
+from contextlib import contextmanager
+import errno
 from glob import glob
+import hashlib
 import os
+import Queue
+import threading
 import time
 
+from metrics import run_metrics
+from profiling import run_profiler
+
 
 class LogTime(object):
     """ Used by the python 'with' syntax this will time the operation and log the details to the log
     """
-    def __init__(self, log, msg, seconds=False):
+    def __init__(self, log, msg, seconds=False, phase=None, labels=None):
         """ Log is function that can be called for logging
             msg is a string formatted message
             msg_details is a tuple that will be applied to message. The idea being to specify varibles that will
             be updated during executiion and made part of the final message
+            If phase is set the duration is also recorded in the run metrics as that phase with the given labels and
+            the phase is profiled when profiling is enabled.
         """
         self.log = log
         self.msg = msg
         self.seconds = seconds
+        self.phase = phase
+        self.labels = labels
         self.start = None
         self.end = None
 
     def __enter__(self):
+        if self.phase is not None:
+            run_profiler.phase_start(self.phase, self.labels)
         self.start = time.time()
 
     def __exit__(self, atype, value, traceback):
         self.end = time.time()
+        if self.phase is not None:
+            run_profiler.phase_end()
+            run_metrics.phase(self.phase, self.end - self.start, self.labels)
         if self.seconds:
             self.log(self.msg + " in %d seconds" % (self.end - self.start))
         else:
             self.log(self.msg + " in %d minutes" % ((self.end - self.start)/60))
 
 
+class Throttle(object):
+    """ Limits the combined rate of transfers sharing it to rate bytes per second, a token bucket allowing a burst of
+        one second. The rate can be changed while in use.
+    """
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.allowance = self.rate
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, size):
+        """ Account for size bytes transferred, sleeping as needed to keep to the rate. """
+        with self.lock:
+            now = time.time()
+            self.allowance = min(self.rate, self.allowance + (now - self.last) * self.rate) - size
+            self.last = now
+            wait = -self.allowance / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class Slots(object):
+    """ Limits how many transfers sharing it run at once to limit. The limit can be changed while in use, holders
+        above a lowered limit finish what they are doing.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.condition = threading.Condition()
+
+    def set_limit(self, limit):
+        with self.condition:
+            self.limit = limit
+            self.condition.notify_all()
+
+    @contextmanager
+    def hold(self):
+        """ A context holding one slot, waiting for one to be free first. """
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.active -= 1
+                self.condition.notify()
+
+
+class ThrottledReader(object):
+    """ A file like object limiting reads from file_obj with a Throttle. """
+    def __init__(self, file_obj, throttle):
+        self.file_obj = file_obj
+        self.throttle = throttle
+
+    def read(self, size=-1):
+        data = self.file_obj.read(size)
+        self.throttle.consume(len(data))
+        return data
+
+
 def calculate_paths(config, v_node_name=None):
     """ Returns the base_dir and prefix_dir given the config and v_node_name
         If the v_node_name is None it pulls the info from the local drive.
@@ -83,6 +162,58 @@ def delete_pickles(store, keep=1):
         store.delete(pickle)
 
 
+def make_dirs(path):
+    """ Make the directory at path and any missing parents, it is no error if another thread made it first.
+    """
+    try:
+        os.makedirs(path)
+    except OSError, ex:
+        if ex.errno != errno.EEXIST:
+            raise
+
+
+def md5_file(path, chunk_size=1048576):
+    """ Return the hex md5 of the file at path, read in chunks so large files are not held in memory.
+    """
+    md5_hash = hashlib.md5()
+    with open(path, 'rb') as afile:
+        for chunk in iter(lambda: afile.read(chunk_size), ''):
+            md5_hash.update(chunk)
+    return md5_hash.hexdigest()
+
+
+def run_parallel(func, items, threads=8, deadline=None):
+    """ Call func on each item with a pool of threads, stopping early if time passes the deadline if one is set.
+        Returns a dictionary of item to result for the items processed, an exception raised by func is the result.
+    """
+    jobs = Queue.Queue()
+    for item in items:
+        jobs.put(item)
+    results = {}
+    lock = threading.Lock()
+
+    def worker():
+        while deadline is None or time.time() < deadline:
+            try:
+                item = jobs.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                result = func(item)
+            except Exception, ex:
+                result = ex
+            with lock:
+                results[item] = result
+
+    workers = [threading.Thread(target=worker) for i in range(threads)]
+    for thread in workers:
+        thread.daemon = True
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return results
+
+
 def sizeof_fmt(num):
     """ Yanked from http://stackoverflow.com/questions/1094841/reusable-library-to-get-human-readable-version-of-file-size
     """
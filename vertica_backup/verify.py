@@ -0,0 +1,277 @@
+""" Verify backups are restorable without restoring them.
+    A backup in a store is checked against its pickle using the store listing, objects missing or different in the
+    listing are confirmed with concurrent HEADs and optionally a sample is downloaded and re-hashed. A restored
+    local tree is checked by hashing every file in parallel. The result is reported in nagios format and the checks
+    stop when the time budget runs out, reporting a warning for an incomplete verification.
+
+Copyright 2014 Hewlett-Packard Development Company, L.P.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software 
+and associated documentation files (the "Software"), to deal in the Software without restriction, 
+including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, 
+and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, 
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or 
+substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, 
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR 
+PURPOSE AND NONINFRINGEMENT.
+
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR 
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF 
+OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+import argparse
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import yaml
+
+from backup import get_stores
+from directory_metadata import DirectoryMetadata
+from epoch import EpochFiles
+from object_store.fs import FSStore
+from restore_download import get_swift_store
+from utils import calculate_paths, md5_file, run_parallel, sizeof_fmt
+
+log = logging.getLogger(__name__)
+
+OK = 0
+WARNING = 1
+CRITICAL = 2
+STATUS_NAMES = {OK: 'OK', WARNING: 'WARNING', CRITICAL: 'CRITICAL'}
+
+
+class Verification(object):
+    """ Collects problems found and how much was checked. """
+    def __init__(self, name):
+        self.name = name
+        self.problems = []
+        self.checked = 0
+        self.total = 0
+        self.complete = True
+
+    def status(self):
+        if len(self.problems) > 0:
+            return CRITICAL
+        elif not self.complete:
+            return WARNING
+        return OK
+
+    def message(self):
+        msg = '%s checked %d of %d objects' % (self.name, self.checked, self.total)
+        if len(self.problems) > 0:
+            msg += ', %d problems: %s' % (len(self.problems), '; '.join(self.problems[:5]))
+        if not self.complete:
+            msg += ', time budget exhausted before finishing'
+        return msg
+
+
+def list_store(store, deadline):
+    """ Return the metadata of the store, or None if the listing has not finished by the deadline. The listing thread
+        is a daemon left to finish in the background, it does not hold up the exit.
+    """
+    if time.time() >= deadline:
+        return None
+    result = {}
+
+    def lister():
+        try:
+            result['listing'] = store.get_metadata()
+        except Exception, ex:
+            result['listing'] = ex
+
+    thread = threading.Thread(target=lister, name='listing %s' % store)
+    thread.daemon = True
+    thread.start()
+    thread.join(max(deadline - time.time(), 0))
+    listing = result.get('listing')
+    if isinstance(listing, Exception):
+        raise listing
+    return listing
+
+
+def verify_store(store, pickle_name, deadline, threads=8, sample=0):
+    """ Check the backup described by pickle_name is complete in store, comparing the pickle with the store listing.
+        Objects missing or different in the listing are checked again with a HEAD since listings can lag. If sample is
+        set that many objects are downloaded and their md5 compared with the pickle.
+    """
+    verification = Verification(str(store))
+    backup = DirectoryMetadata.load_pickle(store, pickle_name)
+    if backup is None:
+        verification.problems.append('pickle %s not found' % pickle_name)
+        return verification
+    verification.total = len(backup.metadata)
+
+    listing = list_store(store, deadline)
+    if listing is None:
+        verification.complete = False
+        return verification
+    suspect = [path for path, file_metadata in backup.metadata.iteritems()
+               if path not in listing or listing[path] != file_metadata]
+    verification.checked = verification.total - len(suspect)
+
+    def head(path):
+        return store.stat(path)
+
+    results = run_parallel(head, suspect, threads, deadline)
+    verification.checked += len(results)
+    verification.complete = len(results) == len(suspect)
+    for path, found in sorted(results.iteritems()):
+        expected = backup.metadata[path]
+        if isinstance(found, Exception):
+            verification.problems.append('%s could not be checked: %s' % (path, found))
+        elif found is None:
+            verification.problems.append('%s is missing' % path)
+        elif found != expected:
+            verification.problems.append('%s differs, %d bytes %s expected %d bytes %s' %
+                                         (path, found.bytes, found.hash, expected.bytes, expected.hash))
+
+    if sample > 0 and time.time() < deadline:
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            def rehash(path):
+                if isinstance(store, FSStore):  # Nothing to download, stat hashes the file in place
+                    return store.stat(path).hash
+                store.download(path, tmp_dir)
+                local_path = os.path.join(tmp_dir, path)
+                try:
+                    return md5_file(local_path)
+                finally:
+                    os.remove(local_path)
+
+            chosen = random.sample(sorted(backup.metadata), min(sample, len(backup.metadata)))
+            results = run_parallel(rehash, chosen, threads, deadline)
+            if len(results) < len(chosen):
+                verification.complete = False
+            for path, md5 in sorted(results.iteritems()):
+                if isinstance(md5, Exception):
+                    verification.problems.append('%s could not be downloaded: %s' % (path, md5))
+                elif md5 != backup.metadata[path].hash:
+                    verification.problems.append('%s downloaded with md5 %s expected %s' %
+                                                 (path, md5, backup.metadata[path].hash))
+            log.info('Downloaded and rehashed %d sample objects from %s' % (len(results), store))
+        finally:
+            shutil.rmtree(tmp_dir)
+    return verification
+
+
+def verify_local(fs_store, pickle_name, deadline, threads=8, catalog_dir=None, snapshot_name=None):
+    """ Check a restored local tree matches the pickle, hashing every file in parallel.
+        With the catalog_dir and snapshot_name the date stamped epoch files of the pickle are looked for under the
+        standard names restore_download moves them back to.
+    """
+    verification = Verification(str(fs_store))
+    backup = DirectoryMetadata.load_pickle(fs_store, pickle_name)
+    if backup is None:
+        verification.problems.append('pickle %s not found' % pickle_name)
+        return verification
+    verification.total = len(backup.metadata)
+
+    local_paths = dict((path, path) for path in backup.metadata)
+    if snapshot_name is not None:
+        try:
+            epoch_files = EpochFiles(fs_store.prefix_dir, catalog_dir, snapshot_name, backup.date)
+        except IndexError:
+            verification.problems.append('no catalog Snapshots directory found in %s' % fs_store.prefix_dir)
+        else:
+            for archived, restored in epoch_files.restored_paths().iteritems():
+                path = os.path.relpath(archived, fs_store.base_dir)
+                if path in local_paths:
+                    local_paths[path] = os.path.relpath(restored, fs_store.base_dir)
+
+    def stat(path):
+        return fs_store.stat(local_paths[path])
+
+    # Largest first so the long hashes are not left until the end
+    paths = sorted(backup.metadata, key=lambda path: backup.metadata[path].bytes, reverse=True)
+    results = run_parallel(stat, paths, threads, deadline)
+    verification.checked = len(results)
+    verification.complete = len(results) == len(paths)
+    for path, found in sorted(results.iteritems()):
+        expected = backup.metadata[path]
+        if isinstance(found, Exception):
+            verification.problems.append('%s could not be read: %s' % (local_paths[path], found))
+        elif found is None:
+            verification.problems.append('%s is missing' % local_paths[path])
+        elif (found.bytes, found.hash) != (expected.bytes, expected.hash):
+            verification.problems.append('%s differs, %s %s expected %s %s' %
+                                         (local_paths[path], sizeof_fmt(found.bytes), found.hash,
+                                          sizeof_fmt(expected.bytes), expected.hash))
+    return verification
+
+
+def choose_pickle(store, day):
+    """ The newest pickle in the store, or the newest on day if given. """
+    pickles = [name for name in store.list_pickles() if day is None or name.startswith(day)]
+    if len(pickles) == 0:
+        return None
+    return pickles[0]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Verify vertica backups in their stores or a restored local tree.')
+    parser.add_argument('config', help='The backup config file')
+    parser.add_argument('domain', nargs='?', help='With v_node verify the swift backup of another node')
+    parser.add_argument('v_node', nargs='?', help='The vertica node name of the backup to verify')
+    parser.add_argument('--day', help='YYYY_MM_DD, verify the newest backup of this day rather than the newest')
+    parser.add_argument('--local', action='store_true', help='Verify the restored tree in the backup dir instead')
+    parser.add_argument('--sample', type=int, default=0, help='Number of objects to download and rehash')
+    parser.add_argument('--threads', type=int, help='Concurrent HEADs, downloads or hashes, default verify_threads')
+    parser.add_argument('--budget', type=int, help='Seconds allowed for the verification, default verify_budget')
+    args = parser.parse_args(argv)
+    if (args.domain is None) != (args.v_node is None):
+        parser.error('domain and v_node must be given together')
+
+    config = yaml.load(open(args.config, 'r'))
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.WARNING)
+    threads = args.threads or config.get('verify_threads', 8)
+    budget = args.budget or config.get('verify_budget', 3600)
+    start = time.time()
+    deadline = start + budget
+
+    verifications = []
+    try:
+        base_dir, prefix_dir = calculate_paths(config, args.v_node)
+        if args.local:
+            stores = [FSStore(base_dir, prefix_dir)]
+        elif args.domain is not None:
+            stores = [get_swift_store(config, args.domain, args.v_node, prefix_dir)]
+        else:
+            stores = [store for store, retain in get_stores(config, prefix_dir)]
+
+        for store in stores:
+            pickle_name = choose_pickle(store, args.day)
+            if pickle_name is None:
+                verification = Verification(str(store))
+                verification.problems.append('no backup found')
+            elif args.local:
+                verification = verify_local(store, pickle_name, deadline, threads, config['catalog_dir'],
+                                            config['snapshot_name'])
+            else:
+                verification = verify_store(store, pickle_name, deadline, threads, args.sample)
+            verification.name += ' ' + str(pickle_name)
+            verifications.append(verification)
+    except Exception, ex:
+        log.exception('Error verifying')
+        print 'CRITICAL: Verification failed with an error: %s' % ex
+        return CRITICAL
+
+    status = max(verification.status() for verification in verifications)
+    duration = time.time() - start
+    print '%s: %s|duration=%ds checked=%d problems=%d' % (
+        STATUS_NAMES[status], '. '.join(verification.message() for verification in verifications), duration,
+        sum(verification.checked for verification in verifications),
+        sum(len(verification.problems) for verification in verifications))
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,198 @@
+""" A directory walker for metadata collection yielding each file with its stat as a stream.
+    It uses scandir, from python 3 or the scandir backport, so the directory entry types avoid a stat of every entry
+    to find the subdirectories, falling back to listdir with a single lstat per entry without it. Relative paths are
+    built up as directories are descended and directories are shared out between threads as they are found.
+
+Copyright 2014 Hewlett-Packard Development Company, L.P.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software 
+and associated documentation files (the "Software"), to deal in the Software without restriction, 
+including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, 
+and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, 
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or 
+substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, 
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR 
+PURPOSE AND NONINFRINGEMENT.
+
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR 
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF 
+OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+import logging
+import os
+import Queue
+import stat
+import threading
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:  # The scandir backport is a requirement but a checkout may be run without it
+        scandir = None
+
+log = logging.getLogger(__name__)
+
+WALKER = 'listdir' if scandir is None else 'scandir'  # The directory listing in use
+
+WALK_THREADS = 4
+BATCH_SIZE = 1000  # Files passed from a walker thread at a time
+QUEUE_BATCHES = 16  # Batches the walker threads can get ahead of the consumer
+
+
+def _scan(path):
+    """ Return (name, is_dir, stat function) for each entry in the directory at path. As with os.walk symlinks to
+        directories are skipped and the stat of a file follows symlinks.
+    """
+    entries = []
+    if scandir is not None:
+        for entry in scandir(path):
+            if entry.is_dir(follow_symlinks=False):
+                entries.append((entry.name, True, entry.stat))
+            elif not entry.is_symlink() or not entry.is_dir():
+                entries.append((entry.name, False, entry.stat))
+        return entries
+
+    for name in os.listdir(path):
+        full_path = path + '/' + name
+        try:
+            stats = os.lstat(full_path)
+            if stat.S_ISLNK(stats.st_mode):
+                stats = os.stat(full_path)
+                if stat.S_ISDIR(stats.st_mode):
+                    continue
+                entries.append((name, False, lambda stats=stats: stats))
+            else:
+                entries.append((name, stat.S_ISDIR(stats.st_mode), lambda stats=stats: stats))
+        except OSError:  # Reported when the file is stat'ed
+            entries.append((name, False, lambda full_path=full_path: os.stat(full_path)))
+    return entries
+
+
+def _scan_dir(path):
+    """ _scan logging rather than raising errors, an unreadable directory has no entries. """
+    try:
+        return _scan(path)
+    except OSError:
+        log.exception('Error listing the directory %s while building up metadata, skipping it' % path)
+        return []
+
+
+def _files(path, relative_path, entries):
+    """ Yield (relative path, stat) for the files among the entries scanned from path. """
+    for name, is_dir, get_stat in entries:
+        if is_dir:
+            continue
+        try:
+            stats = get_stat()
+        except OSError:
+            log.exception('Error stating a file on disk while building up metadata, skipping file %s/%s' %
+                          (path, name))
+            continue
+        yield _join(relative_path, name), stats
+
+
+def _join(relative_path, name):
+    if len(relative_path) == 0:
+        return name
+    return relative_path + '/' + name
+
+
+def _subdirs(path, relative_path, entries):
+    return [(path + '/' + name, _join(relative_path, name)) for name, is_dir, get_stat in entries if is_dir]
+
+
+def walk_files(path, relative_path, threads=WALK_THREADS):
+    """ Yield (relative path, stat) for every file below path, the relative path being relative_path joined with the
+        path below path. With more than one thread the directories are walked in parallel, each thread taking the
+        next directory found by any of them and feeding files back in batches, so hashing can start on the first
+        files while the rest of the tree is still being walked.
+    """
+    path = path.rstrip('/') or '/'
+    relative_path = relative_path.rstrip('/')
+    if not os.path.isdir(path):
+        return  # As with os.walk a missing top directory has no files
+    if scandir is None:
+        log.warning('Walking %s with listdir and an lstat of every entry, install scandir for a faster walk' % path)
+    else:
+        log.debug('Walking %s with scandir' % path)
+
+    entries = _scan_dir(path)
+    for item in _files(path, relative_path, entries):
+        yield item
+    dirs = _subdirs(path, relative_path, entries)
+
+    if threads <= 1:
+        while len(dirs) > 0:
+            dir_path, dir_relative = dirs.pop()
+            entries = _scan_dir(dir_path)
+            dirs.extend(_subdirs(dir_path, dir_relative, entries))
+            for item in _files(dir_path, dir_relative, entries):
+                yield item
+        return
+
+    jobs = Queue.Queue()
+    for job in dirs:
+        jobs.put(job)
+    pending = [len(dirs)]  # Directories queued or being walked, the walk is done when none are left
+    lock = threading.Lock()
+    results = Queue.Queue(QUEUE_BATCHES)
+    stop = threading.Event()
+
+    def put(batch):
+        while not stop.is_set():
+            try:
+                results.put(batch, timeout=1)
+                return
+            except Queue.Full:
+                continue
+
+    def worker():
+        batch = []
+        try:
+            while not stop.is_set():
+                try:
+                    dir_path, dir_relative = jobs.get(timeout=0.05)
+                except Queue.Empty:
+                    with lock:
+                        if pending[0] == 0:
+                            break
+                    continue
+                entries = _scan_dir(dir_path)
+                subdirs = _subdirs(dir_path, dir_relative, entries)
+                with lock:
+                    pending[0] += len(subdirs)
+                for job in subdirs:
+                    jobs.put(job)
+                for item in _files(dir_path, dir_relative, entries):
+                    batch.append(item)
+                    if len(batch) >= BATCH_SIZE:
+                        put(batch)
+                        batch = []
+                with lock:
+                    pending[0] -= 1
+            if len(batch) > 0:
+                put(batch)
+        finally:
+            put(None)
+
+    workers = [threading.Thread(target=worker, name='walker-%d' % index) for index in range(threads)]
+    for thread in workers:
+        thread.daemon = True
+        thread.start()
+    running = len(workers)
+    try:
+        while running > 0:
+            batch = results.get()
+            if batch is None:
+                running -= 1
+                continue
+            for item in batch:
+                yield item
+    finally:
+        stop.set()  # A consumer which stops early releases the threads